@@ -3,51 +3,94 @@
 from __future__ import print_function, division, unicode_literals
 
 import argparse
-from configparser import ConfigParser
-import dataset
-import dateparser
-import datetime
-import glob
-from hashlib import md5
+from functools import cached_property
 import logging
 import os
-import platform
-import psutil
-from random import choice
 import sys
-from time import sleep
+from time import monotonic, sleep
 
-from hercules_config import HerculesConfig
-from autolycus_config import AutolycusConfig
-from autolycus_logger import AutolycusFormatter
+import autolycus_profile
+from autolycus_profile import profiled, span
+
+# The commands the fleet command can run on several installations.
+FLEET_COMMANDS = ['info', 'start', 'stop', 'restart', 'sql_upgrades', 'setup_db']
+
+# Everything else is imported by the commands that need it, so that quick commands like --help,
+# stop and logs don't pay for loading SQLAlchemy, psutil and friends.
+
+class InstallationFilter(logging.Filter):
+    """Tag log records with the installation they are about.
+
+    The text log prefixes their message with it and the JSON log has it as a field of its own.
+    """
+
+    def __init__(self, installation):
+        super().__init__()
+        self.installation = installation
+
+    def filter(self, record):
+        record.installation = self.installation
+        return True
 
 
 class Autolycus(object):
 
-    def __init__(self):
-        self._parse_args()
+    def __init__(self, argv=None, installation=None):
+        """Set up control of a Hercules installation.
+
+        Args:
+            argv (list, optional): The command line arguments; sys.argv if omitted.
+            installation (str, optional): A name to prefix log messages with, for when several
+                installations are controlled from one process.
+        """
+        self._parse_args(argv)
 
         loglevel = logging.DEBUG if self.args.debug else logging.INFO
 
         self.logger = logging.getLogger('autolycus')
-        self.logger.setLevel(loglevel)
+        if not self.logger.handlers:
+            from autolycus_logger import setup_logging
 
-        stdout_log = logging.StreamHandler(sys.stdout)
-        stdout_log.setLevel(loglevel)
-        stdout_log.setFormatter(AutolycusFormatter())
-        self.logger.addHandler(stdout_log)
+            # Keep stdout clean for commands that print machine-readable output.
+            setup_logging(self.logger, sys.stderr if getattr(self.args, 'json', False)
+                          else sys.stdout, loglevel, json_format=self.args.log_format == 'json')
+
+        if self.args.profile:
+            autolycus_profile.enable()
+
+        if installation is not None:
+            self.logger = logging.getLogger(f'autolycus.fleet.{installation}')
+            if not self.logger.filters:
+                self.logger.addFilter(InstallationFilter(installation))
 
         self.servers = ['map-server', 'char-server', 'login-server']
+        # The setting each server's port is configured with, and the Hercules default.
+        self.server_ports = {'map-server': ('map_port', 5121),
+                             'char-server': ('char_port', 6121),
+                             'login-server': ('login_port', 6900)}
+        # Servers that need another server to accept connections before they can start.
+        self.server_dependencies = {'map-server': 'char-server', 'char-server': 'login-server'}
         self.date_format = '%Y-%m-%d_%H-%M-%S'
 
-        self.hercules_config = HerculesConfig(self.hercules_path)
-        self.autolycus_config = AutolycusConfig(self.hercules_path)
-
         self.version_info_file = os.path.join(
             self.hercules_path, 'version_info.ini')
-        self.version_info = self._read_version_info()
 
-    def _parse_args(self):
+    # The configuration and version info are only read once a command needs them.
+    @cached_property
+    def hercules_config(self):
+        from hercules_config import HerculesConfig
+        return HerculesConfig(self.hercules_path)
+
+    @cached_property
+    def autolycus_config(self):
+        from autolycus_config import AutolycusConfig
+        return AutolycusConfig(self.hercules_path)
+
+    @cached_property
+    def version_info(self):
+        return self._read_version_info()
+
+    def _parse_args(self, argv=None):
         parser = argparse.ArgumentParser(
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
@@ -58,26 +101,138 @@ class Autolycus(object):
                             help='Automatically restart servers when making configuration changes.')
         parser.add_argument('--debug', action='store_true',
                             help='Enable debug logging.')
+        parser.add_argument('--log_format', choices=['text', 'json'], default='text',
+                            help='Write the log as text or as one JSON object per line.')
+        parser.add_argument('--profile', action='store_true',
+                            help='Time the steps of the command, write them to the trace file '
+                                 'and log the ones that took longest.')
+        parser.add_argument('--trace_file', default='autolycus_trace.json',
+                            help='Where --profile writes its Chrome trace, for chrome://tracing '
+                                 'or ui.perfetto.dev.')
 
         subparsers = parser.add_subparsers(
             title='Available commands - use autolycus.py [command] -h for help with each command.')
 
         info = subparsers.add_parser('info',
                                      help='Output server status and version information and exit.')
+        info.add_argument('--json', action='store_true',
+                          help='Output the status as a JSON document (and any log messages ' +
+                               'on stderr).')
+        # Not args.timeout: start and restart reuse info() and have a much longer --timeout.
+        info.add_argument('-t', '--timeout', type=float, default=5, dest='probe_timeout',
+                          help='Seconds to wait for each status check.')
         info.set_defaults(func=self.info)
 
         start = subparsers.add_parser('start', help='Start the game servers.')
+        start.add_argument('-t', '--timeout', type=float, default=60,
+                           help='Seconds to wait for each server to accept connections.')
         start.set_defaults(func=self.start)
 
         stop = subparsers.add_parser('stop', help='Stop the game servers.')
+        stop.add_argument('-g', '--grace_period', type=float, default=10,
+                          help='Seconds to wait for the servers to shut down before killing them.')
         stop.set_defaults(func=self.stop)
 
         restart = subparsers.add_parser(
             'restart', help='Stop and restart the game servers.')
+        restart.add_argument('-g', '--grace_period', type=float, default=10,
+                             help='Seconds to wait for the servers to shut down before killing ' +
+                                  'them.')
+        restart.add_argument('-t', '--timeout', type=float, default=60,
+                             help='Seconds to wait for each server to accept connections.')
         restart.set_defaults(func=self.restart)
 
+        supervise = subparsers.add_parser(
+            'supervise', help='Run and watch the game servers, restarting them if they crash.')
+        supervise.add_argument('--socket',
+                               help='The Unix socket to serve supervisor status on. ' +
+                                    '(default: autolycus.sock in the Hercules directory)')
+        supervise.add_argument('--status_port', type=int,
+                               help='Serve status on this TCP port on localhost instead of ' +
+                                    'the Unix socket, e.g. on Windows.')
+        supervise.add_argument('--status', action='store_true',
+                               help='Print the status of a running supervisor and exit.')
+        supervise.add_argument('--backoff_max', type=float, default=60,
+                               help='The longest delay between restarts of a server in seconds.')
+        supervise.add_argument('--crash_limit', type=int, default=5,
+                               help='Give up on a server after this many crashes within ' +
+                                    '--crash_window seconds.')
+        supervise.add_argument('--crash_window', type=float, default=300,
+                               help='The window for crash loop detection in seconds.')
+        supervise.add_argument('-t', '--timeout', type=float, default=60,
+                               help='Seconds to wait for each server to accept connections.')
+        supervise.set_defaults(func=self.supervise)
+
+        metrics = subparsers.add_parser(
+            'metrics', help='Sample CPU, memory, thread and file usage of the game servers.')
+        metrics.add_argument('-i', '--interval', type=float, default=1,
+                             help='Seconds between samples.')
+        metrics.add_argument('--capacity', type=int, default=3600,
+                             help='How many samples to keep per server for summaries.')
+        metrics.add_argument('--port', type=int,
+                             help='Serve metrics in the Prometheus text format on this port ' +
+                                  'until interrupted.')
+        metrics.add_argument('--host', default='127.0.0.1',
+                             help='The address to serve metrics on.')
+        metrics.add_argument('-d', '--duration', type=float, default=10,
+                             help='Without --port, sample for this many seconds and print a ' +
+                                  'summary.')
+        metrics.set_defaults(func=self.metrics)
+
+        watch = subparsers.add_parser(
+            'watch', help='Watch the configuration files and, with -r, restart only the ' +
+                          'servers that read the changed files.')
+        watch.add_argument('--debounce', type=float, default=1,
+                           help='Seconds without further changes before acting on a burst of ' +
+                                'edits.')
+        watch.add_argument('--poll', action='store_true',
+                           help='Poll for changes instead of using inotify, e.g. for network ' +
+                                'file systems.')
+        watch.add_argument('-i', '--interval', type=float, default=1,
+                           help='Seconds between polls with --poll.')
+        watch.add_argument('-g', '--grace_period', type=float, default=10,
+                           help='Seconds to wait for servers to shut down before killing them.')
+        watch.set_defaults(func=self.watch)
+
+        logs = subparsers.add_parser('logs', help='Show the console output of a game server.')
+        logs.add_argument('server', choices=['map-server', 'char-server', 'login-server'],
+                          help='The server to show the output of.')
+        logs.add_argument('-s', '--since', default='1h',
+                          help='Show output since this long ago (e.g. "10m", "2h", "1d") or ' +
+                               'since a date and time (e.g. "2020-05-01 12:00").')
+        logs.set_defaults(func=self.logs)
+
+        web = subparsers.add_parser(
+            'web', help='Serve the server status and start/stop/restart controls over HTTP.')
+        web.add_argument('--host', default='127.0.0.1', help='The address to listen on.')
+        web.add_argument('--port', type=int, default=5000, help='The port to listen on.')
+        web.add_argument('-i', '--interval', type=float, default=2,
+                         help='Seconds between server status refreshes.')
+        web.add_argument('--token', default=os.environ.get('AUTOLYCUS_WEB_TOKEN'),
+                         help='Require this bearer token for start/stop/restart requests. ' +
+                              '(default: $AUTOLYCUS_WEB_TOKEN)')
+        web.set_defaults(func=self.web)
+
+        fleet = subparsers.add_parser(
+            'fleet', help='Run a command on several Hercules installations in parallel.')
+        fleet.add_argument('-i', '--installation', action='append', required=True,
+                           help='The path of an installation, or a glob pattern matching ' +
+                                'several. Can be given more than once.')
+        fleet.add_argument('-j', '--jobs', type=int, default=4,
+                           help='How many installations to work on at the same time.')
+        fleet.add_argument('--json', action='store_true',
+                           help='Output the results as a JSON document (and any log messages ' +
+                                'on stderr).')
+        fleet.add_argument('command', nargs=argparse.REMAINDER,
+                           help='The command to run and its arguments, one of ' +
+                                ', '.join(FLEET_COMMANDS) + '.')
+        fleet.set_defaults(func=self.fleet)
+
         sql_upgrades = subparsers.add_parser(
             'sql_upgrades', help='Run any SQL upgrades needed.')
+        sql_upgrades.add_argument('-f', '--force', action='store_true',
+                                  help='Run upgrades even if the build date is unknown or a ' +
+                                       'previous run was interrupted.')
         sql_upgrades.set_defaults(func=self.sql_upgrades)
 
         setupall = subparsers.add_parser(
@@ -137,19 +292,60 @@ class Autolycus(object):
         account.add_argument(
             'name', help='The user name for the account. Will be created if it does not exist.')
         account.add_argument('-p', '--password', help='The password for the account.')
-        account.add_argument('-s', '--sex', help='The sex for the account (default: random).',
-                             default=choice(['M', 'F']))
+        account.add_argument('-s', '--sex', help='The sex for the account (default: random).')
         account.add_argument('--admin', help='Whether the account should be admin.',
                              action='store_true')
         account.set_defaults(func=self.account)
 
+        import_accounts = subparsers.add_parser(
+            'import_accounts', help='Create or update accounts in bulk from a CSV or JSONL file.')
+        import_accounts.add_argument(
+            'file_name', help='The CSV file (with a header row) or JSON lines file to import. ' +
+                              'Columns are login table columns, e.g. userid, user_pass, sex.')
+        import_accounts.add_argument('--format', choices=['csv', 'jsonl'],
+                                     help='The file format (default: guessed from the extension).')
+        import_accounts.add_argument('--batch_size', type=int, default=1000,
+                                     help='How many accounts to write per transaction.')
+        import_accounts.add_argument('--hashed', action='store_true',
+                                     help='The passwords in the file are already hashed the ' +
+                                          'way the login-server expects.')
+        import_accounts.set_defaults(func=self.import_accounts)
+
         import_sql = subparsers.add_parser(
             'import_sql', help='Import an SQL file into the database.')
         import_sql.add_argument(
-            'file_name', help='The path to the .sql file to import.')
+            'file_name', help='The path to the .sql or .sql.gz file to import.')
+        import_sql.add_argument('--batch_size', type=int, default=1,
+                                help='How many statements to run per transaction.')
+        import_sql.add_argument('--coalesce_rows', type=int, default=1,
+                                help='Merge consecutive INSERTs into the same table into ' +
+                                     'multi-row INSERTs of up to this many rows.')
+        import_sql.add_argument('--disable_checks', action='store_true',
+                                help='Disable foreign key and unique checks during the import.')
+        import_sql.add_argument('-j', '--jobs', type=int, default=1,
+                                help='How many database connections to use to import ' +
+                                     'different tables concurrently. Implies ' +
+                                     '--disable_checks; ignored for SQLite.')
         import_sql.set_defaults(func=self.import_sql)
 
-        self.args = parser.parse_args()
+        export_sql = subparsers.add_parser(
+            'export_sql', help='Export the database to an SQL file that import_sql can read.')
+        export_sql.add_argument(
+            'file_name', help='The file to write. Compressed with gzip if it ends with .gz.')
+        export_sql.add_argument('-t', '--tables', nargs='+',
+                                help='The tables to export (default: all tables).')
+        export_sql.add_argument('--chunk_size', type=int, default=10000,
+                                help='How many rows to read from the database per query.')
+        export_sql.add_argument('--rows_per_insert', type=int, default=1000,
+                                help='How many rows to write per INSERT statement.')
+        export_sql.add_argument('--compress_level', type=int, default=6, choices=range(1, 10),
+                                metavar='{1..9}', help='The gzip compression level.')
+        export_sql.add_argument('-j', '--jobs', type=int, default=1,
+                                help='How many database connections to use to export ' +
+                                     'different tables concurrently.')
+        export_sql.set_defaults(func=self.export_sql)
+
+        self.args = parser.parse_args(argv)
         self.hercules_path = os.path.abspath(self.args.hercules_path)
         self.autorestart = self.args.autorestart
 
@@ -159,6 +355,8 @@ class Autolycus(object):
         Returns:
             dict: A dictionary of the keys and values in the version info file.
         """
+        from configparser import ConfigParser
+
         version_info = {'git_version': 'unknown',
                         'packet_version': 'unknown',
                         'build_date': 'unknown',
@@ -206,57 +404,111 @@ class Autolycus(object):
         Args:
             server_name (str): The server name to get the executable path for.
         """
-        ext = '.exe' if platform.system() == 'Windows' else ''
+        ext = '.exe' if os.name == 'nt' else ''
         return os.path.join(self.hercules_path, f'{server_name}{ext}')
 
-    def _get_status(self, server):
+    def _server_log(self, server):
+        """Get the path of the file a server's console output is logged to."""
+        import autolycus_logs
+
+        return os.path.join(self.hercules_path, autolycus_logs.LOG_DIR, f'{server}.log')
+
+    def _log_settings(self):
+        """Read the console log rotation settings from the installation configuration.
+
+        Returns:
+            tuple: The size to rotate logs at, how many rotated logs to keep and whether to
+                compress them.
+        """
+        import autolycus_logs
+
+        config = self.autolycus_config.installation_config
+        return (int(config('log_max_bytes') or autolycus_logs.MAX_BYTES),
+                int(config('log_backups') or autolycus_logs.BACKUPS),
+                bool(config('log_compress')))
+
+    def _start_log_capture(self, server):
+        """Start a process that writes everything sent to its stdin to a server's log.
+
+        The process runs in its own session so it outlives Autolycus, and exits when the server
+        closes its output.
+
+        Returns:
+            subprocess.Popen: The log capture process.
+        """
+        import autolycus_logs
+        import subprocess
+
+        max_bytes, backups, compress = self._log_settings()
+        command = [sys.executable, autolycus_logs.__file__, self._server_log(server),
+                   '--max_bytes', str(max_bytes), '--backups', str(backups)]
+        if compress:
+            command.append('--compress')
+        return subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL, start_new_session=os.name == 'posix')
+
+    def _server_address(self, server):
+        """Read the address a server listens on from its configuration file.
+
+        Args:
+            server (str): The server to get the address for.
+        Returns:
+            tuple: The host name or IP address and port to connect to the server on.
+        """
+        setting, port = self.server_ports[server]
+        configured_port = self.hercules_config.get(f'{server}.conf', setting)
+        if configured_port is not None:
+            port = int(configured_port, 0)
+        host = (self.hercules_config.get(f'{server}.conf', 'bind_ip') or '').strip('"')
+        if host in ['', '0.0.0.0']:
+            host = '127.0.0.1'
+        return host, port
+
+    def _start_order(self):
+        """Get the servers in the order they need to be started in to satisfy dependencies."""
+        order = []
+
+        def visit(server):
+            if server not in order:
+                if server in self.server_dependencies:
+                    visit(self.server_dependencies[server])
+                order.append(server)
+
+        for server in self.servers:
+            visit(server)
+        return order
+
+    @profiled
+    def _process_snapshot(self):
+        """Take a snapshot of the server processes of this installation.
+
+        Returns:
+            ProcessSnapshot: A snapshot that can answer the status of all servers.
+        """
+        from autolycus_process import ProcessSnapshot
+
+        return ProcessSnapshot(self.hercules_path,
+                               {server: self._server_executable(server) for server in self.servers})
+
+    def _get_status(self, server, snapshot=None):
         """Get the status for the given server.
 
         Args:
             server (str): The server to check status for [map, login, char]
+            snapshot (ProcessSnapshot, optional): The process snapshot to look the server up in.
+                A new one is taken if this is omitted; pass one in when checking several
+                servers to only scan the process table once.
         Returns:
             str: The server status [running, stopped, orphaned, missing].
                 "orphaned" means there is a process for the server but no pid file (or one
                     with a pid that doesn't match the process)
                 "missing" means there is a pid file but no process for the server.
-        Raises:
-            AssertionError: No server status could be determined for the given server.
         """
-        expected_pid = self._server_pid(server)
-
-        # We're expecting a server to be running
-        if expected_pid is not None:
-            if psutil.pid_exists(expected_pid):
-                proc = psutil.Process(expected_pid)
-                if proc.name().startswith(server):
-                    # We've found a process of the right name with the pid we're expecting
-                    return ('running', expected_pid)
-                else:
-                    # The stored pid exists but belongs to another process
-                    return ('missing', expected_pid)
-            else:
-                # The stored pid does not exist
-                return ('missing', expected_pid)
-
-        # We aren't aware of a running server
-        elif expected_pid is None:
-            matching_processes = []
-            for proc in psutil.process_iter():
-                with proc.oneshot():
-                    if proc.name().startswith(server):
-                        matching_processes.append(proc.pid)
-
-            if len(matching_processes) > 1:
-                self.logger.warn(f'Found multiple processes matching {server}!')
-                return ('orphaned', matching_processes)
-            elif len(matching_processes) == 1:
-                return ('orphaned', matching_processes[0])
-            else:
-                return ('stopped', None)
+        snapshot = snapshot or self._process_snapshot()
+        return snapshot.status(server, self._server_pid(server))
 
-        raise AssertionError(f'Failed to find status for {server}!')
-
-    def _run_executable(self, server, force=False):
+    @profiled
+    def _run_executable(self, server, force=False, snapshot=None):
         """Run the specified server executable.
 
         This will clean up orphaned server processes and stray pid files, but not stop running
@@ -265,51 +517,106 @@ class Autolycus(object):
         Args:
             server (str): The server executable to run.
             force (boolean): Whether to restart the server if it is already running.
+            snapshot (ProcessSnapshot, optional): The process snapshot to look the server up in.
+        Returns:
+            psutil.Process: The server process.
         """
-        current_status, pid = self._get_status(server)
+        import psutil
+        import subprocess
+
+        current_status, pid = self._get_status(server, snapshot)
 
         if current_status == 'running' and not force:
-            self.logger.info(f'{server} already running on pid {pid}, not starting another.')
-            return
+            self.logger.info(f'{server} already running on pid {pid}, not starting another.',
+                             extra={'server': server, 'pid': pid, 'operation': 'start'})
+            return psutil.Process(pid)
         elif current_status == 'orphaned' or (current_status == 'running' and force):
             self.logger.info(f'{server} {current_status} on pid {pid}, killing...')
-            self._kill_server(server)
+            self._kill_server(server, snapshot)
         elif current_status == 'missing':
             self.logger.info(f'{server} missing on pid {pid}, removing pidfile.')
             os.remove(os.path.join(self.hercules_path, f'{server}.pid'))
 
-        proc = psutil.Popen([self._server_executable(server)])
+        log_capture = self._start_log_capture(server)
+        try:
+            proc = psutil.Popen([self._server_executable(server)], cwd=self.hercules_path,
+                                stdout=log_capture.stdin, stderr=subprocess.STDOUT)
+        finally:
+            # Only the server may hold the pipe open, so the capture sees when it exits.
+            log_capture.stdin.close()
         if psutil.pid_exists(proc.pid):
             with open(os.path.join(self.hercules_path, f'{server}.pid'), 'w') as pidfile:
                 print(proc.pid, file=pidfile)
-            self.logger.info(f'Started {server} with pid {proc.pid}.')
+            self.logger.info(f'Started {server} with pid {proc.pid}.',
+                             extra={'server': server, 'pid': proc.pid, 'operation': 'start'})
+            return proc
         else:
             exe = self._server_executable(server)
             raise OSError(f'Ran {exe} but failed to find process!')
 
-    def _kill_server(self, server):
+    def _server_pids(self):
+        """Get the pids of all running servers from a single process snapshot.
+
+        Returns:
+            dict: Server names mapped to their pid, or None if a server isn't running.
+        """
+        snapshot = self._process_snapshot()
+        pids = {}
+        for server in self.servers:
+            status, pid = self._get_status(server, snapshot)
+            pids[server] = pid if status in ['running', 'orphaned'] and \
+                not isinstance(pid, list) else None
+        return pids
+
+    def _kill_server(self, server, snapshot=None, grace_period=10):
         """Kill the specified server.
 
         Args:
             server (str): Which of the servers to kill.
+            snapshot (ProcessSnapshot, optional): The process snapshot to look the server up in.
+            grace_period (float, optional): How long to wait for the server to exit before
+                killing it, in seconds.
         """
-        server_status, server_pid = self._get_status(server)
-        pidfile = os.path.join(self.hercules_path, f'{server}.pid')
-        if server_status in ['orphaned', 'running']:
-            self.logger.info(f'Asking {server} (pid {server_pid}) to shut down.')
-            proc = psutil.Process(server_pid)
-            proc.terminate()
-            try:
-                proc.wait(timeout=10)
-            except psutil.TimeoutExpired:
-                self.logger.warn(f'{server} failed to exit within 10 seconds, killing process!')
-                proc.kill()
-        else:
-            self.logger.info(f'{server} is {server_status}, no need to stop.')
+        self._kill_servers([server], snapshot, grace_period)
 
-        if os.path.exists(pidfile):
-            self.logger.info(f'Removing pidfile for {server}.')
-            os.remove(pidfile)
+    @profiled
+    def _kill_servers(self, servers, snapshot=None, grace_period=10):
+        """Kill the specified servers and any processes they started, all at once.
+
+        Args:
+            servers (list): Which of the servers to kill.
+            snapshot (ProcessSnapshot, optional): The process snapshot to look the servers up in.
+            grace_period (float, optional): How long to wait for the servers to exit before
+                killing them, in seconds.
+        """
+        from autolycus_process import terminate
+
+        snapshot = snapshot or self._process_snapshot()
+        processes = []
+        for server in servers:
+            server_status, server_pid = self._get_status(server, snapshot)
+            if server_status in ['orphaned', 'running']:
+                # Only needed when there is something to stop.
+                import psutil
+
+                self.logger.info(f'Asking {server} (pid {server_pid}) to shut down.',
+                                 extra={'server': server, 'pid': server_pid, 'operation': 'stop'})
+                for pid in server_pid if isinstance(server_pid, list) else [server_pid]:
+                    try:
+                        processes.append(psutil.Process(pid))
+                    except psutil.NoSuchProcess:
+                        continue
+            else:
+                self.logger.info(f'{server} is {server_status}, no need to stop.')
+
+        if processes:
+            terminate(processes, grace_period)
+
+        for server in servers:
+            pidfile = os.path.join(self.hercules_path, f'{server}.pid')
+            if os.path.exists(pidfile):
+                self.logger.info(f'Removing pidfile for {server}.')
+                os.remove(pidfile)
 
     @property
     def _database_config(self):
@@ -318,57 +625,153 @@ class Autolycus(object):
             db_config[key] = self.hercules_config.get('sql_connection.conf', key).replace('"', '')
         return db_config
 
+    @property
+    def _database_url(self):
+        return 'mysql://{db_username}:{db_password}@{db_hostname}:{db_port}/{db_database}'.format(
+            **self._database_config)
+
+    @property
+    def _use_md5_passwords(self):
+        return self.hercules_config.get('login-server.conf', 'use_MD5_passwords') == 'true'
+
     def _database(self):
-        """Get a database connection object as a context handler."""
-        db_config = self._database_config
-        db = dataset.connect(
-            'mysql://{db_username}:{db_password}@{db_hostname}:{db_port}/{db_database}'.format(
-                **db_config))
-        return db
-
-    def _database_status(self):
-        """Check connection to the database and output the connection status."""
-        db = self._database()
-        try:
-            db.tables
-            return {'ok': True, 'url': db.url, 'reason': None}
-        except Exception as exc:
-            return {'ok': False, 'url': db.url, 'reason': str(exc).replace('\n', ' ')}
+        """Get a database connection object as a context handler.
+
+        The object and its connection pool are shared by everything using the same database
+        configuration for the lifetime of the process.
+        """
+        from autolycus_db import get_database
+
+        return get_database(self._database_url)
+
+    @profiled
+    def _database_status(self, timeout=None):
+        """Check connection to the database and output the connection status.
 
+        Args:
+            timeout (float, optional): How long connecting to the database may take, in seconds.
+        """
+        from autolycus_db import CONNECT_TIMEOUT, check_database
+
+        return check_database(self._database(), timeout or CONNECT_TIMEOUT)
+
+    @profiled
     def _wait_for_database(self, timeout=120):
+        from autolycus_db import wait_for_database
+
         self.logger.info(f'Waiting for database for up to {timeout} seconds...')
-        while timeout > 0:
-            status = self._database_status()
-            if status['ok']:
-                return True
-            else:
-                timeout -= 1
-                sleep(1)
-        raise IOError(
-            'Database {url} did not become available in time! Reason: {reason}'.format(**status))
+        return wait_for_database(self._database(), timeout)
 
     def execute(self):
-        # try:
-        self.args.func()
-        # except Exception as exc:
-        #     self.logger.error(f'Failed to execute {self.args.func}! Reason: {exc}')
+        try:
+            with span(f'autolycus.py {self.args.func.__name__}'):
+                self.args.func()
+        finally:
+            if self.args.profile:
+                self._write_profile()
+
+    def _write_profile(self):
+        """Write the spans recorded with --profile as a trace and log the slowest of them."""
+        profiler = autolycus_profile.disable()
+        if profiler is None:
+            return
+        profiler.write_trace(self.args.trace_file)
+        self.logger.info(f'Wrote {len(profiler.events)} spans to {self.args.trace_file}; open '
+                         'it in chrome://tracing or ui.perfetto.dev.')
+        self.logger.info('Slowest steps (self time leaves out the steps nested inside):')
+        for line in autolycus_profile.format_summary(profiler.summary()):
+            self.logger.info(line)
+
+    @profiled
+    def _status(self, timeout=5):
+        """Check the servers and the database concurrently.
+
+        The process table scan, a connection to each server's port and the database check all
+        run at the same time, and none of them can take longer than the timeout.
+
+        Args:
+            timeout (float, optional): How long to wait for the checks, in seconds.
+        Returns:
+            dict: The version info, the status, pid, start time, uptime, address and whether it
+                accepts connections for every server, and the database status and latency.
+        """
+        from time import time
+
+        from autolycus_probes import accepts_connections, mask_password, run_probes
+
+        started = monotonic()
+        # Read the configuration up front so the probes only wait on processes and sockets.
+        addresses = {server: self._server_address(server) for server in self.servers}
+        database_url = mask_password(self._database_url)
+        pids = {server: self._server_pid(server) for server in self.servers}
+
+        probes = {'processes': self._process_snapshot,
+                  'database': lambda: self._database_status(timeout)}
+        for server, (host, port) in addresses.items():
+            probes[server] = lambda host=host, port=port: accepts_connections(host, port, timeout)
+        results = run_probes(probes, timeout)
+
+        snapshot = results['processes']['value']
+        servers = {}
+        for server in self.servers:
+            host, port = addresses[server]
+            servers[server] = {'status': 'unknown', 'pid': pids[server], 'started_at': None,
+                               'uptime': None,
+                               'address': f'{host}:{port}',
+                               'accepting_connections': results[server]['value']}
+            if snapshot is None:
+                servers[server]['reason'] = results['processes']['error']
+                continue
+            status, pid = snapshot.status(server, pids[server])
+            servers[server].update(status=status, pid=pid)
+            if not isinstance(pid, list) and pid in snapshot.processes:
+                started_at = snapshot.processes[pid]['create_time']
+                servers[server].update(started_at=started_at, uptime=time() - started_at)
+
+        database = results['database']['value'] or {
+            'ok': False, 'reason': results['database']['error'],
+            'latency': results['database']['latency']}
+        database['url'] = database_url
+
+        return {'hercules_path': self.hercules_path,
+                'version': self.version_info,
+                'servers': servers,
+                'database': database,
+                'elapsed': monotonic() - started}
+
+    @profiled
+    def info(self, timeout=None):
+        """Output info on the Hercules server.
+
+        Args:
+            timeout (float, optional): How long to wait for the status checks, in seconds.
+        """
+        import datetime
+
+        status = self._status(timeout or getattr(self.args, 'probe_timeout', 5))
+        if getattr(self.args, 'json', False):
+            import json
+
+            print(json.dumps(status, indent=2))
+            return
 
-    def info(self):
-        """Output info on the Hercules server."""
         self.logger.info('Hercules {arch} git version {git_version}'.format(**self.version_info))
         self.logger.info(f'Packet version {self.version_info["packet_version"]}')
         self.logger.info(f'{self.version_info["server_mode"]} mode')
         self.logger.info(f'Build date {self.version_info["build_date"]}')
-        for server in self.servers:
-            status, pid = self._get_status(server)
-            self.logger.info(f'{server} status: {status} (pid: {pid})')
-        db_status = self._database_status()
-        status = 'OK' if db_status['ok'] else 'Unavailable'
-        self.logger.info(f'Database status: {status}')
+        for server, server_status in status['servers'].items():
+            uptime = server_status['uptime']
+            uptime = f', up {datetime.timedelta(seconds=round(uptime))}' if uptime else ''
+            self.logger.info(f'{server} status: {server_status["status"]} ' +
+                             f'(pid: {server_status["pid"]}{uptime})')
+        db_status = status['database']
+        self.logger.info(f'Database status: {"OK" if db_status["ok"] else "Unavailable"} ' +
+                         f'({db_status["latency"] * 1000:.0f}ms)')
         self.logger.info(f'Database URL: {db_status["url"]}')
         if db_status['reason']:
             self.logger.info(f'Database status reason: {db_status["reason"]}')
 
+    @profiled
     def setup_database_connection(self, hostname=None, username=None, password=None,
                                   database=None, port=None):
         """Set up the database configuration file.
@@ -388,11 +791,17 @@ class Autolycus(object):
             'db_database': database or self.args.db_database
         }
         self.logger.info(f'Setting up database connection as {field_mappings}.')
-        for setting, value in field_mappings.items():
-            if value and self.hercules_config.get('sql_connection.conf', setting) \
-                    not in [value, f'"{value}"']:
-                self.hercules_config.set('sql_connection.conf', setting, value)
-
+        changed = False
+        with self.hercules_config.transaction():
+            for setting, value in field_mappings.items():
+                if value and self.hercules_config.get('sql_connection.conf', setting) \
+                        not in [value, f'"{value}"']:
+                    self.hercules_config.set('sql_connection.conf', setting, value)
+                    changed = True
+        if changed and self.autorestart:
+            self._restart_changed([self.hercules_config.config_path('sql_connection.conf')])
+
+    @profiled
     def setup_interserver(self, username=None, password=None):
         """Set up the inter-server configuration file and user.
 
@@ -409,82 +818,384 @@ class Autolycus(object):
             self.logger.info(f'Setting up interserver user {field_mappings["userid"]}.')
             self.account(name=field_mappings['userid'],
                          password=field_mappings['passwd'], sex='S', id=1)
-            for config_file in ['char-server.conf', 'map-server.conf']:
-                for setting, value in field_mappings.items():
-                    if value and self.hercules_config.get(config_file, setting) \
-                            not in [value, f'"{value}"']:
-                        self.hercules_config.set(config_file, setting, value)
+            changed = set()
+            with self.hercules_config.transaction():
+                for config_file in ['char-server.conf', 'map-server.conf']:
+                    for setting, value in field_mappings.items():
+                        if value and self.hercules_config.get(config_file, setting) \
+                                not in [value, f'"{value}"']:
+                            self.hercules_config.set(config_file, setting, value)
+                            changed.add(self.hercules_config.config_path(config_file))
+            if changed and self.autorestart:
+                self._restart_changed(changed)
         else:
             self.logger.info('No interserver user specified to set up, leaving defaults.')
 
-    def start(self):
-        """Start the servers."""
-        self.info()
-        for server in self.servers:
+    @profiled
+    def start(self, timeout=None, servers=None):
+        """Start the servers.
+
+        Each server is only started once the server it depends on accepts connections, and
+        this only returns once all of them do.
+
+        Args:
+            timeout (float, optional): How long to wait for each server to accept connections.
+            servers (list, optional): The servers to start; all of them if omitted.
+        """
+        from autolycus_process import wait_for_port
+
+        if servers is None:
+            self.info()
+        timeout = timeout or getattr(self.args, 'timeout', 60)
+        snapshot = self._process_snapshot()
+        for server in self._start_order():
+            if servers is not None and server not in servers:
+                continue
             try:
-                self._run_executable(server)
+                with span(f'start {server}'):
+                    started = monotonic()
+                    proc = self._run_executable(server, snapshot=snapshot)
+                    host, port = self._server_address(server)
+                    wait_for_port(proc, host, port, timeout)
+                self.logger.info(f'{server} accepting connections on {host}:{port} after ' +
+                                 f'{monotonic() - started:.2f}s.')
             except Exception as exc:
                 raise OSError(f'Failed to run {server}! Reason: {exc}')
 
-    def stop(self):
-        """Stop the servers."""
-        for server in self.servers:
-            self._kill_server(server)
+    @profiled
+    def stop(self, grace_period=None):
+        """Stop the servers.
+
+        All servers are asked to shut down at the same time and killed if they have not exited
+        after the grace period.
+
+        Args:
+            grace_period (float, optional): How long to wait for the servers to exit, in seconds.
+        """
+        self._kill_servers(self.servers,
+                           grace_period=grace_period or getattr(self.args, 'grace_period', 10))
 
     def restart(self):
         """Restart the servers."""
         self.stop()
         self.start()
 
+    @profiled
+    def _restart_changed(self, config_files):
+        """Restart only the running servers that read any of the given configuration files.
+
+        Args:
+            config_files (iterable): The full paths of the changed configuration files.
+        Returns:
+            list: The servers that were restarted.
+        """
+        from autolycus_watch import servers_for_config
+
+        conf_path = os.path.join(self.hercules_path, 'conf')
+        affected = {server for config_file in config_files
+                    for server in servers_for_config(config_file, conf_path, self.servers)}
+        snapshot = self._process_snapshot()
+        running = [server for server in self.servers if server in affected and
+                   self._get_status(server, snapshot)[0] == 'running']
+        if not running:
+            self.logger.info('No running server reads the changed configuration files.')
+            return []
+
+        self.logger.info(f'Restarting {", ".join(running)} to apply configuration changes.',
+                         extra={'operation': 'restart'})
+        self._kill_servers(running, snapshot, grace_period=getattr(self.args, 'grace_period', 10))
+        self.start(servers=running)
+        return running
+
+    def watch(self):
+        """Watch the configuration for changes, and restart the servers that read them with -r."""
+        from autolycus_watch import create_watcher, servers_for_config, watch_changes
+
+        conf_path = os.path.join(self.hercules_path, 'conf')
+        watcher = create_watcher(conf_path, poll=self.args.poll, interval=self.args.interval)
+        self.logger.info(f'Watching {conf_path} for changes with {type(watcher).__name__}' +
+                         ('.' if self.autorestart else '; use -r to restart affected servers.'))
+        try:
+            for changed in watch_changes(watcher, self.args.debounce):
+                names = ', '.join(sorted(os.path.relpath(path, conf_path) for path in changed))
+                self.logger.info(f'Configuration changed: {names}')
+                if not self.autorestart:
+                    affected = {server for path in changed
+                                for server in servers_for_config(path, conf_path, self.servers)}
+                    self.logger.info('Restart ' + ', '.join(
+                        server for server in self.servers if server in affected) + ' to apply.')
+                    continue
+                try:
+                    self._restart_changed(changed)
+                except Exception as exc:
+                    self.logger.error(f'Failed to restart servers! Reason: {exc}')
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+
+    def supervise(self):
+        """Run the servers under a resident supervisor that restarts them when they crash."""
+        import asyncio
+        import json
+        from autolycus_supervisor import Supervisor, read_status
+
+        socket_path = self.args.socket or os.path.join(self.hercules_path, 'autolycus.sock')
+        if self.args.status:
+            print(json.dumps(read_status(socket_path, self.args.status_port), indent=2))
+            return
+
+        supervisor = Supervisor(self, socket_path, status_port=self.args.status_port,
+                                backoff_max=self.args.backoff_max,
+                                crash_limit=self.args.crash_limit,
+                                crash_window=self.args.crash_window,
+                                start_timeout=self.args.timeout)
+        asyncio.run(supervisor.run())
+
+    def web(self):
+        """Serve the server status and controls over HTTP until interrupted."""
+        from autolycus_web import ControlQueue, StatusCache, create_app
+
+        if self.args.token is None and self.args.host not in ['127.0.0.1', 'localhost', '::1']:
+            self.logger.warning(f'Serving start/stop/restart controls on {self.args.host} ' +
+                                'without a --token; anyone who can reach it can use them!')
+        status_cache = StatusCache(self, interval=self.args.interval)
+        control_queue = ControlQueue({'start': self.start, 'stop': self.stop,
+                                      'restart': self.restart}, status_cache)
+        status_cache.start()
+        control_queue.start()
+        app = create_app(status_cache, control_queue, token=self.args.token)
+        app.run(host=self.args.host, port=self.args.port, threaded=True)
+
+    def _fleet_installations(self):
+        """Expand the installation paths and patterns given to the fleet command.
+
+        Returns:
+            dict: Unique names for the installations mapped to their paths.
+        """
+        import glob
+
+        paths = []
+        for pattern in self.args.installation:
+            matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+            if not matches:
+                self.logger.warning(f'No installations match {pattern}.')
+            for path in matches:
+                path = os.path.abspath(path)
+                if os.path.isdir(path) and path not in paths:
+                    paths.append(path)
+
+        installations = {}
+        for path in paths:
+            name = os.path.basename(path)
+            if name in installations:
+                name = path
+            installations[name] = path
+        return installations
+
+    def _fleet_run(self, name, path):
+        """Run the fleet command on one installation.
+
+        Returns:
+            dict: Whether the command succeeded, the error if it didn't, how long it took and,
+                for info, the installation's status.
+        """
+        started = monotonic()
+        result = {'path': path, 'ok': True, 'error': None, 'status': None}
+        try:
+            argv = ['-p', path] + (['--debug'] if self.args.debug else []) + \
+                (['-r'] if self.args.autorestart else []) + self.args.command
+            installation = Autolycus(argv, installation=name)
+            with span('Autolycus._fleet_run', installation=name):
+                if installation.args.func.__name__ == 'info':
+                    result['status'] = installation._status(
+                        getattr(installation.args, 'probe_timeout', 5))
+                else:
+                    installation.execute()
+        except SystemExit:
+            # argparse has already printed what was wrong with the arguments.
+            result.update(ok=False, error='Invalid arguments.')
+        except Exception as exc:
+            self.logger.error(f'[{name}] {self.args.command[0]} failed! Reason: {exc}')
+            result.update(ok=False, error=str(exc))
+        result['elapsed'] = monotonic() - started
+        return result
+
+    def fleet(self):
+        """Run a command on several Hercules installations in parallel.
+
+        Every installation gets its own Autolycus instance, run on a bounded thread pool. A
+        failure on one installation doesn't affect the others; the results are collected and
+        summarised once all of them are done.
+
+        Raises:
+            OSError: The command failed on at least one installation.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        import json
+
+        if not self.args.command or self.args.command[0] not in FLEET_COMMANDS:
+            raise KeyError(f'fleet needs one of these commands: {", ".join(FLEET_COMMANDS)}')
+        installations = self._fleet_installations()
+        if not installations:
+            raise KeyError('No Hercules installations to run on!')
+
+        started = monotonic()
+        self.logger.info(f'Running {" ".join(self.args.command)} on {len(installations)} ' +
+                         f'installations, {self.args.jobs} at a time.')
+        with ThreadPoolExecutor(max_workers=max(1, self.args.jobs)) as pool:
+            futures = {name: pool.submit(self._fleet_run, name, path)
+                       for name, path in installations.items()}
+            results = {name: future.result() for name, future in futures.items()}
+        elapsed = monotonic() - started
+
+        if self.args.json:
+            print(json.dumps({'command': self.args.command, 'elapsed': elapsed,
+                              'installations': results}, indent=2))
+        else:
+            for name, result in results.items():
+                outcome = 'OK' if result['ok'] else f'FAILED: {result["error"]}'
+                if result['status'] is not None:
+                    outcome += ' (' + ', '.join(
+                        f'{server} {server_status["status"]}'
+                        for server, server_status in result['status']['servers'].items()) + \
+                        f', database {"OK" if result["status"]["database"]["ok"] else "down"})'
+                self.logger.info(f'{name}: {outcome} in {result["elapsed"]:.1f}s',
+                                 extra={'installation': name, 'operation': self.args.command[0],
+                                        'duration': result['elapsed']})
+            slowest = max(result['elapsed'] for result in results.values())
+            self.logger.info(f'Done in {elapsed:.1f}s (slowest installation {slowest:.1f}s).')
+
+        failed = [name for name, result in results.items() if not result['ok']]
+        if failed:
+            raise OSError(f'{self.args.command[0]} failed on {len(failed)} of ' +
+                          f'{len(installations)} installations: {", ".join(failed)}')
+
+    def metrics(self):
+        """Sample resource usage of the servers and either serve or summarize it."""
+        from autolycus_metrics import MetricsSampler, serve_metrics
+        from autolycus_sql import format_bytes
+
+        sampler = MetricsSampler(self._server_pids, self.servers, interval=self.args.interval,
+                                 capacity=self.args.capacity)
+        sampler.start()
+        try:
+            if self.args.port:
+                serve_metrics(sampler, self.args.host, self.args.port)
+                return
+            sleep(self.args.duration)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sampler.stop()
+
+        for server, fields in sampler.summary().items():
+            if fields['cpu_percent']['avg'] is None:
+                self.logger.info(f'{server}: not running')
+                continue
+            cpu, rss = fields['cpu_percent'], fields['rss_bytes']
+            self.logger.info(f'{server}: CPU {cpu["min"]:.1f}/{cpu["avg"]:.1f}/' +
+                             f'{cpu["p95"]:.1f}%, ' +
+                             f'RSS {format_bytes(rss["min"])}/{format_bytes(rss["avg"])}/' +
+                             f'{format_bytes(rss["p95"])}, ' +
+                             f'threads {fields["threads"]["p95"]:.0f}, ' +
+                             f'fds {fields["open_fds"]["p95"]:.0f} (min/avg/p95)')
+        self.logger.info(f'Took {sampler.samples} samples using {sampler.overhead:.3%} of a core.')
+
+    def logs(self):
+        """Print a server's console output since a point in time."""
+        import autolycus_logs
+
+        since = autolycus_logs.parse_since(self.args.since)
+        _, backups, _ = self._log_settings()
+        output = sys.stdout.buffer
+        try:
+            for line in autolycus_logs.read_since(self._server_log(self.args.server), since,
+                                                  backups):
+                output.write(line)
+            output.flush()
+        except BrokenPipeError:
+            # The output was piped into something like head that has seen enough.
+            sys.stderr.close()
+
+    def _parse_version(self, version):
+        """Parse a build date or last run version, or return None if it isn't one."""
+        import datetime
+
+        try:
+            return datetime.datetime.strptime(version or '', self.date_format)
+        except ValueError:
+            return None
+
+    @profiled
     def sql_upgrades(self, force=False):
         """Determine whether any SQL upgrades need to be run and do so if appropriate.
 
+        Which upgrade files have been applied is recorded in the autolycus_upgrades table of the
+        database, so working out what to do is a single query. Installations that ran upgrades
+        before the table existed have the files older than their last_run_version recorded as
+        applied first.
+
         Args:
             force (boolean): Whether or not to apply SQL updates even if build date cannot be
-                confidently determined.
+                confidently determined, or if a previous run was interrupted part of the way
+                through an upgrade file.
         """
-        try:
-            last_run_version = dateparser.parse(
-                self.autolycus_config.installation_config('last_run_version'),
-                date_formats=[self.date_format])
-            self.logger.debug(f'Read last run version {last_run_version} from ' +
-                              self.autolycus_config.installation_config_file)
-        except Exception:
-            self.logger.warn(
-                f'{self.autolycus_config.installation_config_file} has no last_run_version')
-            last_run_version = datetime.datetime.fromtimestamp(0)
-        current_version = self.version_info['build_date']
-
-        if current_version == 'unknown':
+        import datetime
+
+        from autolycus_upgrades import (UpgradeLedger, file_checksum, parse_upgrade_name,
+                                        plan_upgrades)
+
+        force = force or getattr(self.args, 'force', False)
+        current_version = self._parse_version(self.version_info['build_date'])
+
+        if current_version is None:
             if not force:
                 raise KeyError(f'Could not get build date from {self.version_info_file}! ' +
                                'SQL upgrades are unsafe. To run them anyway, use the "force" flag.')
             else:
                 char_server = self._server_executable('char-server')
-                build_date = datetime.datetime.fromtimestamp(os.path.getctime(char_server))
+                current_version = datetime.datetime.fromtimestamp(os.path.getctime(char_server))
                 self.logger.warn(f'Failed to get build date from {self.version_info_file}! ' +
                                  'SQL upgrades are unsafe.')
                 self.logger.warn('sql_upgrades called with force argument, proceeding anyway.')
                 self.logger.warn('------- THIS MAY BREAK YOUR DATABASE! -------')
-                self.logger.warn(f'Using {char_server} creation date {build_date} as build date.')
-        else:
-            current_version = dateparser.parse(self.version_info['build_date'],
-                                               date_formats=[self.date_format])
-
-        upgrade_files = sorted(glob.glob(os.path.join(self.hercules_path, 'sql-files',
-                                                      'upgrades', '*.sql')))
-
-        for file_name in upgrade_files:
-            upgrade_date = dateparser.parse(os.path.splitext(os.path.basename(file_name))[0],
-                                            date_formats=['%Y-%m-%d--%H-%M'])
-            if upgrade_date is None:
-                self.logger.warn(f'Failed to parse upgrade date for {file_name} - ignoring file.')
-                continue
-            elif last_run_version is None or upgrade_date > last_run_version:
-                self.logger.debug(f'{file_name} has been added since last run, importing...')
-                self.import_sql(file_name)
-            else:
-                self.logger.debug(f'{file_name} is older than last run Hercules, not importing.')
+                self.logger.warn(f'Using {char_server} creation date {current_version} as ' +
+                                 'build date.')
+
+        upgrade_dir = os.path.join(self.hercules_path, 'sql-files', 'upgrades')
+        ledger = UpgradeLedger(self._database().engine)
+        entries = ledger.entries()
+
+        if not entries:
+            last_run_version = self._parse_version(
+                self.autolycus_config.installation_config('last_run_version'))
+            if last_run_version is not None:
+                self.logger.info(f'Recording upgrades up to last run version {last_run_version} ' +
+                                 'as applied.')
+                pending, _ = plan_upgrades(upgrade_dir, entries, self.logger)
+                ledger.record_baseline(
+                    [os.path.basename(file_name) for file_name in pending
+                     if parse_upgrade_name(file_name) <= last_run_version])
+                entries = ledger.entries()
+
+        pending, interrupted = plan_upgrades(upgrade_dir, entries, self.logger)
+        if interrupted:
+            names = ', '.join(os.path.basename(file_name) for file_name in interrupted)
+            if not force:
+                raise KeyError(f'A previous run was interrupted while applying {names}! The ' +
+                               'database may be partially upgraded. Check it and use the ' +
+                               '"force" flag to apply these files again.')
+            self.logger.warn(f'Applying interrupted upgrades {names} again.')
+            pending = sorted(pending + interrupted, key=parse_upgrade_name)
+        self.logger.info(f'{len(pending)} SQL upgrades to apply.')
+
+        for file_name in pending:
+            name = os.path.basename(file_name)
+            ledger.start(name, file_checksum(file_name))
+            started = monotonic()
+            importer = self.import_sql(file_name)
+            ledger.finish(name, monotonic() - started, importer.errors)
 
         # Update last_run_version config setting once all SQL upgrades have been applied
         self.logger.debug('Updating last run version to %s' %
@@ -492,41 +1203,154 @@ class Autolycus(object):
         self.autolycus_config.installation_config('last_run_version',
                                                   current_version.strftime(self.date_format))
 
-    def import_sql(self, file_name):
+    @profiled
+    def import_sql(self, file_name=None, batch_size=None, coalesce_rows=None,
+                   disable_checks=None, jobs=None):
         """Import an .sql file to the database
 
+        By default every statement is run and committed on its own. For large dumps, the other
+        arguments trade that for speed; see SQLImporter for details.
+
         Args:
-            file_name (str): The full path to the .sql file to import.
+            file_name (str, optional): The full path to the .sql file to import.
+            batch_size (int, optional): How many statements to run per transaction.
+            coalesce_rows (int, optional): How many rows to merge consecutive INSERTs into.
+            disable_checks (bool, optional): Whether to disable foreign key and unique checks.
+            jobs (int, optional): How many connections to import different tables with.
 
         Raises:
             IOError: The database is unavailable.
+
+        Returns:
+            SQLImporter: The importer, with the number of rows imported and statements failed.
         """
+        from autolycus_sql import SQLImporter, SQLStatementReader, format_bytes, open_sql_file
+
+        file_name = file_name or self.args.file_name
         self.logger.info(f'Importing {file_name} to database...')
 
         if not self._database_status()['ok']:
             raise IOError('Database is unavailable; cannot import SQL file!')
 
-        with open(file_name) as sql_file, self._database() as db:
-            query = ''
+        importer = SQLImporter(
+            self._database().engine, self.logger,
+            batch_size=batch_size or getattr(self.args, 'batch_size', 1),
+            coalesce_rows=coalesce_rows or getattr(self.args, 'coalesce_rows', 1),
+            disable_checks=disable_checks or getattr(self.args, 'disable_checks', False),
+            jobs=jobs or getattr(self.args, 'jobs', 1))
+
+        with open_sql_file(file_name) as sql_file, \
+                span('import_sql file', file=os.path.basename(file_name)):
+            reader = SQLStatementReader(sql_file, progress=self._log_import_progress)
+            importer.run(reader)
+
+        rows_per_second = importer.rows / reader.elapsed if reader.elapsed > 0 else 0
+        self.logger.info(f'Imported {reader.statements} statements ' +
+                         f'({format_bytes(reader.bytes_read)}, {importer.rows} rows) from ' +
+                         f'{file_name} in {reader.elapsed:.1f}s ' +
+                         f'({format_bytes(reader.throughput)}/s, {rows_per_second:.0f} rows/s).',
+                         extra={'operation': 'import_sql', 'duration': reader.elapsed})
+        if importer.errors:
+            self.logger.warning(f'{importer.errors} statements in {file_name} failed.')
+        return importer
+
+    @profiled
+    def export_sql(self, file_name=None, tables=None, chunk_size=None, rows_per_insert=None,
+                   compress_level=None, jobs=None):
+        """Export the database to an .sql or .sql.gz file
+
+        See SQLExporter for how tables are read and written.
 
-            for line in sql_file.readlines():
-                if line.startswith('--') or line.startswith('#') or not line.strip():
-                    # Ignore any comments, SQL update timestamp lines and empty lines
-                    continue
+        Args:
+            file_name (str, optional): The full path to the file to write.
+            tables (list, optional): The tables to export; all of them if omitted.
+            chunk_size (int, optional): How many rows to read per query.
+            rows_per_insert (int, optional): How many rows to write per INSERT.
+            compress_level (int, optional): The gzip compression level, from 1 to 9.
+            jobs (int, optional): How many connections to export different tables with.
+
+        Raises:
+            IOError: The database is unavailable.
+            KeyError: One of the tables does not exist.
+
+        Returns:
+            SQLExporter: The exporter, with the number of rows and bytes written.
+        """
+        from autolycus_export import SQLExporter
+        from autolycus_sql import format_bytes
 
-                # just add any non-comment lines to the query
-                query += line.strip() + ' '
+        file_name = file_name or self.args.file_name
+        self.logger.info(f'Exporting database to {file_name}...')
 
-                # If the current line ends a command, run it
-                if line.strip().endswith(';'):
-                    self.logger.debug(query)
-                    try:
-                        db.query(query)
-                    except Exception as exc:
-                        self.logger.error(f'SQL statement error: {exc}')
+        if not self._database_status()['ok']:
+            raise IOError('Database is unavailable; cannot export SQL file!')
+
+        exporter = SQLExporter(
+            self._database().engine, self.logger,
+            tables=tables or getattr(self.args, 'tables', None),
+            chunk_size=chunk_size or getattr(self.args, 'chunk_size', 10000),
+            rows_per_insert=rows_per_insert or getattr(self.args, 'rows_per_insert', 1000),
+            compress_level=compress_level or getattr(self.args, 'compress_level', 6),
+            jobs=jobs or getattr(self.args, 'jobs', 1))
+        exporter.run(file_name)
+
+        self.logger.info(f'Exported {exporter.rows} rows ' +
+                         f'({format_bytes(exporter.bytes_written)}) to {file_name} ' +
+                         f'in {exporter.elapsed:.1f}s ({exporter.throughput:.0f} rows/s).',
+                         extra={'operation': 'export_sql', 'duration': exporter.elapsed})
+        return exporter
+
+    @profiled
+    def import_accounts(self, file_name=None, file_format=None, batch_size=None, hashed=None):
+        """Create or update accounts in bulk from a CSV or JSON lines file.
+
+        Args:
+            file_name (str, optional): The full path to the file to import.
+            file_format (str, optional): "csv" or "jsonl"; guessed from the extension if omitted.
+            batch_size (int, optional): How many accounts to write per transaction.
+            hashed (bool, optional): Whether the passwords in the file are already hashed.
 
-                    # empty out current query after running the statement.
-                    query = ''
+        Raises:
+            IOError: The database is unavailable.
+        """
+        from autolycus_accounts import AccountImporter, read_accounts
+
+        file_name = file_name or self.args.file_name
+        self.logger.info(f'Importing accounts from {file_name}...')
+
+        if not self._database_status()['ok']:
+            raise IOError('Database is unavailable; cannot import accounts!')
+
+        importer = AccountImporter(self._database().engine, self.logger,
+                                   use_md5=self._use_md5_passwords,
+                                   hashed=hashed or getattr(self.args, 'hashed', False),
+                                   batch_size=batch_size or getattr(self.args, 'batch_size', 1000))
+        importer.run(read_accounts(file_name, file_format or getattr(self.args, 'format', None)))
+
+        self.logger.info(f'Created {importer.created} and updated {importer.updated} accounts ' +
+                         f'from {file_name} in {importer.elapsed:.1f}s ' +
+                         f'({importer.throughput:.0f} accounts/s).',
+                         extra={'operation': 'import_accounts', 'duration': importer.elapsed})
+        if importer.invalid:
+            self.logger.warning(f'Skipped {importer.invalid} invalid accounts in {file_name}.')
+        if importer.errors:
+            self.logger.warning(f'Failed to write {importer.errors} accounts from {file_name}.')
+
+    def _log_import_progress(self, reader):
+        """Log the progress of an SQL import.
+
+        Args:
+            reader (SQLStatementReader): The reader for the file being imported.
+        """
+        from autolycus_sql import format_bytes
+
+        if reader.percent_done is not None:
+            done = f'{reader.percent_done:.0f}% ({format_bytes(reader.bytes_read)} of ' + \
+                f'{format_bytes(reader.total_bytes)})'
+        else:
+            done = format_bytes(reader.bytes_read)
+        self.logger.info(f'Imported {done}, {reader.statements} statements so far at ' +
+                         f'{format_bytes(reader.throughput)}/s.')
 
     def setup_all(self):
         """Stop the servers if needed, set up database+interserver settings and run SQL upgrades."""
@@ -536,14 +1360,19 @@ class Autolycus(object):
         self.setup_interserver()
         self.sql_upgrades()
 
+    @profiled
     def account(self, name, password=None, sex=None, gm=False, id=None):
         """Create or modify accounts on the server."""
+        from autolycus_accounts import hash_password
+
         account_spec = {
             'userid': name
         }
 
         if sex or hasattr(self.args, 'sex'):
-            account_spec['sex'] = sex or self.args.sex
+            from random import choice
+
+            account_spec['sex'] = sex or self.args.sex or choice(['M', 'F'])
 
         if gm or hasattr(self.args, 'gm'):
             account_spec['group_id'] = 99
@@ -552,10 +1381,7 @@ class Autolycus(object):
             account_spec['account_id'] = id
 
         if password:
-            if self.hercules_config.get('login-server.conf', 'use_MD5_passwords') == 'true':
-                account_spec['user_pass'] = md5(password)
-            else:
-                account_spec['user_pass'] = password
+            account_spec['user_pass'] = hash_password(password, self._use_md5_passwords)
 
         with self._database() as db:
             login_table = db['login']
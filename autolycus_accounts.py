@@ -0,0 +1,248 @@
+import csv
+from hashlib import md5
+import json
+import os
+from time import monotonic
+
+from sqlalchemy import bindparam, text
+
+# The columns of Hercules' login table that can be imported, and their types.
+ACCOUNT_COLUMNS = {'account_id': int, 'userid': str, 'user_pass': str, 'sex': str, 'email': str,
+                   'group_id': int, 'state': int, 'birthdate': str, 'character_slots': int}
+# Column names used by other tools that mean the same thing.
+COLUMN_ALIASES = {'username': 'userid', 'password': 'user_pass', 'id': 'account_id'}
+# The lengths the login-server and the login table accept.
+USERID_LENGTH = (4, 23)
+USER_PASS_LENGTH = 32
+EMAIL_LENGTH = 39
+# How often to log progress during an import, in seconds.
+PROGRESS_INTERVAL = 5
+
+
+class InvalidAccount(ValueError):
+    """An account in an import file can't be imported."""
+
+
+def hash_password(password, use_md5):
+    """Get the value to store in the login table for a password.
+
+    Args:
+        password (str): The plain text password.
+        use_md5 (bool): Whether the login-server is configured with use_MD5_passwords.
+    Returns:
+        str: The MD5 hex digest of the password, or the password itself if MD5 is not used.
+    """
+    return md5(password.encode('utf-8')).hexdigest() if use_md5 else password
+
+
+def read_accounts(file_name, file_format=None):
+    """Read accounts from a CSV file with a header row or a file of one JSON object per line.
+
+    Args:
+        file_name (str): The file to read.
+        file_format (str, optional): "csv" or "jsonl". Guessed from the file extension if
+            omitted.
+    Yields:
+        tuple: The line number and a dictionary of the fields of each account.
+    """
+    if file_format is None:
+        extension = os.path.splitext(file_name)[1].lower()
+        file_format = 'csv' if extension == '.csv' else 'jsonl'
+
+    with open(file_name, newline='', encoding='utf-8') as accounts:
+        if file_format == 'csv':
+            reader = csv.DictReader(accounts)
+            for row in reader:
+                yield reader.line_num, {key: value for key, value in row.items()
+                                        if key is not None and value != ''}
+        elif file_format == 'jsonl':
+            for line_number, line in enumerate(accounts, 1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError as exc:
+                    yield line_number, InvalidAccount(f'invalid JSON: {exc}')
+                    continue
+                if not isinstance(row, dict):
+                    yield line_number, InvalidAccount('not a JSON object')
+                    continue
+                yield line_number, {key: value for key, value in row.items() if value is not None}
+        else:
+            raise KeyError(f'Unknown account file format {file_format}!')
+
+
+def validate_account(row, use_md5, hashed=False):
+    """Check an account read from an import file and convert it to login table columns.
+
+    Args:
+        row (dict): The fields of the account.
+        use_md5 (bool): Whether passwords are stored as MD5 hashes.
+        hashed (bool, optional): Whether the passwords in the file are already hashed.
+    Raises:
+        InvalidAccount: A field is missing or has an invalid value.
+    Returns:
+        dict: The login table columns and values for the account.
+    """
+    account = {}
+    for key, value in row.items():
+        column = COLUMN_ALIASES.get(key, key)
+        if column not in ACCOUNT_COLUMNS:
+            continue
+        try:
+            account[column] = ACCOUNT_COLUMNS[column](value)
+        except (TypeError, ValueError):
+            raise InvalidAccount(f'{key} must be {ACCOUNT_COLUMNS[column].__name__}, ' +
+                                 f'not {value!r}')
+
+    userid = account.get('userid', '')
+    if not USERID_LENGTH[0] <= len(userid) <= USERID_LENGTH[1]:
+        raise InvalidAccount(f'user name {userid!r} must be {USERID_LENGTH[0]} to ' +
+                             f'{USERID_LENGTH[1]} characters long')
+    if 'sex' in account:
+        account['sex'] = account['sex'].upper()
+        if account['sex'] not in ['M', 'F', 'S']:
+            raise InvalidAccount(f'sex must be M, F or S, not {account["sex"]!r}')
+    if 'user_pass' in account:
+        if not hashed:
+            account['user_pass'] = hash_password(account['user_pass'], use_md5)
+        if len(account['user_pass']) > USER_PASS_LENGTH:
+            raise InvalidAccount(f'password must be at most {USER_PASS_LENGTH} characters long')
+    if len(account.get('email', '')) > EMAIL_LENGTH:
+        raise InvalidAccount(f'email must be at most {EMAIL_LENGTH} characters long')
+    return account
+
+
+class AccountImporter(object):
+    """Create or update accounts in the login table in bulk.
+
+    Accounts are collected into batches. For each batch, a single query looks up which of the
+    user names already exist, and then the batch is written with one multi-row
+    INSERT ... ON DUPLICATE KEY UPDATE per set of columns, in a single transaction. Existing
+    accounts only have the columns given in the file updated. Accounts given with an account_id
+    are written as they are and counted as updated.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): The database to import into.
+        logger (logging.Logger): Where to log progress and invalid accounts.
+        use_md5 (bool, optional): Whether passwords are stored as MD5 hashes.
+        hashed (bool, optional): Whether the passwords in the file are already hashed.
+        batch_size (int, optional): How many accounts to write per transaction.
+    """
+
+    def __init__(self, engine, logger, use_md5=False, hashed=False, batch_size=1000):
+        self.engine = engine
+        self.logger = logger
+        self.use_md5 = use_md5
+        self.hashed = hashed
+        self.batch_size = max(1, batch_size)
+
+        self.created = 0
+        self.updated = 0
+        self.invalid = 0
+        self.errors = 0
+        self.elapsed = 0
+
+    @property
+    def rows(self):
+        return self.created + self.updated
+
+    @property
+    def throughput(self):
+        """How many accounts were written per second."""
+        return self.rows / self.elapsed if self.elapsed > 0 else 0
+
+    def run(self, rows):
+        """Import accounts.
+
+        Args:
+            rows (iterable): The line numbers and fields of the accounts, e.g. from
+                read_accounts(). Rows may be exceptions to report them as invalid.
+        """
+        started = monotonic()
+        last_progress = started
+        # lowercased user name -> (line number, account); MySQL compares user names
+        # case-insensitively. A later row for the same name in the same batch is applied on top
+        # of the earlier one, as if they had been written one after the other.
+        batch = {}
+        for line_number, row in rows:
+            try:
+                if isinstance(row, Exception):
+                    raise row
+                account = validate_account(row, self.use_md5, self.hashed)
+            except InvalidAccount as exc:
+                self.logger.warning(f'Skipping account on line {line_number}: {exc}')
+                self.invalid += 1
+                continue
+            key = account['userid'].lower()
+            if key in batch:
+                account = dict(batch[key][1], **account)
+            batch[key] = (line_number, account)
+
+            if len(batch) >= self.batch_size:
+                self._write(batch)
+                batch = {}
+                self.elapsed = monotonic() - started
+                if monotonic() - last_progress >= PROGRESS_INTERVAL:
+                    last_progress = monotonic()
+                    self.logger.info(f'Imported {self.rows} accounts so far at ' +
+                                     f'{self.throughput:.0f} accounts/s.')
+        if batch:
+            self._write(batch)
+        self.elapsed = monotonic() - started
+
+    def _upsert(self, connection, columns):
+        """Build the statement inserting or updating accounts with the given columns."""
+        names = ', '.join(columns)
+        values = ', '.join(f':{column}' for column in columns)
+        updated = [column for column in columns if column != 'account_id']
+        if connection.dialect.name == 'mysql':
+            update = ', '.join(f'{column} = VALUES({column})' for column in updated)
+            return text(f'INSERT INTO login ({names}) VALUES ({values}) ' +
+                        f'ON DUPLICATE KEY UPDATE {update}')
+        # SQLite and PostgreSQL
+        update = ', '.join(f'{column} = excluded.{column}' for column in updated)
+        return text(f'INSERT INTO login ({names}) VALUES ({values}) ' +
+                    f'ON CONFLICT (account_id) DO UPDATE SET {update}')
+
+    def _write(self, batch):
+        """Write a batch of accounts in one transaction."""
+        try:
+            with self.engine.begin() as connection:
+                names = [account['userid'] for _, account in batch.values()
+                         if 'account_id' not in account]
+                existing = {}
+                if names:
+                    lookup = text('SELECT userid, account_id FROM login WHERE userid IN :names')
+                    result = connection.execute(
+                        lookup.bindparams(bindparam('names', expanding=True)), {'names': names})
+                    existing = {row.userid.lower(): row.account_id for row in result}
+
+                # Accounts with the same columns go into the same multi-row INSERT.
+                groups = {}
+                created = updated = 0
+                for name, (line_number, account) in batch.items():
+                    if 'account_id' not in account:
+                        account['account_id'] = existing.get(name)
+                    if account['account_id'] is not None:
+                        updated += 1
+                    elif 'user_pass' in account:
+                        created += 1
+                    else:
+                        self.logger.warning(f'Skipping account on line {line_number}: ' +
+                                            f'{account["userid"]} does not exist so a ' +
+                                            'password is required.')
+                        self.invalid += 1
+                        continue
+                    groups.setdefault(tuple(sorted(account)), []).append(account)
+
+                for columns, accounts in groups.items():
+                    # The driver sends these as a single multi-row INSERT on MySQL.
+                    connection.execute(self._upsert(connection, columns), accounts)
+            self.created += created
+            self.updated += updated
+        except Exception as exc:
+            self.logger.error(f'Failed to import {len(batch)} accounts from lines ' +
+                              f'{min(line for line, _ in batch.values())} to ' +
+                              f'{max(line for line, _ in batch.values())}: {exc}')
+            self.errors += len(batch)
@@ -1,13 +1,95 @@
+from contextlib import contextmanager
 import json
 import logging
 import os
 
+from autolycus_files import atomic_write
+
+try:
+    import fcntl
+except ImportError:
+    # Windows; without advisory locks, writes are still atomic but may lose concurrent changes.
+    fcntl = None
+
+
+class ConfigFile(object):
+    """A JSON configuration file shared with other Autolycus processes.
+
+    The file is only read again when it was replaced or its modification time or size
+    changed. Changes are written while holding an exclusive lock on a .lock file next to it:
+    the file is read again under the lock, the changed keys are applied on top and the result
+    is written to a temporary file and renamed over the original, so changes made by another
+    process in the meantime are kept and readers never see a partially written file.
+
+    Args:
+        file_name (str): The path of the JSON file.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.lock_file = f'{file_name}.lock'
+        self.logger = logging.getLogger('autolycus')
+
+        # ((inode, mtime, size), contents) of the file as last read or written
+        self._cached = None
+        # key -> value set but not yet written
+        self.pending = {}
+
+    def _read(self):
+        """Get the contents of the file, re-reading it only if it changed."""
+        try:
+            stat = os.stat(self.file_name)
+        except OSError:
+            if self._cached is None:
+                self.logger.warning(f'Config file {self.file_name} does not exist.')
+            self._cached = (None, {})
+            return self._cached[1]
+
+        file_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if self._cached is None or self._cached[0] != file_key:
+            with open(self.file_name) as config:
+                # The file may have been replaced since the stat; key on what is actually read.
+                stat = os.fstat(config.fileno())
+                self._cached = ((stat.st_ino, stat.st_mtime_ns, stat.st_size),
+                                json.load(config))
+        return self._cached[1]
+
+    def get(self, key):
+        if key in self.pending:
+            return self.pending[key]
+        return self._read().get(key, None)
+
+    @contextmanager
+    def _locked(self):
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_file, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def write(self):
+        """Write the pending changes to the file, merged with its current contents."""
+        if not self.pending:
+            return
+        with self._locked():
+            contents = dict(self._read())
+            contents.update(self.pending)
+            self.logger.debug(f'Writing {len(self.pending)} changes to {self.file_name}.')
+            atomic_write(self.file_name, json.dumps(contents))
+            stat = os.stat(self.file_name)
+            self._cached = ((stat.st_ino, stat.st_mtime_ns, stat.st_size), contents)
+        self.pending = {}
+
 
 class AutolycusConfig(object):
     """Read and store Autolycus configuration options."""
 
     def __init__(self, hercules_path):
-        """Read configuration from files.
+        """Set up the configuration files; they are read on first use.
 
         Args:
             hercules_path (str): The path to the Hercules installation to configure.
@@ -17,40 +99,50 @@ class AutolycusConfig(object):
                                                'autolycus_config.json')
         self.installation_config_file = os.path.join(os.path.abspath(hercules_path),
                                                      'conf', 'autolycus_config.json')
-        self._global_config = None
-        self._installation_config = None
+        self._files = {'global': ConfigFile(self.global_config_file),
+                       'installation': ConfigFile(self.installation_config_file)}
+        self._transaction_depth = 0
         self.logger = logging.getLogger('autolycus')
 
-        self._read_config()
+    @contextmanager
+    def transaction(self):
+        """Group several configuration changes so each file is written at most once.
 
-    def _write_config(self, config_file, config_dict):
-        with open(config_file, 'w') as config:
-            config.write(json.dumps(config_dict))
+        Values set inside the transaction are visible straight away but only written to disk
+        when the outermost transaction ends. If an exception is raised, they are discarded.
 
-    def _read_config(self):
-        """Read global and installation config from files."""
-        try:
-            if self._global_config is None:
-                self._global_config = {}
-            with open(self.global_config_file) as global_file:
-                self._global_config.update(json.loads(global_file.read()))
-        except IOError:
-            self.logger.warn(f'Global config file {self.global_config_file} does not exist.')
-            self._global_config = {}
+        Example:
+            with autolycus_config.transaction():
+                autolycus_config.installation_config('log_backups', '10')
+                autolycus_config.installation_config('log_compress', 'true')
+        """
+        self._transaction_depth += 1
         try:
-            if self._installation_config is None:
-                self._installation_config = {}
-            with open(self.installation_config_file) as install_file:
-                self._installation_config.update(
-                    json.loads(install_file.read()))
-        except IOError:
-            self.logger.warn(f'Install config file {self.installation_config_file} does not exist.')
-            self._installation_config = {}
+            yield self
+        except BaseException:
+            if self._transaction_depth == 1:
+                for config_file in self._files.values():
+                    config_file.pending = {}
+            raise
+        else:
+            if self._transaction_depth == 1:
+                for config_file in self._files.values():
+                    config_file.write()
+        finally:
+            self._transaction_depth -= 1
+
+    def _config(self, name, key, value):
+        config_file = self._files[name]
+        if value is not None:
+            with self.transaction():
+                config_file.pending[key] = value
+        return config_file.get(key)
 
     def global_config(self, key, value=None):
         """Read or write a value from the global Autolycus configuration.
 
-        Will automatically update the configuration file on disk when setting a value.
+        Will automatically update the configuration file on disk when setting a value, unless
+        a transaction() is open.
 
         Args:
             key (str): The key of the configuration option to get or set.
@@ -59,17 +151,13 @@ class AutolycusConfig(object):
         Returns:
             str: The value of the configuration option given.
         """
-        if self._global_config is None:
-            self._read_config()
-        if value is not None:
-            self._global_config[key] = value
-            self._write_config(self.global_config_file, self._global_config)
-        return self._global_config.get(key, None)
+        return self._config('global', key, value)
 
     def installation_config(self, key, value=None):
         """Read or write a value from the installation configuration.
 
-        Will automatically update the configuration file on disk when setting a value.
+        Will automatically update the configuration file on disk when setting a value, unless
+        a transaction() is open.
 
         Args:
             key (str): The key of the configuration option to get or set.
@@ -78,9 +166,4 @@ class AutolycusConfig(object):
         Returns:
             str: The value of the configuration option given.
         """
-        if self._installation_config is None:
-            self._read_config()
-        if value is not None:
-            self._installation_config[key] = value
-            self._write_config(self.installation_config_file, self._installation_config)
-        return self._installation_config.get(key, None)
+        return self._config('installation', key, value)
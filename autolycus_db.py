@@ -0,0 +1,135 @@
+import atexit
+import logging
+from random import uniform
+import socket
+import threading
+from time import monotonic, sleep
+
+import dataset
+
+# How many connections each database engine keeps open, and how many more it may open at busy
+# times. Enough for parallel imports without exhausting the server's connection limit.
+POOL_SIZE = 5
+MAX_OVERFLOW = 10
+# Reconnect before MySQL's default wait_timeout can drop connections that have been idle.
+POOL_RECYCLE = 3600
+# How long a single connection attempt may take before it counts as failed, in seconds.
+CONNECT_TIMEOUT = 5
+# The first and the longest pause between readiness checks, in seconds.
+BACKOFF_INITIAL = 0.05
+BACKOFF_MAX = 2.0
+
+_databases = {}
+_lock = threading.Lock()
+logger = logging.getLogger('autolycus')
+
+
+def get_database(url):
+    """Get the shared database object for a URL, connecting on first use.
+
+    Every caller asking for the same URL gets the same dataset.Database, so they share one
+    engine and its connection pool for the lifetime of the process. Pooled connections are
+    checked with a lightweight ping before use, so connections dropped by the server are
+    replaced transparently.
+
+    Args:
+        url (str): The SQLAlchemy URL of the database.
+
+    Returns:
+        dataset.Database: The database object.
+    """
+    with _lock:
+        database = _databases.get(url)
+        if database is None:
+            engine_kwargs = {'pool_pre_ping': True, 'pool_recycle': POOL_RECYCLE}
+            if not url.startswith('sqlite'):
+                engine_kwargs.update(pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW)
+            if url.startswith('mysql'):
+                engine_kwargs['connect_args'] = {'connect_timeout': CONNECT_TIMEOUT}
+            database = dataset.connect(url, engine_kwargs=engine_kwargs)
+            _databases[url] = database
+        return database
+
+
+def check_database(database, timeout=CONNECT_TIMEOUT):
+    """Check whether a database is accepting queries.
+
+    This first checks that the server's port accepts TCP connections, which fails fast while
+    the server is still starting, and then runs SELECT 1 on a pooled connection.
+
+    Args:
+        database (dataset.Database): The database to check.
+        timeout (float, optional): How long the TCP connection attempt may take in seconds.
+
+    Returns:
+        dict: 'ok' (bool) whether the database is available, 'url' (str) its URL, 'reason'
+            (str) why it is unavailable if it isn't and 'latency' (float) how long the check
+            took in seconds.
+    """
+    start = monotonic()
+    url = database.engine.url
+    try:
+        if url.host:
+            socket.create_connection((url.host, url.port or 3306), timeout=timeout).close()
+        with database.engine.connect() as connection:
+            connection.exec_driver_sql('SELECT 1')
+    except Exception as exc:
+        return {'ok': False, 'url': database.url, 'reason': str(exc).replace('\n', ' '),
+                'latency': monotonic() - start}
+    return {'ok': True, 'url': database.url, 'reason': None, 'latency': monotonic() - start}
+
+
+def wait_for_database(database, timeout=120):
+    """Wait until a database is accepting queries.
+
+    Checks are retried with exponential backoff and jitter, starting at BACKOFF_INITIAL
+    seconds apart and backing off to at most BACKOFF_MAX, until the deadline passes.
+
+    Args:
+        database (dataset.Database): The database to wait for.
+        timeout (float, optional): How long to wait in seconds.
+
+    Raises:
+        IOError: The database did not become available before the deadline.
+
+    Returns:
+        float: How long it took for the database to become available, in seconds.
+    """
+    start = monotonic()
+    deadline = start + timeout
+    delay = BACKOFF_INITIAL
+    attempts = 0
+    while True:
+        attempts += 1
+        status = check_database(database, timeout=max(0.1, min(CONNECT_TIMEOUT,
+                                                                deadline - monotonic())))
+        if status['ok']:
+            elapsed = monotonic() - start
+            logger.info(f'Database became available after {elapsed:.2f}s ({attempts} checks).')
+            return elapsed
+
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            raise IOError('Database {url} did not become available in time! '
+                          'Reason: {reason}'.format(**status))
+        logger.debug(f'Database unavailable ({status["reason"]}), checking again.')
+        sleep(min(remaining, delay / 2 + uniform(0, delay / 2)))
+        delay = min(delay * 2, BACKOFF_MAX)
+
+
+def dispose(url=None):
+    """Close the pooled connections for one or all databases.
+
+    Args:
+        url (str, optional): The URL of the database to close. Closes all of them if omitted.
+    """
+    with _lock:
+        urls = [url] if url is not None else list(_databases)
+        for database_url in urls:
+            database = _databases.pop(database_url, None)
+            if database is not None:
+                logger.debug(f'Closing connections to {database.engine.url!r}.')
+                database.close()
+
+
+atexit.register(dispose)
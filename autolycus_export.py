@@ -0,0 +1,288 @@
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import decimal
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+from time import monotonic
+
+from sqlalchemy import inspect, text
+
+# How many rows to fetch per keyset query.
+DEFAULT_CHUNK_SIZE = 10000
+# How many rows to write per INSERT, and the most characters per INSERT. Keep the latter below
+# the server's max_allowed_packet; it matches SQLImporter's max_statement_size.
+DEFAULT_ROWS_PER_INSERT = 1000
+MAX_STATEMENT_SIZE = 1024 * 1024
+# gzip's default of 9 costs several times the CPU of 6 for a few percent smaller dumps.
+DEFAULT_COMPRESS_LEVEL = 6
+
+# The characters MySQL needs escaped inside a string literal with its default sql_mode.
+MYSQL_ESCAPES = str.maketrans({'\\': '\\\\', "'": "\\'", '\0': '\\0', '\n': '\\n',
+                               '\r': '\\r', '\x1a': '\\Z'})
+STANDARD_ESCAPES = str.maketrans({"'": "''"})
+
+
+def _format_timedelta(value):
+    """Format a timedelta the way MySQL writes TIME values, e.g. -1:02:03.500000."""
+    sign = '-' if value < datetime.timedelta(0) else ''
+    seconds, microseconds = divmod(abs(value) // datetime.timedelta(microseconds=1), 1000000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    fraction = f'.{microseconds:06d}' if microseconds else ''
+    return f"'{sign}{hours}:{minutes:02d}:{seconds:02d}{fraction}'"
+
+
+def sql_literal(value, escapes=MYSQL_ESCAPES):
+    """Write a value returned by the database driver as an SQL literal.
+
+    Args:
+        value: The value.
+        escapes (dict, optional): The str.translate table for string literals, MYSQL_ESCAPES or
+            STANDARD_ESCAPES for databases that don't treat backslashes specially.
+    Returns:
+        str: The literal.
+    """
+    if value is None:
+        return 'NULL'
+    elif isinstance(value, bool):
+        return '1' if value else '0'
+    elif isinstance(value, (int, float, decimal.Decimal)):
+        return repr(value) if isinstance(value, float) else str(value)
+    elif isinstance(value, str):
+        return "'" + value.translate(escapes) + "'"
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        return f"X'{bytes(value).hex()}'"
+    elif isinstance(value, datetime.datetime):
+        return f"'{value.isoformat(sep=' ')}'"
+    elif isinstance(value, (datetime.date, datetime.time)):
+        return f"'{value.isoformat()}'"
+    elif isinstance(value, datetime.timedelta):
+        return _format_timedelta(value)
+    return "'" + str(value).translate(escapes) + "'"
+
+
+class SQLExporter(object):
+    """Write the tables of a database to an SQL dump that import_sql can read back.
+
+    The dump starts with a DROP TABLE and CREATE TABLE for every table, followed by the rows of
+    each table as multi-row INSERTs. Rows are read in chunks ordered by primary key, each chunk
+    continuing after the last key of the one before (WHERE pk > last key ORDER BY pk LIMIT n),
+    so every query is a short index range scan however large the table, and with a server-side
+    cursor, so the driver doesn't buffer even a whole chunk. Tables without a primary key are
+    read with a single streamed query. Memory use depends on the chunk size, not on the size of
+    the tables.
+
+    If the file name ends with .gz, the dump is compressed with gzip, each section as a separate
+    gzip member; gzip readers treat concatenated members as one stream. With several jobs,
+    tables are read concurrently on separate connections into temporary files next to the
+    output, which are appended to the dump in order as they finish. The dump is written to a
+    temporary name and only renamed into place once complete.
+
+    Each table is read in one REPEATABLE READ transaction, so it is consistent in itself, but
+    different tables are read at different times; stop the servers first for a consistent dump.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): The database to export.
+        logger (logging.Logger): Where to log progress.
+        tables (list, optional): The tables to export. All tables if omitted.
+        chunk_size (int, optional): How many rows to fetch per query.
+        rows_per_insert (int, optional): How many rows to write per INSERT.
+        jobs (int, optional): How many tables to read concurrently.
+        compress_level (int, optional): The gzip compression level, from 1 (fastest) to 9.
+    """
+
+    def __init__(self, engine, logger, tables=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 rows_per_insert=DEFAULT_ROWS_PER_INSERT, jobs=1,
+                 compress_level=DEFAULT_COMPRESS_LEVEL):
+        self.engine = engine
+        self.logger = logger
+        self.tables = tables
+        self.chunk_size = max(1, chunk_size)
+        self.rows_per_insert = max(1, rows_per_insert)
+        self.jobs = max(1, jobs)
+        self.compress_level = compress_level
+
+        self.mysql = engine.dialect.name == 'mysql'
+        self.escapes = MYSQL_ESCAPES if self.mysql else STANDARD_ESCAPES
+        self.quote = engine.dialect.identifier_preparer.quote_identifier
+
+        self.rows = 0
+        self.bytes_written = 0
+        self.elapsed = 0
+        self.compress = False
+        self._lock = threading.Lock()
+
+    @property
+    def throughput(self):
+        """How many rows were exported per second."""
+        return self.rows / self.elapsed if self.elapsed > 0 else 0
+
+    def run(self, file_name):
+        """Export the tables to a file.
+
+        Args:
+            file_name (str): The file to write. Compressed with gzip if it ends with .gz.
+        Raises:
+            KeyError: One of the tables doesn't exist.
+        """
+        started = monotonic()
+        self.compress = file_name.endswith('.gz')
+        existing = inspect(self.engine).get_table_names()
+        tables = self.tables or existing
+        for table in tables:
+            if table not in existing:
+                raise KeyError(f'Table {table} does not exist!')
+
+        directory = os.path.dirname(os.path.abspath(file_name))
+        partial = f'{file_name}.partial'
+        try:
+            with open(partial, 'wb') as dump:
+                with self._section(dump) as out:
+                    self._write_header(out, tables)
+                if self.jobs == 1:
+                    for table in tables:
+                        self._dump_table(table, dump)
+                else:
+                    self._dump_concurrently(tables, dump, directory)
+                with self._section(dump) as out:
+                    if self.mysql:
+                        out.write(b'SET FOREIGN_KEY_CHECKS=1;\n')
+                self.bytes_written = dump.tell()
+            os.replace(partial, file_name)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(partial)
+            raise
+        self.elapsed = monotonic() - started
+
+    @contextlib.contextmanager
+    def _section(self, dump):
+        """Write a section of the dump, as its own gzip member if compressing."""
+        if self.compress:
+            with gzip.GzipFile(fileobj=dump, mode='wb', compresslevel=self.compress_level,
+                               mtime=0) as out:
+                yield out
+        else:
+            yield dump
+
+    def _write_header(self, out, tables):
+        now = datetime.datetime.now().isoformat(sep=' ', timespec='seconds')
+        out.write(f'-- Autolycus SQL export of {len(tables)} tables at {now}\n\n'.encode())
+        if self.mysql:
+            out.write(b'SET FOREIGN_KEY_CHECKS=0;\n\n')
+        with self.engine.connect() as connection:
+            for table in tables:
+                out.write(f'DROP TABLE IF EXISTS {self.quote(table)};\n'
+                          f'{self._create_statement(connection, table)};\n\n'.encode())
+
+    def _create_statement(self, connection, table):
+        if self.mysql:
+            return connection.exec_driver_sql(f'SHOW CREATE TABLE {self.quote(table)}').one()[1]
+        # Let SQLAlchemy reflect the table and write the DDL for this dialect.
+        from sqlalchemy import MetaData, Table
+        from sqlalchemy.schema import CreateTable
+
+        reflected = Table(table, MetaData(), autoload_with=connection)
+        return str(CreateTable(reflected).compile(connection)).strip()
+
+    def _dump_concurrently(self, tables, dump, directory):
+        def dump_to_temporary_file(table):
+            temporary = tempfile.TemporaryFile(dir=directory, prefix='.autolycus-export-')
+            try:
+                self._dump_table(table, temporary)
+                temporary.seek(0)
+            except BaseException:
+                temporary.close()
+                raise
+            return temporary
+
+        with ThreadPoolExecutor(self.jobs, thread_name_prefix='export') as executor:
+            futures = [executor.submit(dump_to_temporary_file, table) for table in tables]
+            try:
+                for future in futures:
+                    with future.result() as temporary:
+                        shutil.copyfileobj(temporary, dump, 1024 * 1024)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def _dump_table(self, table, dump):
+        """Write the rows of a table to a file as one section of the dump."""
+        started = monotonic()
+        rows = 0
+        with self._section(dump) as out, self.engine.connect() as connection:
+            if self.mysql:
+                connection = connection.execution_options(isolation_level='REPEATABLE READ')
+            with connection.begin():
+                primary_key = inspect(connection).get_pk_constraint(table)['constrained_columns']
+                statement = _InsertWriter(self, table, out)
+                for row in self._read_rows(connection, table, primary_key):
+                    statement.add(row)
+                    rows += 1
+                statement.flush()
+        elapsed = monotonic() - started
+        with self._lock:
+            self.rows += rows
+        self.logger.info(f'Exported {rows} rows from {table} in {elapsed:.1f}s.')
+
+    def _read_rows(self, connection, table, primary_key):
+        """Read all rows of a table in primary key order, one chunk at a time."""
+        streaming = connection.execution_options(stream_results=True, yield_per=self.chunk_size)
+        quoted = self.quote(table)
+        if not primary_key:
+            yield from streaming.execute(text(f'SELECT * FROM {quoted}'))
+            return
+
+        columns = ', '.join(self.quote(column) for column in primary_key)
+        keys = ', '.join(f':key{index}' for index in range(len(primary_key)))
+        order = f'ORDER BY {columns} LIMIT {self.chunk_size}'
+        first = text(f'SELECT * FROM {quoted} {order}')
+        after = text(f'SELECT * FROM {quoted} WHERE ({columns}) > ({keys}) {order}')
+
+        result = streaming.execute(first)
+        positions = [list(result.keys()).index(column) for column in primary_key]
+        while True:
+            count = 0
+            row = None
+            for row in result:
+                count += 1
+                yield row
+            if count < self.chunk_size:
+                return
+            result = streaming.execute(after, {f'key{index}': row[position]
+                                               for index, position in enumerate(positions)})
+
+
+class _InsertWriter(object):
+    """Collect the rows of a table into multi-row INSERTs and write them out."""
+
+    def __init__(self, exporter, table, out):
+        self.exporter = exporter
+        self.table = table
+        self.out = out
+        self.prefix = None
+        self.rows = []
+        self.size = 0
+
+    def add(self, row):
+        if self.prefix is None:
+            columns = ', '.join(self.exporter.quote(column) for column in row._fields)
+            self.prefix = f'INSERT INTO {self.exporter.quote(self.table)} ({columns}) VALUES\n'
+        escapes = self.exporter.escapes
+        values = '(' + ','.join(sql_literal(value, escapes) for value in row) + ')'
+        if self.rows and (len(self.rows) >= self.exporter.rows_per_insert or
+                          self.size + len(values) > MAX_STATEMENT_SIZE):
+            self.flush()
+        self.rows.append(values)
+        self.size += len(values) + 2 if self.size else len(self.prefix) + len(values)
+
+    def flush(self):
+        if self.rows:
+            self.out.write((self.prefix + ',\n'.join(self.rows) + ';\n').encode('utf-8'))
+            self.rows = []
+            self.size = 0
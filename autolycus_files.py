@@ -0,0 +1,37 @@
+import os
+import tempfile
+
+
+def atomic_write(file_name, data):
+    """Replace a file's contents so readers only ever see the old or the new version.
+
+    The data is written to a temporary file in the same directory, flushed to disk and then
+    renamed over the original file. The original file's permissions are kept.
+
+    Args:
+        file_name (str): The path of the file to write.
+        data (str): The new contents of the file.
+    """
+    directory = os.path.dirname(os.path.abspath(file_name))
+    fd, temp_name = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(file_name)}.',
+                                     suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', newline='') as temp_file:
+            temp_file.write(data)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        if os.path.exists(file_name):
+            os.chmod(temp_name, os.stat(file_name).st_mode & 0o7777)
+        os.replace(temp_name, file_name)
+    except BaseException:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+
+    # Make sure the rename itself survives a crash. Directories can't be opened on Windows.
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
@@ -1,42 +1,162 @@
+import atexit
 import logging
+import queue
+import threading
+
+# Attributes that may be attached to log records with extra={...}, and are written as fields of
+# their own by the JSON formatter.
+STRUCTURED_FIELDS = ['installation', 'server', 'pid', 'operation', 'duration']
+
 
 class AutolycusFormatter(logging.Formatter):
+    """Format log records with a prefix for their level, and their installation if they have one.
+
+    There is one formatter per level, built once, so formatting doesn't change any shared state
+    and is safe from any number of threads.
+    """
 
-    err_fmt  = '[ERROR] %(asctime)s: %(msg)s'
-    dbg_fmt  = '[DEBUG] %(asctime)s: %(msg)s'
-    info_fmt = '%(asctime)s: %(msg)s'
-    warning_fmt = '[WARN] %(asctime)s: %(msg)s'
-    critical_fmt = '[CRIT] %(asctime)s: %(msg)s'
+    err_fmt = '[ERROR] %(asctime)s: %(installation_prefix)s%(message)s'
+    dbg_fmt = '[DEBUG] %(asctime)s: %(installation_prefix)s%(message)s'
+    info_fmt = '%(asctime)s: %(installation_prefix)s%(message)s'
+    warning_fmt = '[WARN] %(asctime)s: %(installation_prefix)s%(message)s'
+    critical_fmt = '[CRIT] %(asctime)s: %(installation_prefix)s%(message)s'
 
     def __init__(self):
-        super().__init__(fmt='%(levelno)d: %(msg)s', datefmt=None, style='%')  
+        super().__init__(fmt='%(levelno)d: %(message)s', datefmt=None, style='%')
+        self._formatters = {level: logging.Formatter(fmt)
+                            for level, fmt in [(logging.DEBUG, self.dbg_fmt),
+                                               (logging.INFO, self.info_fmt),
+                                               (logging.WARNING, self.warning_fmt),
+                                               (logging.ERROR, self.err_fmt),
+                                               (logging.CRITICAL, self.critical_fmt)]}
+
+    def format(self, record):
+        installation = getattr(record, 'installation', None)
+        record.installation_prefix = f'[{installation}] ' if installation is not None else ''
+        formatter = self._formatters.get(record.levelno)
+        if formatter is None:
+            return super().format(record)
+        return formatter.format(record)
+
+
+class JSONFormatter(logging.Formatter):
+    """Format log records as one JSON object per line, for log collectors.
+
+    Every object has the time, level and message, and any of STRUCTURED_FIELDS that were given
+    with extra={...} when logging, e.g. {"server": "map-server", "pid": 1234}.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # Only imported when JSON logging is asked for, to keep start-up quick.
+        import json
+        self._dumps = json.dumps
+
+    def formatTime(self, record, datefmt=None):
+        return super().formatTime(record, '%Y-%m-%dT%H:%M:%S') + f'.{record.msecs:03.0f}'
 
     def format(self, record):
+        entry = {'time': self.formatTime(record),
+                 'level': record.levelname,
+                 'message': record.getMessage()}
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return self._dumps(entry, default=str)
+
+
+class QueueHandler(logging.Handler):
+    """Put log records on a queue for a LogWriter to format and write.
+
+    Like logging.handlers.QueueHandler, the message is merged with its arguments and any
+    traceback is formatted before the record is queued, as both may have changed by the time
+    the writer gets to it; the rest of the formatting is left to the writer. Importing
+    logging.handlers would pull in socket and pickle, which quick commands can't afford.
+    """
+
+    def __init__(self, records):
+        super().__init__()
+        self.records = records
+        self._exception_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        """Get a copy of the record that no longer refers to the caller's mutable objects."""
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self._exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.records.put(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+
+class LogWriter(object):
+    """Format and write queued log records in a background thread.
+
+    Args:
+        records (queue.SimpleQueue): The queue a QueueHandler puts records on.
+        handler (logging.Handler): The handler to pass the records to.
+    """
+
+    def __init__(self, records, handler):
+        self.records = records
+        self.handler = handler
+        self._thread = None
 
-        # Save the original format configured by the user
-        # when the logger formatter was instantiated
-        format_orig = self._style._fmt
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
 
-        # Replace the original format with one customized by logging level
-        if record.levelno == logging.DEBUG:
-            self._style._fmt = AutolycusFormatter.dbg_fmt
+    def stop(self):
+        """Write the records queued so far and stop the thread."""
+        if self._thread is not None:
+            self.records.put(None)
+            self._thread.join()
+            self._thread = None
 
-        elif record.levelno == logging.INFO:
-            self._style._fmt = AutolycusFormatter.info_fmt
+    def _run(self):
+        while True:
+            record = self.records.get()
+            if record is None:
+                break
+            self.handler.handle(record)
 
-        elif record.levelno == logging.ERROR:
-            self._style._fmt = AutolycusFormatter.err_fmt
 
-        elif record.levelno == logging.WARNING:
-            self._style._fmt = AutolycusFormatter.warning_fmt
+def setup_logging(logger, stream, level=logging.INFO, json_format=False):
+    """Send a logger's records to a stream from a background thread.
 
-        elif record.levelno == logging.CRITICAL:
-            self._style._fmt = AutolycusFormatter.critical_fmt
+    The logger only gets a QueueHandler, so logging from the supervisor, web or import threads
+    just puts the record on a queue. A LogWriter thread formats the records and writes them in
+    order. It is stopped at exit, after writing whatever is still queued.
 
-        # Call the original formatter class to do the grunt work
-        result = logging.Formatter.format(self, record)
+    Args:
+        logger (logging.Logger): The logger to set up.
+        stream (file): Where to write the log.
+        level (int, optional): The lowest level to log.
+        json_format (bool, optional): Write JSON lines instead of text, see JSONFormatter.
+    Returns:
+        LogWriter: The running writer.
+    """
+    output = logging.StreamHandler(stream)
+    output.setFormatter(JSONFormatter() if json_format else AutolycusFormatter())
 
-        # Restore the original format configured by the user
-        self._style._fmt = format_orig
+    records = queue.SimpleQueue()
+    logger.setLevel(level)
+    logger.addHandler(QueueHandler(records))
 
-        return result
\ No newline at end of file
+    writer = LogWriter(records, output)
+    writer.start()
+    atexit.register(writer.stop)
+    return writer
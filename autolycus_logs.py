@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""Capture the console output of a server into rotated log files and read it back.
+
+Run as a script, this reads a server's output from stdin until the server exits and writes it
+to a log file, e.g.:
+
+    map-server | autolycus_logs.py log/console/map-server.log --max_bytes 10485760 --compress
+
+Autolycus starts one of these for every server it runs, in its own session, so output keeps
+being captured after Autolycus exits and the server never blocks on a terminal.
+"""
+
+import argparse
+from bisect import bisect_right
+import datetime
+import gzip
+import os
+import re
+import selectors
+import shutil
+import struct
+import sys
+import threading
+from time import time
+
+# Where server output is logged, relative to the Hercules directory.
+LOG_DIR = os.path.join('log', 'console')
+MAX_BYTES = 10 * 1024 * 1024
+BACKUPS = 5
+# How often to write buffered output to disk, in seconds.
+FLUSH_INTERVAL = 1
+# Lines longer than this are split, so a server that never prints a newline can't use up memory.
+MAX_LINE = 64 * 1024
+# An index entry is added for the first line after this many bytes or seconds since the last one.
+INDEX_BYTES = 64 * 1024
+INDEX_SECONDS = 1
+# Index entries are the timestamp and uncompressed offset of a line.
+INDEX_ENTRY = struct.Struct('<dQ')
+
+SINCE_RE = re.compile(r'^(\d+(?:\.\d+)?)\s*([smhd])$')
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def format_timestamp(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).isoformat(sep=' ', timespec='milliseconds')
+
+
+def parse_timestamp(line):
+    """Get the timestamp a log line starts with, or None if it doesn't start with one."""
+    try:
+        return datetime.datetime.fromisoformat(line[:23].decode()).timestamp()
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def parse_since(since):
+    """Parse a point in time given as a duration before now ("90s", "10m", "2h", "1d") or as a
+    date and time ("2020-05-01 12:00").
+
+    Returns:
+        float: The point in time as a Unix timestamp.
+    """
+    match = SINCE_RE.match(since.strip())
+    if match:
+        return time() - float(match.group(1)) * UNITS[match.group(2)]
+    try:
+        return datetime.datetime.fromisoformat(since.strip()).timestamp()
+    except ValueError:
+        raise ValueError(f'Could not understand "{since}"; use e.g. "10m", "2h" or ' +
+                         '"2020-05-01 12:00".')
+
+
+def rotated_files(path, backups=BACKUPS):
+    """Get the log file and its rotated predecessors that exist, oldest first."""
+    files = []
+    for number in range(backups, 0, -1):
+        for candidate in [f'{path}.{number}.gz', f'{path}.{number}']:
+            if os.path.exists(candidate):
+                files.append(candidate)
+                break
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def index_path(log_file):
+    """Get the path of the index for a log file; compressed files share their index."""
+    return (log_file[:-3] if log_file.endswith('.gz') else log_file) + '.idx'
+
+
+def read_index(log_file):
+    """Read the index of a log file.
+
+    Returns:
+        tuple: Lists of the timestamps and the offsets of the indexed lines.
+    """
+    try:
+        with open(index_path(log_file), 'rb') as index:
+            data = index.read()
+    except IOError:
+        return [], []
+    # Ignore a partially written last entry.
+    data = data[:len(data) - len(data) % INDEX_ENTRY.size]
+    entries = list(INDEX_ENTRY.iter_unpack(data))
+    return [entry[0] for entry in entries], [entry[1] for entry in entries]
+
+
+class RotatingLog(object):
+    """A log file of timestamped lines, rotated when it reaches a maximum size.
+
+    Next to every log file, a small index records the offset of a line every INDEX_BYTES bytes
+    or INDEX_SECONDS seconds, so readers can seek close to a point in time. Rotated files are
+    renamed to .1, .2 etc. and optionally compressed with gzip in a background thread; their
+    indexes keep referring to uncompressed offsets.
+
+    Args:
+        path (str): The path of the log file.
+        max_bytes (int, optional): The size at which to rotate the file.
+        backups (int, optional): How many rotated files to keep.
+        compress (bool, optional): Whether to compress rotated files.
+    """
+
+    def __init__(self, path, max_bytes=MAX_BYTES, backups=BACKUPS, compress=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self._compressor = None
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, 'ab')
+        self._index = open(index_path(self.path), 'ab')
+        self.size = self._file.tell()
+        self._indexed_size = None
+        self._indexed_time = None
+
+    def write(self, timestamp, line):
+        """Write a line of output, received at the given time."""
+        if self.size >= self.max_bytes:
+            self._rotate()
+        if self._indexed_size is None or self.size - self._indexed_size >= INDEX_BYTES or \
+                timestamp - self._indexed_time >= INDEX_SECONDS:
+            self._index.write(INDEX_ENTRY.pack(timestamp, self.size))
+            self._indexed_size, self._indexed_time = self.size, timestamp
+        data = format_timestamp(timestamp).encode() + b' ' + line.rstrip(b'\r') + b'\n'
+        self._file.write(data)
+        self.size += len(data)
+
+    def flush(self):
+        self._file.flush()
+        self._index.flush()
+
+    def close(self):
+        self._file.close()
+        self._index.close()
+        if self._compressor is not None:
+            self._compressor.join()
+
+    def _rotate(self):
+        self.close()
+        for number in range(self.backups, 0, -1):
+            source = f'{self.path}.{number}'
+            for suffix in ['', '.gz', '.idx']:
+                if not os.path.exists(source + suffix):
+                    continue
+                if number == self.backups:
+                    os.remove(source + suffix)
+                else:
+                    os.replace(source + suffix, f'{self.path}.{number + 1}{suffix}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+            os.replace(index_path(self.path), f'{self.path}.1.idx')
+            if self.compress:
+                self._compressor = threading.Thread(target=self._compress,
+                                                    args=(f'{self.path}.1',))
+                self._compressor.start()
+        else:
+            os.remove(self.path)
+            os.remove(index_path(self.path))
+        self._open()
+
+    @staticmethod
+    def _compress(file_name):
+        with open(file_name, 'rb') as source, gzip.open(f'{file_name}.tmp', 'wb', 6) as target:
+            shutil.copyfileobj(source, target, 1024 * 1024)
+        os.replace(f'{file_name}.tmp', f'{file_name}.gz')
+        os.remove(file_name)
+
+
+def _read_chunks(fd):
+    """Read from a file descriptor without blocking for longer than FLUSH_INTERVAL.
+
+    Yields:
+        bytes: The data read, or None if nothing arrived within FLUSH_INTERVAL seconds. The
+            last chunk is empty.
+    """
+    if os.name != 'posix':
+        # Selectors only support sockets on Windows; read pipes the blocking way instead.
+        while True:
+            data = os.read(fd, MAX_LINE)
+            yield data
+            if not data:
+                return
+
+    os.set_blocking(fd, False)
+    with selectors.DefaultSelector() as selector:
+        selector.register(fd, selectors.EVENT_READ)
+        while True:
+            if not selector.select(timeout=FLUSH_INTERVAL):
+                yield None
+                continue
+            try:
+                data = os.read(fd, MAX_LINE)
+            except BlockingIOError:
+                continue
+            yield data
+            if not data:
+                return
+
+
+def capture(fd, log):
+    """Write the output read from a file descriptor to a log until the writer closes it.
+
+    Args:
+        fd (int): The file descriptor to read from.
+        log (RotatingLog): The log to write to.
+    """
+    partial = b''
+    flushed = time()
+    try:
+        for data in _read_chunks(fd):
+            now = time()
+            if data:
+                lines = (partial + data).split(b'\n')
+                partial = lines.pop()
+                for line in lines:
+                    log.write(now, line)
+                if len(partial) >= MAX_LINE:
+                    log.write(now, partial)
+                    partial = b''
+            if now - flushed >= FLUSH_INTERVAL:
+                log.flush()
+                flushed = now
+        if partial:
+            log.write(time(), partial)
+    finally:
+        log.close()
+
+
+def read_since(path, since, backups=BACKUPS):
+    """Read the lines logged since a point in time, from the rotated files as well.
+
+    The index of each file is used to seek to the last indexed line before the point in time,
+    and rotated files that end before it are skipped entirely.
+
+    Args:
+        path (str): The path of the log file.
+        since (float): The Unix timestamp to read lines from.
+        backups (int, optional): How many rotated files there may be.
+
+    Yields:
+        bytes: The lines logged since the given time, including their timestamp.
+    """
+    files = rotated_files(path, backups)
+    indexes = [read_index(log_file) for log_file in files]
+    for position, log_file in enumerate(files):
+        timestamps, offsets = indexes[position]
+        # Every file starts with an indexed line, so the next one tells when this one ended.
+        later = [index[0] for index in indexes[position + 1:] if index[0]]
+        if later and later[0][0] <= since:
+            continue
+
+        entry = bisect_right(timestamps, since) - 1
+        offset = offsets[entry] if entry >= 0 else 0
+        opener = gzip.open if log_file.endswith('.gz') else open
+        with opener(log_file, 'rb') as log:
+            log.seek(offset)
+            # Without an index entry to start from, every line's timestamp has to be checked.
+            found = entry < 0 and bool(timestamps)
+            for line in log:
+                if not found:
+                    timestamp = parse_timestamp(line)
+                    if timestamp is None or timestamp < since:
+                        continue
+                    found = True
+                yield line
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write stdin to a rotated, indexed log file.')
+    parser.add_argument('path', help='The log file to write.')
+    parser.add_argument('--max_bytes', type=int, default=MAX_BYTES,
+                        help='The size at which to rotate the log file.')
+    parser.add_argument('--backups', type=int, default=BACKUPS,
+                        help='How many rotated log files to keep.')
+    parser.add_argument('--compress', action='store_true',
+                        help='Compress rotated log files with gzip.')
+    args = parser.parse_args()
+    capture(sys.stdin.fileno(), RotatingLog(args.path, args.max_bytes, args.backups, args.compress))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import threading
+from time import monotonic, thread_time, time
+
+import psutil
+
+logger = logging.getLogger('autolycus')
+
+# The values recorded for each server in every sample, in the order they are stored in.
+FIELDS = ('timestamp', 'up', 'cpu_percent', 'rss_bytes', 'threads', 'open_fds')
+# The Prometheus metric name and help text for every field but the timestamp.
+METRICS = {'up': ('hercules_server_up', 'Whether the server process is running.'),
+           'cpu_percent': ('hercules_server_cpu_percent',
+                           'CPU used by the server, in percent of one core.'),
+           'rss_bytes': ('hercules_server_resident_memory_bytes',
+                         'Resident memory size of the server in bytes.'),
+           'threads': ('hercules_server_threads', 'Number of threads of the server.'),
+           'open_fds': ('hercules_server_open_fds',
+                        'Number of open file descriptors (handles on Windows) of the server.')}
+# How long to wait before looking for a server that isn't running again, in seconds.
+RESCAN_INTERVAL = 5
+# The sampler should not use more than this share of one core; it warns if it does.
+OVERHEAD_BUDGET = 0.01
+
+
+class RingBuffer(object):
+    """A fixed-size buffer of samples that overwrites the oldest sample when full.
+
+    All samples are stored in a single preallocated array of doubles, so the memory used never
+    grows and no objects are kept around per sample.
+
+    Args:
+        fields (tuple): The names of the values in each sample.
+        capacity (int): How many samples to keep.
+    """
+
+    def __init__(self, fields, capacity):
+        self.fields = fields
+        self.capacity = capacity
+        self.width = len(fields)
+        self.count = 0
+        self._next = 0
+        self._data = array('d', bytes(8 * self.width * capacity))
+
+    def __len__(self):
+        return self.count
+
+    def append(self, *values):
+        """Record a sample; values are given in the order of the buffer's fields."""
+        offset = self._next * self.width
+        self._data[offset:offset + self.width] = array('d', values)
+        self._next = (self._next + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def latest(self, field):
+        """Get the most recent value of a field, or None if nothing has been recorded yet."""
+        if not self.count:
+            return None
+        return self._data[(self._next - 1) % self.capacity * self.width +
+                          self.fields.index(field)]
+
+    def column(self, field):
+        """Get all recorded values of a field, oldest first."""
+        index = self.fields.index(field)
+        start = (self._next - self.count) % self.capacity
+        positions = [(start + i) % self.capacity for i in range(self.count)]
+        return [self._data[position * self.width + index] for position in positions]
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+def summarize(values):
+    """Get the minimum, average and 95th percentile of a list of values.
+
+    Returns:
+        dict: The min, avg and p95 of the values, or None for each if there are none.
+    """
+    if not values:
+        return {'min': None, 'avg': None, 'p95': None}
+    ordered = sorted(values)
+    return {'min': ordered[0],
+            'avg': sum(ordered) / len(ordered),
+            'p95': ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]}
+
+
+class MetricsSampler(object):
+    """Periodically record resource usage of the server processes.
+
+    A background thread reads CPU usage, resident memory, thread and file descriptor counts of
+    every server at a fixed interval, fetching each process' information with a single
+    psutil.Process.oneshot() call. Samples go into a ring buffer per server. The sampler
+    measures the CPU time it uses itself and reports it as a metric.
+
+    Args:
+        find_pids (callable): Returns a dictionary of server names to the pid of their running
+            process, or None for servers that aren't running. It is called once at start-up and
+            again whenever a server is not running, at most every RESCAN_INTERVAL seconds.
+        servers (list): The names of the servers to sample.
+        interval (float, optional): Seconds between samples.
+        capacity (int, optional): How many samples to keep per server.
+    """
+
+    def __init__(self, find_pids, servers, interval=1, capacity=3600):
+        self.find_pids = find_pids
+        self.servers = servers
+        self.interval = interval
+        self.buffers = {server: RingBuffer(FIELDS, capacity) for server in servers}
+        self.processes = {server: None for server in servers}
+        self.cpu_seconds = 0
+        self.samples = 0
+        self._started = None
+        self._last_scan = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def overhead(self):
+        """The share of one core used by the sampler since it started."""
+        if self._started is None:
+            return 0
+        elapsed = monotonic() - self._started
+        return self.cpu_seconds / elapsed if elapsed > 0 else 0
+
+    def _refresh_processes(self):
+        """Look up the processes for any servers that aren't running."""
+        if self._last_scan is not None and monotonic() - self._last_scan < RESCAN_INTERVAL:
+            return
+        self._last_scan = monotonic()
+        for server, pid in self.find_pids().items():
+            if server in self.processes and self.processes[server] is None and pid is not None:
+                try:
+                    proc = psutil.Process(pid)
+                    # The first call only sets the baseline for the next one.
+                    proc.cpu_percent()
+                    self.processes[server] = proc
+                except psutil.NoSuchProcess:
+                    continue
+
+    def sample(self):
+        """Record one sample for every server."""
+        started = thread_time()
+        if any(proc is None for proc in self.processes.values()):
+            self._refresh_processes()
+        now = time()
+        for server, proc in self.processes.items():
+            if proc is None:
+                self.buffers[server].append(now, 0, 0, 0, 0, 0)
+                continue
+            try:
+                with proc.oneshot():
+                    cpu_percent = proc.cpu_percent()
+                    rss = proc.memory_info().rss
+                    threads = proc.num_threads()
+                    fds = proc.num_fds() if hasattr(proc, 'num_fds') else proc.num_handles()
+                self.buffers[server].append(now, 1, cpu_percent, rss, threads, fds)
+            except (psutil.NoSuchProcess, psutil.ZombieProcess):
+                logger.debug(f'{server} (pid {proc.pid}) is gone.')
+                self.processes[server] = None
+                self.buffers[server].append(now, 0, 0, 0, 0, 0)
+        self.samples += 1
+        self.cpu_seconds += thread_time() - started
+
+    def _run(self):
+        next_sample = monotonic()
+        warned = False
+        while not self._stop.is_set():
+            self.sample()
+            if not warned and self.samples >= 10 and self.overhead > OVERHEAD_BUDGET:
+                logger.warning(f'Metrics sampling uses {self.overhead:.2%} of a core; ' +
+                               'consider a longer interval.')
+                warned = True
+            next_sample += self.interval
+            # Skip samples rather than bunching them up if sampling fell behind.
+            if next_sample < monotonic():
+                next_sample = monotonic() + self.interval
+            self._stop.wait(next_sample - monotonic())
+
+    def start(self):
+        """Start sampling in a background thread."""
+        self._started = monotonic()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='metrics-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling and wait for the background thread to finish."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def summary(self):
+        """Get the min, average and 95th percentile of every metric of every server.
+
+        Only samples taken while a server was running count towards its summary.
+
+        Returns:
+            dict: Server names mapped to dictionaries of field names mapped to summaries.
+        """
+        summaries = {}
+        for server, buffer in self.buffers.items():
+            up = buffer.column('up')
+            summaries[server] = {}
+            for field in METRICS:
+                if field == 'up':
+                    continue
+                values = [value for value, running in zip(buffer.column(field), up) if running]
+                summaries[server][field] = summarize(values)
+        return summaries
+
+    def prometheus(self):
+        """Render the latest samples and their summaries in the Prometheus text format."""
+        lines = []
+        summaries = self.summary()
+        for field, (name, description) in METRICS.items():
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} gauge']
+            for server, buffer in self.buffers.items():
+                value = buffer.latest(field)
+                if value is not None:
+                    lines.append(f'{name}{{server="{server}"}} {_format_value(value)}')
+            if field == 'up':
+                continue
+            lines += [f'# HELP {name}_window {description} Summarized over the kept samples.',
+                      f'# TYPE {name}_window gauge']
+            for server in self.buffers:
+                for stat, value in summaries[server][field].items():
+                    if value is not None:
+                        lines.append(f'{name}_window{{server="{server}",stat="{stat}"}} '
+                                     f'{_format_value(value)}')
+        lines += ['# HELP autolycus_sampler_cpu_seconds_total CPU time used by the sampler.',
+                  '# TYPE autolycus_sampler_cpu_seconds_total counter',
+                  f'autolycus_sampler_cpu_seconds_total {self.cpu_seconds!r}',
+                  '# HELP autolycus_sampler_overhead_ratio Share of one core used by the sampler.',
+                  '# TYPE autolycus_sampler_overhead_ratio gauge',
+                  f'autolycus_sampler_overhead_ratio {self.overhead!r}']
+        return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(sampler, host, port):
+    """Serve a sampler's metrics over HTTP on /metrics until interrupted.
+
+    Args:
+        sampler (MetricsSampler): The running sampler to serve metrics from.
+        host (str): The address to listen on.
+        port (int): The port to listen on.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = sampler.prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(f'{self.address_string()} {format % args}')
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    logger.info(f'Serving metrics on http://{host}:{port}/metrics')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,64 @@
+import re
+import socket
+import threading
+from time import monotonic
+
+
+def mask_password(url):
+    """Replace the password in a database URL with asterisks."""
+    return re.sub(r'(://[^:@/]*:)[^@/]*@', r'\1***@', url)
+
+
+def accepts_connections(host, port, timeout=1):
+    """Check whether something accepts TCP connections on a port.
+
+    Returns:
+        bool: Whether a connection could be made within the timeout.
+    """
+    try:
+        socket.create_connection((host, port), timeout=timeout).close()
+        return True
+    except OSError:
+        return False
+
+
+def run_probes(probes, timeout):
+    """Run status checks concurrently and collect whatever finishes in time.
+
+    Every probe runs in its own daemon thread, so a probe stuck in a driver's connect timeout
+    neither delays the others nor keeps the process from exiting once the results are in.
+
+    Args:
+        probes (dict): Probe names mapped to functions without arguments.
+        timeout (float): How long to wait for all the probes, in seconds.
+
+    Returns:
+        dict: Probe names mapped to dictionaries of 'ok' (bool) whether the probe finished
+            without raising, 'value' what it returned, 'error' (str) why it failed and
+            'latency' (float) how long it took in seconds.
+    """
+    results = {}
+
+    def run(name, probe):
+        started = monotonic()
+        try:
+            result = {'ok': True, 'value': probe(), 'error': None}
+        except Exception as exc:
+            result = {'ok': False, 'value': None, 'error': str(exc).replace('\n', ' ')}
+        result['latency'] = monotonic() - started
+        results[name] = result
+
+    deadline = monotonic() + timeout
+    threads = [threading.Thread(target=run, args=(name, probe), name=f'probe-{name}', daemon=True)
+               for name, probe in probes.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(max(0, deadline - monotonic()))
+
+    finished = dict(results)
+    for name in probes:
+        if name not in finished:
+            finished[name] = {'ok': False, 'value': None, 'latency': timeout,
+                              'error': f'Timed out after {timeout} seconds.'}
+    return finished
@@ -0,0 +1,252 @@
+import logging
+import os
+import sys
+from time import monotonic, sleep
+
+# psutil is imported by the functions that need it: importing it takes longer than the rest of
+# a quick stop with no servers running, which never needs it.
+
+logger = logging.getLogger('autolycus')
+
+
+def _same_path(first, second):
+    return first is not None and second is not None and \
+        os.path.normcase(os.path.realpath(first)) == os.path.normcase(os.path.realpath(second))
+
+
+def _process_names():
+    """List the pid and name of every process.
+
+    On Linux the names are read straight from /proc, which is all psutil would do, without
+    paying for importing psutil.
+
+    Returns:
+        list: (pid, name) tuples.
+    """
+    if not sys.platform.startswith('linux'):
+        import psutil
+
+        return [(proc.pid, proc.info['name']) for proc in psutil.process_iter(attrs=['name'])]
+
+    names = []
+    for entry in os.scandir('/proc'):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry.name}/comm', 'rb') as comm:
+                names.append((int(entry.name), comm.read().rstrip(b'\n').decode(errors='replace')))
+        except OSError:
+            continue
+    return names
+
+
+class ProcessSnapshot(object):
+    """A single pass over the process table, indexed for finding Hercules servers.
+
+    Scanning the process table is expensive on busy hosts, so this only reads the name of every
+    process and fetches the executable path, working directory and start time just for the
+    processes whose name looks like one of the servers. psutil is only imported if there are
+    any.
+
+    Args:
+        hercules_path (str): The path to the Hercules installation the servers belong to.
+        executables (dict): Server names mapped to the full path of their executable.
+    """
+
+    def __init__(self, hercules_path, executables):
+        self.hercules_path = hercules_path
+        self.executables = executables
+        # pid -> dict of pid, name, exe, cwd and create_time for every candidate process
+        self.processes = {}
+        # server name / real path of the executable -> list of candidate pids
+        self.by_name = {}
+        self.by_exe = {}
+
+        servers = tuple(executables)
+        candidates = [pid for pid, name in _process_names() if name and name.startswith(servers)]
+        if candidates:
+            import psutil
+        for pid in candidates:
+            try:
+                proc = psutil.Process(pid)
+                with proc.oneshot():
+                    info = proc.as_dict(attrs=['pid', 'name', 'exe', 'cwd', 'create_time'],
+                                        ad_value=None)
+            except psutil.NoSuchProcess:
+                continue
+            name = info['name']
+            if not name or not name.startswith(servers):
+                # The pid was reused by another process since its name was read.
+                continue
+            self.processes[proc.pid] = info
+            for server in servers:
+                if name.startswith(server):
+                    self.by_name.setdefault(server, []).append(proc.pid)
+            if info['exe']:
+                self.by_exe.setdefault(os.path.realpath(info['exe']), []).append(proc.pid)
+
+    def belongs_to(self, pid, server):
+        """Check whether a process is the given server of this Hercules installation.
+
+        A process matches if it runs the server's executable. If its executable can't be read
+        (e.g. it belongs to another user), it matches if its name and working directory do. If
+        neither can be read, the name alone has to do.
+        """
+        info = self.processes.get(pid)
+        if info is None or not info['name'].startswith(server):
+            return False
+        if info['exe'] is not None:
+            return _same_path(info['exe'], self.executables[server])
+        if info['cwd'] is not None:
+            return _same_path(info['cwd'], self.hercules_path)
+        return True
+
+    def find(self, server):
+        """Get the pids of all processes that are the given server of this installation."""
+        pids = [pid for pid in self.by_exe.get(os.path.realpath(self.executables[server]), [])
+                if self.processes[pid]['name'].startswith(server)]
+        # Processes whose executable can't be read have to be matched by the weaker criteria.
+        pids += [pid for pid in self.by_name.get(server, [])
+                 if self.processes[pid]['exe'] is None and self.belongs_to(pid, server)]
+        return sorted(pids)
+
+    def status(self, server, expected_pid):
+        """Get the status for the given server.
+
+        Args:
+            server (str): The server to check status for [map, login, char]
+            expected_pid (int): The pid stored in the server's pid file, or None.
+        Returns:
+            tuple: The server status [running, stopped, orphaned, missing] and its pid (or list
+                of pids, if there are several orphaned processes).
+                "orphaned" means there is a process for the server but no pid file.
+                "missing" means there is a pid file but no process for the server with that pid.
+        """
+        if expected_pid is not None:
+            if self.belongs_to(expected_pid, server):
+                return ('running', expected_pid)
+            return ('missing', expected_pid)
+
+        matching_processes = self.find(server)
+        if len(matching_processes) > 1:
+            logger.warning(f'Found multiple processes matching {server}!')
+            return ('orphaned', matching_processes)
+        elif len(matching_processes) == 1:
+            return ('orphaned', matching_processes[0])
+        return ('stopped', None)
+
+
+def terminate(processes, grace_period=10):
+    """Terminate processes and all their children concurrently.
+
+    Every process is sent SIGTERM at once and they are all waited for together. Any that are
+    still running after the grace period are killed with SIGKILL.
+
+    Args:
+        processes (list): The psutil.Process objects to terminate.
+        grace_period (float, optional): How long to give the processes to exit, in seconds.
+
+    Returns:
+        list: The processes that had to be killed.
+    """
+    import psutil
+
+    targets = []
+    for proc in processes:
+        try:
+            targets += [proc] + proc.children(recursive=True)
+        except psutil.NoSuchProcess:
+            continue
+
+    for proc in targets:
+        try:
+            proc.terminate()
+        except psutil.NoSuchProcess:
+            pass
+
+    def on_exit(proc):
+        logger.debug(f'Process {proc.pid} exited with code {proc.returncode}.')
+
+    _, alive = psutil.wait_procs(targets, timeout=grace_period, callback=on_exit)
+    for proc in alive:
+        logger.warning(f'Process {proc.pid} failed to exit within {grace_period} seconds, '
+                       'killing it!')
+        try:
+            proc.kill()
+        except psutil.NoSuchProcess:
+            pass
+    psutil.wait_procs(alive, timeout=5, callback=on_exit)
+    return alive
+
+
+def is_listening(proc, port):
+    """Check whether a process is listening on a TCP port.
+
+    Returns:
+        bool: Whether the process listens on the port, or None if that can't be determined.
+    """
+    import psutil
+
+    try:
+        # psutil renamed connections() to net_connections() in version 6.
+        connections = getattr(proc, 'net_connections', None) or proc.connections
+        return any(connection.status == psutil.CONN_LISTEN and connection.laddr.port == port
+                   for connection in connections(kind='tcp'))
+    except psutil.AccessDenied:
+        return None
+
+
+def wait_for_port(proc, host, port, timeout=60):
+    """Wait until a process is accepting connections on a port.
+
+    The process' own sockets are checked where possible, so a different process holding the
+    port is not mistaken for it; otherwise a TCP connection to the port is attempted.
+
+    Args:
+        proc (psutil.Process): The process to wait for.
+        host (str): The address the process should listen on.
+        port (int): The port the process should listen on.
+        timeout (float, optional): How long to wait in seconds.
+
+    Raises:
+        OSError: The process exited before it started listening.
+        TimeoutError: The process did not start listening in time.
+
+    Returns:
+        float: How long it took for the process to start listening, in seconds.
+    """
+    import socket
+
+    import psutil
+
+    start = monotonic()
+    deadline = start + timeout
+    delay = 0.02
+    while True:
+        try:
+            exited = proc.status() == psutil.STATUS_ZOMBIE
+        except psutil.NoSuchProcess:
+            exited = True
+        if exited:
+            try:
+                exit_code = proc.wait(timeout=0)
+            except (psutil.NoSuchProcess, psutil.TimeoutExpired):
+                exit_code = 'unknown'
+            raise OSError(f'Process {proc.pid} exited with code {exit_code} before listening on '
+                          f'port {port}!')
+
+        listening = is_listening(proc, port)
+        if listening is None:
+            try:
+                socket.create_connection((host, port), timeout=0.2).close()
+                listening = True
+            except OSError:
+                listening = False
+        if listening:
+            return monotonic() - start
+
+        if monotonic() >= deadline:
+            raise TimeoutError(f'Process {proc.pid} did not listen on port {port} within '
+                               f'{timeout} seconds!')
+        sleep(min(delay, max(0, deadline - monotonic())))
+        delay = min(delay * 2, 0.5)
@@ -0,0 +1,209 @@
+import functools
+import os
+import threading
+from time import perf_counter_ns
+
+# The profiler spans are recorded to, while profiling is enabled.
+_profiler = None
+
+
+class Profiler(object):
+    """Collect timed spans from any number of threads.
+
+    Every span is recorded with its total time and its self time, which leaves out the time
+    spent in spans nested inside it on the same thread, so summing self times never counts a
+    step twice.
+    """
+
+    def __init__(self):
+        self.started = perf_counter_ns()
+        # (name, category, thread id, start, duration, self duration, args) of every span
+        self.events = []
+        # thread id -> thread name
+        self.threads = {}
+        self._local = threading.local()
+
+    def _stack(self):
+        """Get the spans currently open on this thread, innermost last."""
+        try:
+            return self._local.stack
+        except AttributeError:
+            thread = threading.current_thread()
+            self.threads[thread.ident] = thread.name
+            self._local.stack = []
+            return self._local.stack
+
+    def record(self, name, category, start, end, args, children=0):
+        """Record a finished span.
+
+        Args:
+            name (str): What was timed.
+            category (str): The module it was timed in.
+            start (int): When it started, from perf_counter_ns().
+            end (int): When it ended, from perf_counter_ns().
+            args (dict): Details to show with the span, e.g. the file it was about.
+            children (int, optional): Nanoseconds spent in spans nested inside this one.
+        """
+        duration = end - start
+        stack = self._stack()
+        if stack:
+            stack[-1].children += duration
+        self.events.append((name, category, threading.get_ident(), start, duration,
+                            duration - children, args))
+
+    def trace(self):
+        """Get the spans in the Chrome trace event format, for chrome://tracing or Perfetto."""
+        pid = os.getpid()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                   'args': {'name': thread_name}}
+                  for tid, thread_name in self.threads.items()]
+        for name, category, tid, start, duration, _, args in self.events:
+            events.append({'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': tid,
+                           'ts': (start - self.started) / 1000, 'dur': duration / 1000,
+                           'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_trace(self, file_name):
+        import json
+
+        with open(file_name, 'w') as trace_file:
+            json.dump(self.trace(), trace_file, default=str)
+
+    def summary(self, count=15):
+        """Total the spans by name.
+
+        Args:
+            count (int, optional): How many of the names with the most self time to return.
+        Returns:
+            list: (name, calls, total, self, longest) tuples with times in seconds, the most
+                self time first.
+        """
+        totals = {}
+        for name, _, _, _, duration, self_duration, _ in self.events:
+            calls, total, own, longest = totals.get(name, (0, 0, 0, 0))
+            totals[name] = (calls + 1, total + duration, own + self_duration,
+                            max(longest, duration))
+        rows = [(name, calls, total / 1e9, own / 1e9, longest / 1e9)
+                for name, (calls, total, own, longest) in totals.items()]
+        return sorted(rows, key=lambda row: row[3], reverse=True)[:count]
+
+
+class Span(object):
+    """Time the code inside a with block as a span of a profiler."""
+
+    __slots__ = ['profiler', 'name', 'category', 'args', 'start', 'children']
+
+    def __init__(self, profiler, name, category, args):
+        self.profiler = profiler
+        self.name = name
+        self.category = category
+        self.args = args
+        self.children = 0
+
+    def __enter__(self):
+        self.profiler._stack().append(self)
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = perf_counter_ns()
+        self.profiler._stack().pop()
+        self.profiler.record(self.name, self.category, self.start, end, self.args, self.children)
+        return False
+
+
+class _NullSpan(object):
+    """What span() returns while profiling is disabled: a with block that does nothing."""
+
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def enable():
+    """Start recording spans, unless that is already happening.
+
+    Returns:
+        Profiler: The profiler spans are recorded to.
+    """
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler()
+    return _profiler
+
+
+def disable():
+    """Stop recording spans.
+
+    Returns:
+        Profiler: The profiler the spans were recorded to, or None if profiling was disabled.
+    """
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+def enabled():
+    return _profiler is not None
+
+
+def span(name, category='autolycus', **args):
+    """Time a with block while profiling is enabled.
+
+    Example:
+        with span('import_sql', file=file_name):
+            importer.run(reader)
+
+    Args:
+        name (str): What is being timed; spans of the same name are totalled in the summary.
+        category (str, optional): The module it is timed in.
+        **args: Details to show with the span in the trace.
+    """
+    if _profiler is None:
+        return _NULL_SPAN
+    return Span(_profiler, name, category, args)
+
+
+def record(name, start, end, category='autolycus', **args):
+    """Record a span after the fact, e.g. only once it turned out to be slow.
+
+    Args:
+        name (str): What was timed.
+        start (int): When it started, from perf_counter_ns().
+        end (int): When it ended, from perf_counter_ns().
+        category (str, optional): The module it was timed in.
+        **args: Details to show with the span in the trace.
+    """
+    profiler = _profiler
+    if profiler is not None:
+        profiler.record(name, category, start, end, args)
+
+
+def profiled(function):
+    """Time every call of a function or method as a span named after it."""
+    name = function.__qualname__
+    category = function.__module__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _profiler is None:
+            return function(*args, **kwargs)
+        with Span(_profiler, name, category, {}):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def format_summary(rows):
+    """Format the result of Profiler.summary() as the lines of a table."""
+    lines = [f'{"self ms":>10} {"total ms":>10} {"calls":>7} {"longest ms":>10}  span']
+    for name, calls, total, own, longest in rows:
+        lines.append(f'{own * 1000:10.1f} {total * 1000:10.1f} {calls:7d} {longest * 1000:10.1f}'
+                     f'  {name}')
+    return lines
@@ -0,0 +1,532 @@
+import codecs
+import gzip
+import os
+import queue
+import re
+import threading
+from time import monotonic, perf_counter_ns
+
+import autolycus_profile
+
+# How much of an SQL file to read and decode at a time.
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+# Statements and commits that take longer than this (in nanoseconds) get a span of their own
+# with --profile; there are far too many quick ones to record them all.
+SLOW_STATEMENT = 50 * 1000 * 1000
+
+# Inside a string literal, the only characters that matter are escapes and the closing quote.
+QUOTE_RES = {
+    "'": re.compile(r"[\\']"),
+    '"': re.compile(r'[\\"]'),
+    '`': re.compile(r'`'),
+}
+
+# A complete string literal, including escapes and doubled quotes.
+LITERAL_RES = {
+    "'": re.compile(r"'[^'\\]*(?:(?:\\.|'')[^'\\]*)*'", re.DOTALL),
+    '"': re.compile(r'"[^"\\]*(?:(?:\\.|"")[^"\\]*)*"', re.DOTALL),
+    '`': re.compile(r'`[^`]*(?:``[^`]*)*`'),
+}
+
+WHITESPACE_RE = re.compile(r'\s*')
+DELIMITER_RE = re.compile(r'delimiter[ \t]+(\S+)[^\n]*(?:\n|$)', re.IGNORECASE)
+
+
+def _boundary_re(delimiter):
+    """Match anything outside a string literal that may change how the text is split."""
+    return re.compile('|'.join([r"['\"`#/\-]", re.escape(delimiter)]))
+
+
+def _run_re(delimiter):
+    """Match a run of plain text and complete string literals that can be taken as-is."""
+    plain = '[^\'"`#/\\-' + re.escape(delimiter[0]) + ']+'
+    literals = [literal.pattern for literal in LITERAL_RES.values()]
+    return re.compile('(?:' + '|'.join([plain] + literals) + ')*', re.DOTALL)
+
+
+class SQLStatementReader(object):
+    """Split an SQL dump into statements lazily, reading it in fixed-size chunks.
+
+    Statements are split on the current delimiter, ignoring delimiters inside string literals
+    (with backslash and doubled-quote escapes) and comments. Comments are dropped, except for
+    MySQL's executable /*! ... */ comments, and mysql client DELIMITER commands are honoured.
+    Only the chunk being scanned and the statement being built are held in memory.
+
+    Args:
+        sql_file (file): The SQL file to read, opened in binary mode.
+        chunk_size (int, optional): How many bytes to read from the file at a time.
+        encoding (str, optional): The text encoding of the file.
+        progress (callable, optional): Called with the reader as its argument after reading each
+            chunk, at most every progress_interval seconds.
+        progress_interval (float, optional): The minimum time between progress calls in seconds.
+    """
+
+    def __init__(self, sql_file, chunk_size=DEFAULT_CHUNK_SIZE, encoding='utf-8', progress=None,
+                 progress_interval=5.0):
+        self.sql_file = sql_file
+        self.chunk_size = chunk_size
+        self.encoding = encoding
+        self.progress = progress
+        self.progress_interval = progress_interval
+
+        self.bytes_read = 0
+        self.statements = 0
+        self.started = None
+        self._last_progress = None
+        try:
+            # The size of a compressed file says nothing about how much SQL is in it.
+            if isinstance(sql_file, gzip.GzipFile):
+                raise ValueError
+            self.total_bytes = os.fstat(sql_file.fileno()).st_size
+        except (AttributeError, OSError, ValueError):
+            self.total_bytes = None
+
+    @property
+    def elapsed(self):
+        """float: Seconds since the reader started reading."""
+        return monotonic() - self.started if self.started is not None else 0.0
+
+    @property
+    def throughput(self):
+        """float: Bytes read per second so far."""
+        elapsed = self.elapsed
+        return self.bytes_read / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def percent_done(self):
+        """float: The percentage of the file read so far, or None if the size is unknown."""
+        if not self.total_bytes:
+            return None
+        return min(100.0, 100.0 * self.bytes_read / self.total_bytes)
+
+    def _read_chunk(self, decoder):
+        if self.started is None:
+            self.started = self._last_progress = monotonic()
+        data = self.sql_file.read(self.chunk_size)
+        self.bytes_read += len(data)
+        if self.progress is not None and monotonic() - self._last_progress >= \
+                self.progress_interval:
+            self._last_progress = monotonic()
+            self.progress(self)
+        if not data:
+            return decoder.decode(b'', final=True), True
+        return decoder.decode(data), False
+
+    def __iter__(self):
+        decoder = codecs.getincrementaldecoder(self.encoding)()
+        delimiter = ';'
+        boundary = _boundary_re(delimiter)
+        run = _run_re(delimiter)
+        buf, eof = '', False
+        pos = 0
+        parts = []        # the pieces of the statement being built
+        has_content = False
+        quote = None      # the quote character while inside a string literal
+
+        while True:
+            # Refilling only happens when a step below could not make a decision with the text
+            # at hand (or ran out of it); every other iteration consumes some of the buffer.
+            need_more = False
+
+            if quote is not None:
+                match = QUOTE_RES[quote].search(buf, pos)
+                if match is None:
+                    parts.append(buf[pos:])
+                    pos = len(buf)
+                    need_more = True
+                else:
+                    index = match.start()
+                    if index + 1 >= len(buf) and not eof:
+                        # Can't tell an escape or doubled quote from the end of the literal yet.
+                        parts.append(buf[pos:index])
+                        pos = index
+                        need_more = True
+                    elif buf[index] == '\\':
+                        parts.append(buf[pos:index + 2])
+                        pos = index + 2
+                    elif buf[index + 1:index + 2] == quote:
+                        parts.append(buf[pos:index + 2])
+                        pos = index + 2
+                    else:
+                        parts.append(buf[pos:index + 1])
+                        pos = index + 1
+                        quote = None
+
+            elif not has_content and buf[pos:pos + 1].isspace():
+                pos = WHITESPACE_RE.match(buf, pos).end()
+                need_more = pos >= len(buf)
+
+            elif not has_content and not eof and len(buf) - pos < 9 and \
+                    'delimiter'.startswith(buf[pos:].lower()):
+                need_more = True
+
+            elif not has_content and buf[pos:pos + 9].lower() == 'delimiter':
+                match = DELIMITER_RE.match(buf, pos)
+                if match is None or (not match.group(0).endswith('\n') and not eof):
+                    need_more = True
+                else:
+                    delimiter = match.group(1)
+                    boundary = _boundary_re(delimiter)
+                    run = _run_re(delimiter)
+                    pos = match.end()
+
+            else:
+                # Fast path: take plain text and complete literals in one go. A run reaching the
+                # end of the buffer is left to the careful path below, as its last literal may
+                # continue in the next chunk.
+                end = run.match(buf, pos).end()
+                if end > pos and (eof or end < len(buf)):
+                    text = buf[pos:end]
+                    parts.append(text)
+                    has_content = has_content or bool(text.strip())
+                    pos = end
+                    continue
+
+                match = boundary.search(buf, pos)
+                if match is None:
+                    # Hold back anything that could be the start of a delimiter.
+                    end = len(buf) if eof else max(pos, len(buf) - len(delimiter) + 1)
+                    text = buf[pos:end]
+                    parts.append(text)
+                    has_content = has_content or bool(text.strip())
+                    pos = end
+                    need_more = True
+                else:
+                    index = match.start()
+                    text = buf[pos:index]
+                    parts.append(text)
+                    has_content = has_content or bool(text.strip())
+                    pos = index
+                    char = buf[index]
+                    lookahead = buf[index + 1:index + 3]
+
+                    if buf.startswith(delimiter, index):
+                        statement = ''.join(parts).strip()
+                        parts, has_content = [], False
+                        pos = index + len(delimiter)
+                        if statement:
+                            self.statements += 1
+                            yield statement
+                    elif char in QUOTE_RES:
+                        has_content = True
+                        literal = LITERAL_RES[char].match(buf, index)
+                        if literal is not None and (eof or literal.end() < len(buf)):
+                            # The common case: the whole literal is in the buffer already.
+                            parts.append(literal.group(0))
+                            pos = literal.end()
+                        else:
+                            parts.append(char)
+                            quote = char
+                            pos += 1
+                    elif len(lookahead) < 2 and not eof and char in '-/':
+                        need_more = True
+                    elif char == '#' or (char == '-' and lookahead[:1] == '-' and
+                                         (len(lookahead) < 2 or lookahead[1].isspace())):
+                        end = buf.find('\n', index)
+                        if end == -1 and not eof:
+                            need_more = True
+                        else:
+                            pos = len(buf) if end == -1 else end
+                    elif char == '/' and lookahead[:1] == '*':
+                        end = buf.find('*/', index + 2)
+                        if end == -1 and not eof:
+                            need_more = True
+                        elif lookahead[1:] in ('!', '+'):
+                            # Executable comments and optimizer hints are part of the statement.
+                            end = len(buf) if end == -1 else end + 2
+                            parts.append(buf[index:end])
+                            has_content = True
+                            pos = end
+                        else:
+                            parts.append(' ')
+                            pos = len(buf) if end == -1 else end + 2
+                    else:
+                        parts.append(char)
+                        has_content = True
+                        pos += 1
+
+            if need_more:
+                if eof:
+                    break
+                text, eof = self._read_chunk(decoder)
+                buf = buf[pos:] + text
+                pos = 0
+
+        statement = ''.join(parts).strip()
+        if statement:
+            # A final statement without a trailing delimiter.
+            self.statements += 1
+            yield statement
+
+
+def open_sql_file(file_name):
+    """Open an SQL file for SQLStatementReader, decompressing it if it ends with .gz."""
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name, 'rb')
+    return open(file_name, 'rb')
+
+
+def format_bytes(size):
+    """Format a number of bytes for humans, e.g. "12.3 MiB"."""
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if abs(size) < 1024 or unit == 'GiB':
+            return f'{size:.1f} {unit}'
+        size /= 1024
+
+
+# A single-table INSERT whose VALUES list may be merged with the next one's.
+INSERT_RE = re.compile(r'(INSERT\s+(?:IGNORE\s+)?INTO\s+([`"]?[\w$]+[`"]?(?:\.[`"]?[\w$]+[`"]?)?)'
+                       r'\s*(?:\([^()]*\))?\s*VALUES\s*)(\(.*)', re.IGNORECASE | re.DOTALL)
+
+# One parenthesised row of values: plain text, string literals and one level of nested
+# parentheses for function calls. Anything more complicated is not coalesced.
+ROW_PATTERN = r'\s*\((?:[^()\'"]|%s|%s|\([^()\'"]*\))*\)\s*' % (LITERAL_RES["'"].pattern,
+                                                                LITERAL_RES['"'].pattern)
+ROWS_RE = re.compile(f'{ROW_PATTERN}(?:,{ROW_PATTERN})*', re.DOTALL)
+ROW_RE = re.compile(ROW_PATTERN, re.DOTALL)
+
+
+def split_insert(statement):
+    """Split a plain INSERT ... VALUES statement into its prefix, table name and rows.
+
+    Returns:
+        tuple: The statement up to and including VALUES, the table name and the text of the
+            VALUES list. None if the statement is anything else, e.g. an INSERT ... SELECT or one
+            with an ON DUPLICATE KEY UPDATE clause.
+    """
+    match = INSERT_RE.match(statement)
+    if match is None or not ROWS_RE.fullmatch(match.group(3)):
+        return None
+    return match.group(1), match.group(2).replace('`', '').replace('"', ''), match.group(3)
+
+
+class _ImportConnection(object):
+    """A database connection that commits every batch_size statements."""
+
+    def __init__(self, importer):
+        self.importer = importer
+        self.connection = importer.engine.connect()
+        self.transaction = None
+        self.pending = 0
+        if importer.disable_checks:
+            self._set_checks(0)
+
+    def _set_checks(self, value):
+        if self.importer.engine.dialect.name == 'mysql':
+            self.connection.exec_driver_sql(f'SET FOREIGN_KEY_CHECKS={value}')
+            self.connection.exec_driver_sql(f'SET UNIQUE_CHECKS={value}')
+
+    def execute(self, statement, rows):
+        if self.transaction is None:
+            self.transaction = self.connection.begin()
+        self.importer.logger.debug(statement if len(statement) < 1000 else
+                                   f'{statement[:1000]}... ({len(statement)} characters)')
+        started = perf_counter_ns() if autolycus_profile.enabled() else None
+        try:
+            result = self.connection.exec_driver_sql(statement)
+            if rows is None:
+                # Not taken apart; count the rows of INSERTs as the database reports them.
+                is_insert = statement[:16].lstrip()[:6].upper() == 'INSERT'
+                rows = max(result.rowcount, 0) if is_insert else 0
+            self.importer._count(rows=rows)
+        except Exception as exc:
+            self.importer.logger.error(f'SQL statement error: {exc}')
+            self.importer._count(errors=1)
+        if started is not None:
+            ended = perf_counter_ns()
+            if ended - started >= SLOW_STATEMENT:
+                autolycus_profile.record('slow SQL statement', started, ended, 'autolycus_sql',
+                                         statement=statement[:200], rows=rows)
+        self.pending += 1
+        if self.pending >= self.importer.batch_size:
+            self.commit()
+
+    def commit(self):
+        if self.transaction is not None:
+            started = perf_counter_ns() if autolycus_profile.enabled() else None
+            self.transaction.commit()
+            self.transaction = None
+            if started is not None:
+                ended = perf_counter_ns()
+                if ended - started >= SLOW_STATEMENT:
+                    autolycus_profile.record('slow SQL commit', started, ended, 'autolycus_sql')
+        self.pending = 0
+
+    def close(self):
+        """Commit what is left and hand the connection back to the pool.
+
+        The checks go back to the server's defaults whether or not the import worked, as both
+        disable_checks and the dumps themselves turn them off for the session; a connection
+        they cannot be restored on is thrown away rather than pooled with them still off.
+        """
+        try:
+            self.commit()
+        finally:
+            try:
+                if self.transaction is not None:
+                    self.transaction.rollback()
+                    self.transaction = None
+                self._set_checks('DEFAULT')
+            except Exception as exc:
+                self.importer.logger.debug(f'Discarding the import connection: {exc}')
+                self.connection.invalidate()
+            finally:
+                self.connection.close()
+
+
+class SQLImporter(object):
+    """Execute a stream of SQL statements against a database as fast as it will take them.
+
+    With the defaults, every statement is executed and committed on its own. The options trade
+    that for speed on large dumps.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): The database to import into.
+        logger (logging.Logger): Where to log statements and errors.
+        batch_size (int, optional): How many statements to execute per transaction.
+        coalesce_rows (int, optional): Merge consecutive INSERTs into the same table into
+            multi-row INSERTs of up to this many rows.
+        max_statement_size (int, optional): The maximum size in characters of a merged INSERT.
+            Keep this below the server's max_allowed_packet.
+        disable_checks (bool, optional): Turn off foreign key and unique checks (MySQL only) for
+            the duration of the import.
+        jobs (int, optional): How many connections to use. Above 1, INSERTs into different
+            tables are run concurrently; any other statement waits for all pending INSERTs.
+            Tables are then filled in no particular order, so foreign key and unique checks are
+            turned off as with disable_checks. SQLite only allows one writer at a time, so it
+            always uses a single connection.
+    """
+
+    def __init__(self, engine, logger, batch_size=1, coalesce_rows=1,
+                 max_statement_size=1024 * 1024, disable_checks=False, jobs=1):
+        self.engine = engine
+        self.logger = logger
+        self.batch_size = max(1, batch_size)
+        self.coalesce_rows = max(1, coalesce_rows)
+        self.max_statement_size = max_statement_size
+        self.jobs = max(1, jobs)
+        if self.jobs > 1 and engine.dialect.name == 'sqlite':
+            logger.warning('SQLite allows only one writer at a time; importing with a single '
+                           'connection.')
+            self.jobs = 1
+        if self.jobs > 1 and not disable_checks:
+            logger.info('Disabling foreign key and unique checks to import tables concurrently.')
+            disable_checks = True
+        self.disable_checks = disable_checks
+
+        self.rows = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._queues = []
+        self._workers = []
+        self._failures = []
+
+    def _count(self, rows=0, errors=0):
+        with self._lock:
+            self.rows += rows
+            self.errors += errors
+
+    def run(self, statements):
+        """Execute all the statements.
+
+        Args:
+            statements (iterable): The SQL statements to execute, e.g. an SQLStatementReader.
+
+        Raises:
+            Exception: A connection failed while importing. Errors in individual statements are
+                logged and counted in self.errors instead.
+        """
+        connection = _ImportConnection(self)
+        if self.jobs > 1:
+            self._start_workers()
+
+        # INSERTs only need taking apart to merge them or hand them to a worker per table.
+        split = self.coalesce_rows > 1 or self.jobs > 1
+        prefix, table, rows, row_count, size = None, None, [], 0, 0
+        try:
+            for statement in statements:
+                insert = split_insert(statement) if split else None
+
+                if insert is not None and insert[0] == prefix and \
+                        row_count < self.coalesce_rows and \
+                        size + len(insert[2]) < self.max_statement_size:
+                    rows.append(insert[2])
+                    row_count += len(ROW_RE.findall(insert[2]))
+                    size += len(insert[2]) + 1
+                    continue
+
+                if rows:
+                    self._insert(connection, table, prefix + ','.join(rows), row_count)
+                    rows = []
+
+                if insert is not None:
+                    prefix, table, rows = insert[0], insert[1], [insert[2]]
+                    row_count = len(ROW_RE.findall(insert[2]))
+                    size = len(prefix) + len(insert[2])
+                else:
+                    prefix = None
+                    self._barrier()
+                    connection.execute(statement, rows=None)
+                    if self.jobs > 1:
+                        connection.commit()
+
+            if rows:
+                self._insert(connection, table, prefix + ','.join(rows), row_count)
+        finally:
+            self._stop_workers()
+            connection.close()
+
+        if self._failures:
+            raise self._failures[0]
+
+    def _insert(self, connection, table, statement, rows):
+        if self.jobs > 1:
+            if self._failures:
+                raise self._failures[0]
+            self._queues[hash(table) % self.jobs].put((statement, rows))
+        else:
+            connection.execute(statement, rows)
+
+    def _start_workers(self):
+        for _ in range(self.jobs):
+            work_queue = queue.Queue(maxsize=4)
+            worker = threading.Thread(target=self._worker, args=(work_queue,), daemon=True)
+            worker.start()
+            self._queues.append(work_queue)
+            self._workers.append(worker)
+
+    def _worker(self, work_queue):
+        connection = None
+        while True:
+            item = work_queue.get()
+            try:
+                if item is None:
+                    break
+                elif self._failures:
+                    continue
+                if connection is None:
+                    connection = _ImportConnection(self)
+                if item == 'commit':
+                    connection.commit()
+                else:
+                    connection.execute(*item)
+            except Exception as exc:
+                self._failures.append(exc)
+            finally:
+                work_queue.task_done()
+        if connection is not None:
+            connection.close()
+
+    def _barrier(self):
+        """Commit and wait for all the INSERTs handed to workers so far."""
+        for work_queue in self._queues:
+            work_queue.put('commit')
+        for work_queue in self._queues:
+            work_queue.join()
+
+    def _stop_workers(self):
+        for work_queue in self._queues:
+            work_queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._queues, self._workers = [], []
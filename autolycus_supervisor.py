@@ -0,0 +1,265 @@
+import asyncio
+from collections import deque
+import json
+import logging
+import os
+import signal
+import socket
+from time import monotonic, time
+
+from autolycus_process import wait_for_port
+
+logger = logging.getLogger('autolycus')
+
+
+class ServerState(object):
+    """What the supervisor knows about one server."""
+
+    def __init__(self, name):
+        self.name = name
+        self.state = 'stopped'
+        self.pid = None
+        self.started_at = None
+        self.restarts = 0
+        self.last_exit_code = None
+        self.backoff = 0
+        # monotonic times of recent crashes, for crash loop detection
+        self.crashes = deque()
+
+    def to_dict(self):
+        return {'state': self.state,
+                'pid': self.pid,
+                'started_at': self.started_at,
+                'uptime': time() - self.started_at if self.state == 'running' else None,
+                'restarts': self.restarts,
+                'last_exit_code': self.last_exit_code}
+
+
+class Supervisor(object):
+    """Keep the Hercules servers running from a single resident process.
+
+    Each server is started through Autolycus._run_executable, in dependency order, and then
+    watched by a task that waits on the process and restarts it as soon as it exits. Restarts
+    back off exponentially, and a server that crashes too often within a time window is
+    considered to be crash looping and is left stopped. A server is only (re)started while the
+    server it depends on accepts connections, and is blocked if that one is given up on. The
+    current state of all servers is served as JSON to anything connecting to the status socket.
+
+    Args:
+        autolycus (Autolycus): The Autolycus instance for the installation to supervise.
+        socket_path (str): The path of the Unix socket to serve status on.
+        status_port (int, optional): Serve status on this TCP port on localhost instead of the
+            Unix socket, e.g. on systems without Unix sockets.
+        backoff_initial (float, optional): The delay before the first restart, in seconds.
+        backoff_max (float, optional): The longest delay between restarts, in seconds.
+        stable_after (float, optional): How long a server has to run for the restart delay to
+            be reset, in seconds.
+        crash_limit (int, optional): How many crashes within crash_window count as a crash loop.
+        crash_window (float, optional): The crash loop detection window, in seconds.
+        start_timeout (float, optional): How long to wait for a server to accept connections.
+    """
+
+    def __init__(self, autolycus, socket_path, status_port=None, backoff_initial=1,
+                 backoff_max=60, stable_after=60, crash_limit=5, crash_window=300,
+                 start_timeout=60):
+        self.autolycus = autolycus
+        self.socket_path = socket_path
+        self.status_port = status_port
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.stable_after = stable_after
+        self.crash_limit = crash_limit
+        self.crash_window = crash_window
+        self.start_timeout = start_timeout
+
+        self.servers = {server: ServerState(server) for server in autolycus.servers}
+        # Set while a server accepts connections, and once it is given up on, respectively.
+        self._ready = {server: None for server in autolycus.servers}
+        self._given_up = {server: None for server in autolycus.servers}
+        self._stopping = None
+
+    def status(self):
+        """Get the state of all supervised servers as a dictionary."""
+        return {'pid': os.getpid(),
+                'servers': {name: server.to_dict() for name, server in self.servers.items()}}
+
+    async def _blocking(self, function, *args):
+        """Run a blocking function in a worker thread."""
+        return await asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+    async def run(self):
+        """Start and supervise the servers until the supervisor receives SIGTERM or SIGINT."""
+        loop = asyncio.get_event_loop()
+        self._stopping = asyncio.Event()
+        self._ready = {server: asyncio.Event() for server in self.servers}
+        self._given_up = {server: asyncio.Event() for server in self.servers}
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(signum, self._stopping.set)
+            except NotImplementedError:
+                # Windows: rely on KeyboardInterrupt instead.
+                pass
+
+        status_server = await self._start_status_server()
+        status_address = self.socket_path if self.status_port is None else \
+            f'127.0.0.1:{self.status_port}'
+        logger.info(f'Supervising {", ".join(self.servers)}; status on {status_address}.')
+        tasks = [asyncio.ensure_future(self._supervise(server))
+                 for server in self.autolycus._start_order()]
+        try:
+            await self._stopping.wait()
+        finally:
+            logger.info('Supervisor shutting down, stopping servers.')
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self._blocking(self.autolycus._kill_servers, self.autolycus.servers)
+            status_server.close()
+            await status_server.wait_closed()
+            if self.status_port is None and os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    async def _wait_for_dependency(self, name, dependency):
+        """Wait until the server a server depends on accepts connections.
+
+        Returns:
+            bool: Whether the dependency is ready; False if it was given up on.
+        """
+        if self._ready[dependency].is_set():
+            return True
+        self.servers[name].state = 'waiting'
+        logger.info(f'{name} is waiting for {dependency} to accept connections.')
+        waits = [asyncio.ensure_future(self._ready[dependency].wait()),
+                 asyncio.ensure_future(self._given_up[dependency].wait())]
+        try:
+            await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for wait in waits:
+                wait.cancel()
+        return self._ready[dependency].is_set()
+
+    async def _supervise(self, name):
+        """Start a server once its dependency is ready and restart it whenever it exits."""
+        server = self.servers[name]
+        dependency = self.autolycus.server_dependencies.get(name)
+
+        while True:
+            if dependency is not None and not await self._wait_for_dependency(name, dependency):
+                server.state = 'blocked'
+                logger.error(f'Not starting {name}: {dependency} was given up on.',
+                             extra={'server': name})
+                self._given_up[name].set()
+                return
+
+            server.state = 'starting'
+            try:
+                proc = await self._blocking(self.autolycus._run_executable, name)
+                server.pid, server.started_at = proc.pid, time()
+                host, port = self.autolycus._server_address(name)
+                latency = await self._blocking(wait_for_port, proc, host, port,
+                                               self.start_timeout)
+                logger.info(f'{name} accepting connections on {host}:{port} after '
+                            f'{latency:.2f}s.', extra={'server': name, 'pid': proc.pid,
+                                                       'operation': 'start', 'duration': latency})
+                server.state = 'running'
+                self._ready[name].set()
+                started = monotonic()
+                server.last_exit_code = await self._blocking(proc.wait)
+                self._ready[name].clear()
+                logger.error(f'{name} (pid {proc.pid}) exited with code '
+                             f'{server.last_exit_code}!', extra={'server': name, 'pid': proc.pid})
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                self._ready[name].clear()
+                logger.error(f'Failed to run {name}! Reason: {exc}')
+                started = monotonic()
+                # Don't leave a server that never became ready running behind.
+                await self._blocking(self.autolycus._kill_server, name)
+
+            server.pid = None
+
+            if monotonic() - started >= self.stable_after:
+                server.backoff = 0
+            if not self._record_crash(server):
+                self._given_up[name].set()
+                return
+
+            server.state = 'backoff'
+            server.backoff = min(self.backoff_max,
+                                 server.backoff * 2 if server.backoff else self.backoff_initial)
+            logger.info(f'Restarting {name} in {server.backoff:.0f} seconds.')
+            await asyncio.sleep(server.backoff)
+            server.restarts += 1
+
+    def _record_crash(self, server):
+        """Remember a crash and check whether the server is crash looping.
+
+        Returns:
+            bool: Whether the server should be restarted.
+        """
+        now = monotonic()
+        server.crashes.append(now)
+        while server.crashes and now - server.crashes[0] > self.crash_window:
+            server.crashes.popleft()
+        if len(server.crashes) >= self.crash_limit:
+            server.state = 'failed'
+            server.pid = None
+            logger.critical(f'{server.name} crashed {len(server.crashes)} times within '
+                            f'{self.crash_window} seconds; not restarting it again.')
+            return False
+        return True
+
+    async def _start_status_server(self):
+        """Serve status on the TCP port if one was given, or on the Unix socket otherwise.
+
+        Raises:
+            OSError: There is no port and the system doesn't have Unix sockets.
+        """
+        if self.status_port is not None:
+            return await asyncio.start_server(self._send_status, host='127.0.0.1',
+                                              port=self.status_port)
+        if not hasattr(socket, 'AF_UNIX'):
+            raise OSError('Unix sockets are not available on this system; serve status on a '
+                          'TCP port with --status_port instead.')
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        return await asyncio.start_unix_server(self._send_status, path=self.socket_path)
+
+    async def _send_status(self, reader, writer):
+        try:
+            writer.write(json.dumps(self.status()).encode() + b'\n')
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+def read_status(socket_path, status_port=None):
+    """Read the status from a running supervisor.
+
+    Args:
+        socket_path (str): The path of the supervisor's status socket.
+        status_port (int, optional): The TCP port on localhost the supervisor serves status
+            on, if it was started with one; the socket path is ignored then.
+
+    Raises:
+        OSError: The supervisor can't be reached, or there is no port and the system doesn't
+            have Unix sockets.
+
+    Returns:
+        dict: The supervisor's status, see Supervisor.status().
+    """
+    if status_port is not None:
+        client = socket.create_connection(('127.0.0.1', status_port))
+    elif hasattr(socket, 'AF_UNIX'):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(socket_path)
+        except OSError:
+            client.close()
+            raise
+    else:
+        raise OSError('Unix sockets are not available on this system; read status from a '
+                      'TCP port with --status_port instead.')
+    with client, client.makefile('rb') as status:
+        return json.loads(status.readline())
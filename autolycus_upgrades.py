@@ -0,0 +1,157 @@
+import datetime
+import hashlib
+import os
+import re
+
+from sqlalchemy import text
+
+LEDGER_TABLE = 'autolycus_upgrades'
+# Hercules names upgrade files after their creation date, e.g. 2020-05-01--12-30.sql.
+UPGRADE_NAME_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})--(\d{2})-(\d{2})\.sql$')
+
+CREATE_LEDGER = f"""CREATE TABLE IF NOT EXISTS {LEDGER_TABLE} (
+    file_name VARCHAR(255) NOT NULL PRIMARY KEY,
+    checksum CHAR(64) NULL,
+    status VARCHAR(16) NOT NULL,
+    errors INT NOT NULL DEFAULT 0,
+    duration FLOAT NULL,
+    applied_at DATETIME NOT NULL
+)"""
+
+
+def parse_upgrade_name(file_name):
+    """Get the date of an upgrade file from its name.
+
+    Args:
+        file_name (str): The name or path of the upgrade file.
+    Returns:
+        datetime.datetime: The date in the file name, or None if the name isn't in the format
+            Hercules uses for upgrade files.
+    """
+    match = UPGRADE_NAME_RE.match(os.path.basename(file_name))
+    if match is None:
+        return None
+    try:
+        return datetime.datetime(*map(int, match.groups()))
+    except ValueError:
+        return None
+
+
+def file_checksum(file_name):
+    """Get the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as data:
+        for block in iter(lambda: data.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class UpgradeLedger(object):
+    """The record of which SQL upgrade files have been applied to a database.
+
+    Every upgrade file is recorded in the autolycus_upgrades table when it is started, with the
+    checksum of its contents, and marked as applied with the time it took and the number of
+    failed statements once it is done. A file still marked as started was interrupted.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): The database the upgrades are applied to.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        with self.engine.begin() as connection:
+            connection.execute(text(CREATE_LEDGER))
+
+    def entries(self):
+        """Read the whole ledger.
+
+        Returns:
+            dict: File names mapped to dictionaries of their checksum, status, errors,
+                duration and applied_at.
+        """
+        with self.engine.connect() as connection:
+            result = connection.execute(text(
+                f'SELECT file_name, checksum, status, errors, duration, applied_at '
+                f'FROM {LEDGER_TABLE}'))
+            return {row.file_name: row._asdict() for row in result}
+
+    def record_baseline(self, file_names):
+        """Record upgrade files as applied without running them.
+
+        This is for installations that applied upgrades before the ledger existed.
+        """
+        if not file_names:
+            return
+        now = datetime.datetime.now()
+        with self.engine.begin() as connection:
+            connection.execute(
+                text(f'INSERT INTO {LEDGER_TABLE} (file_name, status, applied_at) '
+                     'VALUES (:file_name, :status, :applied_at)'),
+                [{'file_name': file_name, 'status': 'baseline', 'applied_at': now}
+                 for file_name in file_names])
+
+    def start(self, file_name, checksum):
+        """Record that an upgrade file is being applied."""
+        with self.engine.begin() as connection:
+            connection.execute(text(f'DELETE FROM {LEDGER_TABLE} WHERE file_name = :file_name'),
+                               {'file_name': file_name})
+            connection.execute(
+                text(f'INSERT INTO {LEDGER_TABLE} (file_name, checksum, status, applied_at) '
+                     'VALUES (:file_name, :checksum, :status, :applied_at)'),
+                {'file_name': file_name, 'checksum': checksum, 'status': 'started',
+                 'applied_at': datetime.datetime.now()})
+
+    def finish(self, file_name, duration, errors):
+        """Record that an upgrade file has been applied."""
+        with self.engine.begin() as connection:
+            connection.execute(
+                text(f'UPDATE {LEDGER_TABLE} SET status = :status, duration = :duration, '
+                     'errors = :errors, applied_at = :applied_at WHERE file_name = :file_name'),
+                {'file_name': file_name, 'status': 'applied', 'duration': duration,
+                 'errors': errors, 'applied_at': datetime.datetime.now()})
+
+
+def plan_upgrades(upgrade_dir, entries, logger):
+    """Work out which upgrade files still need to be applied.
+
+    Files that were applied are checked against the checksum recorded when they were, and a
+    warning is logged for every one that has changed since; they are not applied again.
+
+    Args:
+        upgrade_dir (str): The directory containing the upgrade files.
+        entries (dict): The ledger entries, see UpgradeLedger.entries().
+        logger (logging.Logger): Where to log files that are ignored or have changed.
+    Returns:
+        tuple: The paths of the upgrade files that have not been applied yet and those that
+            were interrupted, both oldest first.
+    """
+    upgrades = []
+    try:
+        files = list(os.scandir(upgrade_dir))
+    except IOError:
+        logger.warning(f'Upgrade directory {upgrade_dir} does not exist.')
+        files = []
+    for entry in files:
+        if not entry.name.endswith('.sql'):
+            continue
+        upgrade_date = parse_upgrade_name(entry.name)
+        if upgrade_date is None:
+            logger.warning(f'Failed to parse upgrade date for {entry.path} - ignoring file.')
+            continue
+        upgrades.append((upgrade_date, entry.name, entry.path))
+    upgrades.sort()
+
+    for _, name, path in upgrades:
+        entry = entries.get(name)
+        # Files recorded as a baseline were never checksummed.
+        if entry is None or entry['status'] != 'applied' or entry['checksum'] is None:
+            continue
+        if file_checksum(path) != entry['checksum']:
+            logger.warning(f'{path} has changed since it was applied on {entry["applied_at"]}! '
+                           'The changes are not applied; apply them by hand, or delete its row '
+                           f'from {LEDGER_TABLE} to run the whole file again.')
+
+    pending = [path for _, name, path in upgrades if name not in entries]
+    interrupted = [path for _, name, path in upgrades
+                   if entries.get(name, {}).get('status') == 'started']
+    return pending, interrupted
@@ -0,0 +1,256 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+from time import monotonic, sleep
+
+logger = logging.getLogger('autolycus')
+
+# Which servers read the files in each directory under conf/.
+DIRECTORY_SERVERS = {'map': ['map-server'],
+                     'char': ['char-server'],
+                     'login': ['login-server'],
+                     'global': ['login-server', 'char-server', 'map-server']}
+# Files read by other servers than their directory suggests, wherever they are.
+FILE_SERVERS = {'sql_connection.conf': ['login-server', 'char-server', 'map-server'],
+                'console.conf': ['login-server', 'char-server', 'map-server'],
+                'socket.conf': ['login-server', 'char-server', 'map-server'],
+                'plugins.conf': ['login-server', 'char-server', 'map-server'],
+                'inter-server.conf': ['char-server', 'map-server'],
+                'map-index.conf': ['char-server', 'map-server']}
+# Everything else directly in conf/ (atcommands, channels, groups, messages, motd...) is read
+# by the map-server.
+DEFAULT_SERVERS = ['map-server']
+
+# Names of files that are not configuration: Autolycus' own state, and the temporary and
+# backup files of editors and atomic writes.
+IGNORED_NAMES = {'autolycus_config.json', 'autolycus_config.json.lock', '4913'}
+IGNORED_SUFFIXES = ('~', '.swp', '.swx', '.tmp', '.bak', '.lock')
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+    IN_DELETE_SELF
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def is_config_file(path):
+    name = os.path.basename(path)
+    return not (name.startswith('.') or name in IGNORED_NAMES or name.endswith(IGNORED_SUFFIXES))
+
+
+def servers_for_config(path, conf_path, servers):
+    """Work out which servers read a configuration file.
+
+    Overrides in conf/import are treated like the default file of the same name elsewhere in
+    conf/. Files nobody is known to read are assumed to be read by all servers.
+
+    Args:
+        path (str): The path of the configuration file.
+        conf_path (str): The path of the conf directory.
+        servers (list): All the servers, in the order to return them in.
+    Returns:
+        list: The servers that need to be restarted for a change to the file to take effect.
+    """
+    name = os.path.basename(path)
+    relative = os.path.relpath(path, conf_path).split(os.sep)
+    if relative == ['.']:
+        # The whole tree may have changed.
+        readers = servers
+    elif name in FILE_SERVERS:
+        readers = FILE_SERVERS[name]
+    elif relative[0] == 'import':
+        for dir_path, dir_names, file_names in os.walk(conf_path):
+            if dir_path == conf_path:
+                dir_names[:] = [dir_name for dir_name in dir_names if dir_name != 'import']
+            if name in file_names:
+                return servers_for_config(os.path.join(dir_path, name), conf_path, servers)
+        readers = servers
+    elif len(relative) > 1:
+        readers = DIRECTORY_SERVERS.get(relative[0], servers)
+    else:
+        readers = DEFAULT_SERVERS
+    return [server for server in servers if server in readers]
+
+
+class InotifyWatcher(object):
+    """Watch a directory tree for changed files with Linux' inotify.
+
+    Every directory in the tree is watched, including ones created later. The kernel queues
+    events while nothing is reading, so no change is missed between two calls of changes().
+
+    Args:
+        root (str): The directory to watch.
+    Raises:
+        OSError: inotify is not available.
+    """
+
+    def __init__(self, root):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError('Failed to find the C library!')
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError('inotify is not available!')
+        self._libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self.root = root
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # watch descriptor -> directory
+        self._watches = {}
+        self._add_tree(root)
+
+    def _add_tree(self, root):
+        for dir_path, dir_names, file_names in os.walk(root):
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(dir_path), WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC:
+                    raise OSError(error, 'Out of inotify watches; raise '
+                                         'fs.inotify.max_user_watches')
+                continue
+            self._watches[wd] = dir_path
+
+    def changes(self, timeout):
+        """Wait for changes.
+
+        Args:
+            timeout (float): How long to wait for the first change, in seconds.
+        Returns:
+            set: The paths of the files that were created, changed, moved or deleted.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                logger.warning('Missed configuration changes; assuming every file changed.')
+                changed.add(self.root)
+                continue
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_DELETE_SELF:
+                del self._watches[wd]
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add_tree(path)
+                continue
+            changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """Watch a directory tree for changed files by comparing their stats every interval.
+
+    This works everywhere, including network file systems that inotify can't see changes on.
+
+    Args:
+        root (str): The directory to watch.
+        interval (float, optional): How often to look for changes, in seconds.
+    """
+
+    def __init__(self, root, interval=1):
+        self.root = root
+        self.interval = interval
+        self._stats = self._scan()
+
+    def _scan(self):
+        stats = {}
+        for dir_path, dir_names, file_names in os.walk(self.root):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                stats[path] = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        return stats
+
+    def changes(self, timeout):
+        deadline = monotonic() + timeout
+        while True:
+            sleep(max(0, min(self.interval, deadline - monotonic())))
+            stats = self._scan()
+            changed = {path for path in stats.keys() | self._stats.keys()
+                       if stats.get(path) != self._stats.get(path)}
+            self._stats = stats
+            if changed or monotonic() >= deadline:
+                return changed
+
+    def close(self):
+        pass
+
+
+def create_watcher(root, poll=False, interval=1):
+    """Watch a directory tree with inotify if possible, or by polling it otherwise."""
+    if not poll:
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError) as exc:
+            logger.warning(f'Falling back to polling for changes in {root}. Reason: {exc}')
+    return PollingWatcher(root, interval)
+
+
+def watch_changes(watcher, debounce=1, max_delay=10):
+    """Yield the configuration files changed in bursts of edits.
+
+    A burst ends once no file has changed for the debounce time, so saving several files or
+    an editor's write-rename-chmod sequence only counts once, or after max_delay seconds if
+    edits keep coming.
+
+    Args:
+        watcher (InotifyWatcher or PollingWatcher): Where to get changes from.
+        debounce (float, optional): How long to wait for more changes, in seconds.
+        max_delay (float, optional): The longest to wait for a burst to end, in seconds.
+    Yields:
+        set: The paths of the configuration files changed in each burst.
+    """
+    while True:
+        changed = {path for path in watcher.changes(3600) if is_config_file(path)}
+        if not changed:
+            continue
+        # Events for ignored files and directories don't end the burst early; only a quiet
+        # debounce period without relevant changes does.
+        max_deadline = monotonic() + max_delay
+        quiet_until = monotonic() + debounce
+        while True:
+            now = monotonic()
+            timeout = min(quiet_until, max_deadline) - now
+            if timeout <= 0:
+                break
+            more = {path for path in watcher.changes(timeout) if is_config_file(path)}
+            if more:
+                changed |= more
+                quiet_until = monotonic() + debounce
+        yield changed
@@ -0,0 +1,196 @@
+from collections import OrderedDict
+import hashlib
+import hmac
+import itertools
+import json
+import logging
+import queue
+import threading
+from time import time
+
+from flask import Flask, Response, abort, jsonify, request, url_for
+
+logger = logging.getLogger('autolycus')
+
+# How many finished control jobs to remember.
+JOB_HISTORY = 100
+
+
+class StatusCache(object):
+    """The server status, refreshed in the background and shared by all requests.
+
+    A single thread checks the status every interval, so the cost of the process table scan
+    and the database check doesn't depend on how many clients are looking at it. Requests are
+    answered from the last serialised status.
+
+    Values that change on every check (uptimes, latencies and how long the check took) are left
+    out, so the status and its ETag only change when something actually happens and polling
+    clients mostly get 304 Not Modified. Uptimes can be worked out from started_at.
+
+    Args:
+        autolycus (Autolycus): The installation to check the status of.
+        interval (float, optional): Seconds between refreshes.
+        timeout (float, optional): How long each status check may take, in seconds.
+    """
+
+    def __init__(self, autolycus, interval=2, timeout=5):
+        self.autolycus = autolycus
+        self.interval = interval
+        self.timeout = timeout
+        # (body, etag); replaced as a whole so readers never see a mismatched pair.
+        self.current = None
+        self._refresh_now = threading.Event()
+        self._ready = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='status-refresher', daemon=True)
+        self._thread.start()
+
+    def refresh(self):
+        """Refresh the status as soon as possible, e.g. after a server was started."""
+        self._refresh_now.set()
+
+    def get(self, timeout=None):
+        """Get the serialised status and its ETag, waiting for the first refresh if needed."""
+        self._ready.wait(timeout)
+        return self.current
+
+    def _run(self):
+        while True:
+            self._refresh_now.clear()
+            try:
+                status = self.autolycus._status(self.timeout)
+                del status['elapsed']
+                del status['database']['latency']
+                for server in status['servers'].values():
+                    del server['uptime']
+                body = json.dumps(status, sort_keys=True).encode()
+                if self.current is None or body != self.current[0]:
+                    self.current = (body, hashlib.sha1(body).hexdigest())
+                self._ready.set()
+            except Exception as exc:
+                logger.error(f'Failed to refresh server status! Reason: {exc}')
+            self._refresh_now.wait(self.interval)
+
+
+class ControlQueue(object):
+    """Run control actions one at a time, outside of the request threads.
+
+    Requests only queue an action and get a job to poll, so no request waits for servers to
+    start or stop and two actions never run at the same time.
+
+    Args:
+        actions (dict): Action names mapped to functions without arguments.
+        status_cache (StatusCache, optional): A status cache to refresh after each action.
+    """
+
+    def __init__(self, actions, status_cache=None):
+        self.actions = actions
+        self.status_cache = status_cache
+        self.jobs = OrderedDict()
+        self._ids = itertools.count(1)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='control-queue', daemon=True)
+        self._thread.start()
+
+    def submit(self, action):
+        """Queue an action.
+
+        Raises:
+            KeyError: There is no such action.
+        Returns:
+            dict: The job for the action.
+        """
+        if action not in self.actions:
+            raise KeyError(f'Unknown action {action}!')
+        with self._lock:
+            job = {'id': next(self._ids), 'action': action, 'state': 'queued', 'error': None,
+                   'queued_at': time(), 'started_at': None, 'finished_at': None}
+            self.jobs[job['id']] = job
+            while len(self.jobs) > JOB_HISTORY:
+                self.jobs.popitem(last=False)
+        self._queue.put(job)
+        return dict(job)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            # Requests copy jobs under the lock, so only change them while holding it, and
+            # finish them in one go so nobody sees a job that is done but has no finished_at.
+            with self._lock:
+                job.update(state='running', started_at=time())
+            logger.info(f'Running queued {job["action"]} (job {job["id"]}).')
+            try:
+                self.actions[job['action']]()
+                outcome = {'state': 'done'}
+            except Exception as exc:
+                logger.error(f'Failed to {job["action"]} (job {job["id"]})! Reason: {exc}')
+                outcome = {'state': 'failed', 'error': str(exc)}
+            with self._lock:
+                job.update(outcome, finished_at=time())
+            if self.status_cache is not None:
+                self.status_cache.refresh()
+
+
+def create_app(status_cache, control_queue, token=None):
+    """Create the web API.
+
+    GET /api/status returns the cached status with an ETag and answers If-None-Match with 304
+    Not Modified. POST /api/servers/<action> queues start, stop or restart and returns the job,
+    which can be polled at GET /api/jobs/<id>.
+
+    Args:
+        status_cache (StatusCache): The running status cache.
+        control_queue (ControlQueue): The running control queue.
+        token (str, optional): If given, control requests need the header
+            "Authorization: Bearer <token>".
+    Returns:
+        flask.Flask: The application.
+    """
+    app = Flask('autolycus')
+
+    @app.get('/api/status')
+    def status():
+        current = status_cache.get(timeout=status_cache.timeout + 1)
+        if current is None:
+            abort(503)
+        body, etag = current
+        response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+
+    @app.post('/api/servers/<action>')
+    def control(action):
+        if token is not None:
+            expected = f'Bearer {token}'.encode()
+            if not hmac.compare_digest(request.headers.get('Authorization', '').encode(),
+                                       expected):
+                abort(401)
+        try:
+            job = control_queue.submit(action)
+        except KeyError:
+            abort(404)
+        response = jsonify(job)
+        response.status_code = 202
+        response.headers['Location'] = url_for('job', job_id=job['id'])
+        return response
+
+    @app.get('/api/jobs/<int:job_id>')
+    def job(job_id):
+        job = control_queue.get(job_id)
+        if job is None:
+            abort(404)
+        return jsonify(job)
+
+    return app
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Compare the libconfig parser against the old regex-based setting lookup.
+
+Run this against a Hercules installation, e.g.:
+
+    benchmarks/bench_config_parser.py -p /path/to/Hercules
+
+For every file in the conf tree this looks up every setting it contains, once with the regex
+search HerculesConfig.get used to do per lookup and once by parsing the file and querying the
+resulting document. It also checks every file serialises back byte-identically.
+"""
+
+import argparse
+import glob
+import os
+import re
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from hercules_libconfig import Document, ParseError  # noqa: E402
+
+
+def regex_lookup(file_name, setting):
+    """The lookup HerculesConfig.get used before the parser: read the file and regex it."""
+    with open(file_name, 'r') as conffile:
+        configuration = conffile.read()
+    matches = re.search(r'\s*%s\s*:\s*(.*)' % setting, configuration)
+    return matches.groups()[0] if matches else None
+
+
+def parser_lookups(file_name, settings):
+    document = Document.load(file_name)
+    return [document.get_raw(setting) for setting in settings]
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-p', '--hercules_path', default='.',
+                        help='The path containing the Hercules installation to read.')
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help='How many times to repeat each measurement (best time is used).')
+    args = parser.parse_args()
+
+    conf_files = sorted(glob.glob(os.path.join(args.hercules_path, 'conf', '**', '*.conf'),
+                                  recursive=True))
+    if not conf_files:
+        sys.exit(f'No .conf files found in {args.hercules_path}/conf!')
+
+    total_bytes = regex_time = parser_time = parse_only_time = 0
+    total_settings = round_trip_failures = parse_failures = 0
+
+    for file_name in conf_files:
+        try:
+            document = Document.load(file_name)
+        except ParseError as exc:
+            print(f'Skipping unparseable file: {exc}')
+            parse_failures += 1
+            continue
+
+        with open(file_name, 'r', newline='') as conffile:
+            if conffile.read() != document.dumps():
+                print(f'Round trip mismatch: {file_name}')
+                round_trip_failures += 1
+
+        settings = sorted({name for path, _ in document.walk() for name in path[-1:]})
+        total_settings += len(settings)
+        total_bytes += os.path.getsize(file_name)
+
+        best = float('inf')
+        for _ in range(args.repeat):
+            start = perf_counter()
+            for setting in settings:
+                regex_lookup(file_name, setting)
+            best = min(best, perf_counter() - start)
+        regex_time += best
+
+        best = float('inf')
+        for _ in range(args.repeat):
+            start = perf_counter()
+            parser_lookups(file_name, settings)
+            best = min(best, perf_counter() - start)
+        parser_time += best
+
+        best = float('inf')
+        for _ in range(args.repeat):
+            start = perf_counter()
+            Document.load(file_name)
+            best = min(best, perf_counter() - start)
+        parse_only_time += best
+
+    print(f'Files: {len(conf_files)} ({total_bytes / 1024:.0f} KiB), settings: {total_settings}')
+    print(f'Parse failures: {parse_failures}, round trip mismatches: {round_trip_failures}')
+    print(f'Parse throughput: {total_bytes / 1024 / 1024 / parse_only_time:.2f} MiB/s')
+    print(f'Regex lookup of every setting:  {regex_time * 1000:10.1f} ms')
+    print(f'Parse once, look up every one:  {parser_time * 1000:10.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
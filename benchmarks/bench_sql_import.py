@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Compare SQL import speed with and without the bulk-load options of import_sql.
+
+This generates a dump of single-row INSERTs into several tables, one table after the other like
+mysqldump writes them, and imports it with each configuration in turn, starting with the way
+import_sql ran statements before SQLImporter (each through dataset's db.query), e.g.:
+
+    benchmarks/bench_sql_import.py --rows 50000
+    benchmarks/bench_sql_import.py --url mysql://ragnarok:ragnarok@db/bench --jobs 4
+
+The default database is a throwaway SQLite file, which shows the effect of batching and
+coalescing but not of network latency, where the difference is far larger.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import dataset  # noqa: E402
+import sqlalchemy  # noqa: E402
+
+from autolycus_sql import SQLImporter, SQLStatementReader  # noqa: E402
+
+
+def write_dump(file_name, rows, tables):
+    with open(file_name, 'w') as dump:
+        for table in range(tables):
+            dump.write(f'DROP TABLE IF EXISTS bench_{table};\n')
+            dump.write(f'CREATE TABLE bench_{table} (id INT PRIMARY KEY, name VARCHAR(50), '
+                       f'script TEXT, price INT);\n')
+        # Like mysqldump, all the rows of one table come before those of the next, so runs of
+        # INSERTs into the same table can be coalesced.
+        for table in range(tables):
+            for row in range(table, rows, tables):
+                dump.write(f"INSERT INTO `bench_{table}` VALUES ({row}, 'Item_{row}', "
+                           f"'bonus bStr,1; bonus bAgi,{row % 10};', {row * 10});\n")
+
+
+class DatasetImporter(object):
+    """The import_sql code path SQLImporter replaced, as the baseline to compare it with.
+
+    Every statement is run on its own through dataset's db.query, inside the transaction that
+    dataset opens for the with block. Every INSERT of the generated dump is a single row.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.rows = 0
+        self.errors = 0
+
+    def run(self, statements):
+        with dataset.connect(self.url) as db:
+            for statement in statements:
+                try:
+                    db.query(statement)
+                except Exception:
+                    self.errors += 1
+                    continue
+                if statement.startswith('INSERT'):
+                    self.rows += 1
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--url', help='The database to import into. Tables named bench_* will '
+                                      'be dropped and recreated. Defaults to a temporary SQLite '
+                                      'database.')
+    parser.add_argument('--rows', type=int, default=20000, help='How many rows to import.')
+    parser.add_argument('--tables', type=int, default=4, help='How many tables to spread them '
+                                                              'over.')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Also run the bulk configuration with this many connections.')
+    args = parser.parse_args()
+
+    logger = logging.getLogger('autolycus')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        dump_file = os.path.join(temp_dir, 'bench.sql')
+        write_dump(dump_file, args.rows, args.tables)
+        url = args.url or f'sqlite:///{os.path.join(temp_dir, "bench.db")}'
+        engine = sqlalchemy.create_engine(url)
+
+        configurations = [
+            ('before SQLImporter: dataset db.query', None),
+            ('one statement per transaction', {}),
+            ('1000 statements per transaction', {'batch_size': 1000}),
+            ('batched, 500-row INSERTs', {'batch_size': 1000, 'coalesce_rows': 500}),
+            ('batched, 500-row INSERTs, no checks', {'batch_size': 1000, 'coalesce_rows': 500,
+                                                     'disable_checks': True}),
+        ]
+        if args.jobs > 1 and engine.dialect.name == 'sqlite':
+            print('Ignoring --jobs: SQLite only allows one writer at a time.')
+        elif args.jobs > 1:
+            configurations.append((f'all of the above, {args.jobs} connections',
+                                   {'batch_size': 1000, 'coalesce_rows': 500,
+                                    'disable_checks': True, 'jobs': args.jobs}))
+
+        print(f'Importing {args.rows} rows into {args.tables} tables on {engine.url!r}')
+        for name, options in configurations:
+            if options is None:
+                importer = DatasetImporter(url)
+            else:
+                importer = SQLImporter(engine, logger, **options)
+            start = perf_counter()
+            with open(dump_file, 'rb') as sql_file:
+                importer.run(SQLStatementReader(sql_file))
+            elapsed = perf_counter() - start
+            print(f'{name:45} {elapsed:8.2f}s {importer.rows / elapsed:12.0f} rows/s'
+                  f'{"" if not importer.errors else f" ({importer.errors} errors)"}')
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Check how long autolycus.py takes to start for commands that should be quick.
+
+Health checks and scripts run these commands often, so their cost is dominated by interpreter
+start-up and imports. Every command is run several times against an empty Hercules directory
+and its median wall time over a bare `python -c pass` is compared to a budget, e.g.:
+
+    benchmarks/bench_startup.py
+    benchmarks/bench_startup.py --runs 20 --scale 2
+
+The heaviest imports of every command are listed from `python -X importtime`, which is the
+place to look when a budget is exceeded. Exits with status 1 if any command is over budget.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+AUTOLYCUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'autolycus.py')
+
+# Command line and budget in milliseconds of start-up time on top of the bare interpreter.
+COMMANDS = [(['--help'], 50),
+            (['logs', 'map-server', '--since', '10m'], 50),
+            (['stop'], 50)]
+
+
+def run(arguments, hercules_path, import_time=False):
+    command = [sys.executable] + (['-X', 'importtime'] if import_time else []) + arguments
+    started = perf_counter()
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            cwd=hercules_path)
+    return perf_counter() - started, result.stderr.decode(errors='replace')
+
+
+def median_time(arguments, hercules_path, runs):
+    return statistics.median(run(arguments, hercules_path)[0] for _ in range(runs))
+
+
+def heaviest_imports(arguments, hercules_path, baseline, count=5):
+    """Get the slowest top-level imports of a command that the bare interpreter doesn't do."""
+    _, output = run(arguments, hercules_path, import_time=True)
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Nested imports are indented under the module that imported them.
+        if name.startswith('  ') or name.strip() in baseline:
+            continue
+        imports.append((int(cumulative) / 1000, name.strip()))
+    return sum(time for time, _ in imports), sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10,
+                        help='How many times to run each command.')
+    parser.add_argument('--scale', type=float, default=1,
+                        help='Multiply all budgets by this, for slow machines.')
+    args = parser.parse_args()
+
+    over_budget = False
+    with tempfile.TemporaryDirectory() as hercules_path:
+        baseline_time = median_time(['-c', 'pass'], hercules_path, args.runs)
+        _, baseline_output = run(['-c', 'pass'], hercules_path, import_time=True)
+        baseline = {line.split('|')[2].strip() for line in baseline_output.splitlines()
+                    if line.startswith('import time:') and 'cumulative' not in line}
+        print(f'python -c pass: {baseline_time * 1000:.1f}ms (subtracted from the times below)')
+
+        for arguments, budget in COMMANDS:
+            budget *= args.scale
+            command = [AUTOLYCUS, '-p', hercules_path] + arguments
+            startup = (median_time(command, hercules_path, args.runs) - baseline_time) * 1000
+            import_total, imports = heaviest_imports(command, hercules_path, baseline)
+            verdict = 'ok' if startup <= budget else 'OVER BUDGET'
+            over_budget = over_budget or startup > budget
+            print(f'autolycus.py {" ".join(arguments)}: {startup:.1f}ms of {budget:.0f}ms budget '
+                  f'({verdict}); imports {import_total:.1f}ms')
+            for time, name in imports:
+                print(f'    {time:7.1f}ms {name}')
+
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == '__main__':
+    main()
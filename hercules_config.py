@@ -1,7 +1,12 @@
-import glob
+from contextlib import contextmanager
 import logging
 import os
-import re
+import threading
+
+from autolycus_files import atomic_write
+from autolycus_profile import profiled, span
+from hercules_libconfig import Document, ParseError, quote
+
 
 class HerculesConfig(object):
     """Manipulate Hercules configuration files.
@@ -19,6 +24,76 @@ class HerculesConfig(object):
         self.hercules_path = hercules_path
         self.logger = logging.getLogger('autolycus')
 
+        # base name -> list of full paths, conf/import overrides first
+        self._file_index = None
+        # directory -> mtime when the index was built, to tell whether files were added since
+        self._directory_mtimes = {}
+        # full path -> ((mtime, size), parsed Document)
+        self._documents = {}
+        # full path -> Document with edits not yet written to disk
+        self._pending = {}
+        self._transaction_depth = 0
+        # The status refresher, control queue and probe threads share one instance; the index,
+        # caches and pending edits are only changed while holding this.
+        self._lock = threading.RLock()
+
+    @profiled
+    def _build_index(self):
+        """Walk the conf directory once and index every file by its base name.
+
+        Files in the conf/import directory are sorted to the front of each list so they take
+        precedence over the defaults elsewhere in the conf directory. The new index replaces the
+        old one in a single assignment, so other threads never see it half built.
+
+        Returns:
+            dict: The new index.
+        """
+        conf_path = os.path.join(self.hercules_path, 'conf')
+        import_path = os.path.join(conf_path, 'import')
+        overrides = {}
+        defaults = {}
+
+        directory_mtimes = {}
+        for dir_path, dir_names, file_names in os.walk(conf_path):
+            dir_names.sort()
+            try:
+                directory_mtimes[dir_path] = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                pass
+            if dir_path == import_path or dir_path.startswith(import_path + os.sep):
+                target = overrides
+            else:
+                target = defaults
+            for file_name in sorted(file_names):
+                target.setdefault(file_name, []).append(os.path.join(dir_path, file_name))
+
+        file_index = {}
+        for file_name in set(overrides) | set(defaults):
+            file_index[file_name] = overrides.get(file_name, []) + defaults.get(file_name, [])
+        self.logger.debug(f'Indexed {len(file_index)} configuration file names in {conf_path}.')
+        self._directory_mtimes = directory_mtimes
+        self._file_index = file_index
+        return file_index
+
+    def _index_outdated(self):
+        """Check whether files were added to, removed from or renamed in the conf directory."""
+        for dir_path, mtime in self._directory_mtimes.items():
+            try:
+                if os.stat(dir_path).st_mtime_ns != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def invalidate(self):
+        """Drop the cached file index and settings so they are re-read on next access.
+
+        Edits pending in an open transaction are kept.
+        """
+        with self._lock:
+            self._file_index = None
+            self._documents = {}
+
     def _find_config_files(self, file_name):
         """Find any configuration files matching the file name.
 
@@ -27,89 +102,196 @@ class HerculesConfig(object):
 
         Raises:
             IOError: No files matching the name were found.
-        
+
         Returns:
             list: A list of configuration files, in order of priority (highest first).
                 This will sort files in the conf/import directory to the front of the list.
-        """        
-        # First check for any files matching the given file name in the conf/import directory.
-        override_glob = os.path.join(self.hercules_path, 'conf', 'import',
-                                     '**', os.path.basename(file_name))
-        matching_files = glob.glob(override_glob, recursive = True)
-
-        # Then check for any files elsewhere in the conf directory.
-        defaults_glob = os.path.join(self.hercules_path, 'conf', '**', os.path.basename(file_name))
-        matching_files += [file_name for file_name in
-                           glob.glob(defaults_glob, recursive=True)
-                           if file_name not in matching_files]
+        """
+        base_name = os.path.basename(file_name)
+        with self._lock:
+            # Another thread may drop the index at any time; keep using the one looked at here.
+            file_index = self._file_index
+            if file_index is None or \
+                    (base_name not in file_index and self._index_outdated()):
+                # Files may have been added since the index was built, so look again before
+                # failing. Names that are still missing are answered from the index until a
+                # directory changes.
+                file_index = self._build_index()
 
+        matching_files = file_index.get(base_name)
         if not matching_files:
             raise IOError(f'Failed to find any files matching {file_name} in {self.hercules_path}!')
 
         return matching_files
 
+    def config_path(self, file_name):
+        """Get the full path of the configuration file that set() would modify.
+
+        Raises:
+            IOError: No files matching the name were found.
+        """
+        return self._find_config_files(file_name)[0]
+
+    def _read_document(self, file_name):
+        """Get the parsed contents of a configuration file, re-reading it only if it changed.
+
+        Args:
+            file_name (str): The full path of the configuration file to read.
 
+        Returns:
+            hercules_libconfig.Document: The parsed file. None if the file has vanished or
+                could not be parsed.
+        """
+        with self._lock:
+            if file_name in self._pending:
+                return self._pending[file_name]
+
+            try:
+                stat = os.stat(file_name)
+            except OSError:
+                self.logger.debug(f'{file_name} has disappeared, rebuilding the file index.')
+                self._file_index = None
+                self._documents.pop(file_name, None)
+                return None
+
+            file_key = (stat.st_mtime_ns, stat.st_size)
+            cached = self._documents.get(file_name)
+            if cached is not None and cached[0] == file_key:
+                return cached[1]
+
+            try:
+                with span('HerculesConfig parse', 'hercules_config', file=file_name):
+                    document = Document.load(file_name)
+            except ParseError as exc:
+                self.logger.error(f'Failed to parse {file_name}: {exc}')
+                document = None
+
+            self._documents[file_name] = (file_key, document)
+            return document
+
+    @profiled
+    def _write_document(self, file_name, document):
+        """Atomically write a parsed configuration file back to disk."""
+        with self._lock:
+            atomic_write(file_name, document.dumps())
+            stat = os.stat(file_name)
+            self._documents[file_name] = ((stat.st_mtime_ns, stat.st_size), document)
+
+    @contextmanager
+    def transaction(self):
+        """Group several configuration changes so each modified file is only written once.
+
+        Changes made with set() inside the transaction are visible to get() straight away but
+        only written to disk when the outermost transaction ends. If an exception is raised,
+        all pending changes are discarded and no files are written.
+
+        Example:
+            with hercules_config.transaction():
+                hercules_config.set('sql_connection.conf', 'db_hostname', 'db')
+                hercules_config.set('sql_connection.conf', 'db_port', '3306')
+        """
+        self._transaction_depth += 1
+        try:
+            yield self
+        except BaseException:
+            if self._transaction_depth == 1:
+                with self._lock:
+                    self.logger.debug(f'Discarding changes to {len(self._pending)} config '
+                                      'files.')
+                    for file_name in self._pending:
+                        self._documents.pop(file_name, None)
+                    self._pending = {}
+            raise
+        else:
+            if self._transaction_depth == 1:
+                with self._lock:
+                    pending, self._pending = self._pending, {}
+                for file_name, document in pending.items():
+                    self.logger.debug(f'Writing changes to {file_name}.')
+                    self._write_document(file_name, document)
+        finally:
+            self._transaction_depth -= 1
+
+    @staticmethod
+    def _format_value(value, current=None):
+        """Format a value as libconfig text, quoting it if it needs to be a string.
+
+        Args:
+            value (str): The value to format.
+            current (hercules_libconfig.Setting, optional): The setting being replaced. If it
+                holds a string, the new value will be quoted as well.
+        """
+        value = str(value)
+        is_string = current is not None and getattr(current.value, 'kind', None) == 'string'
+        if is_string and not (value.startswith('"') and value.endswith('"')):
+            return quote(value)
+        try:
+            Document(f'value: {value}')
+        except ParseError:
+            return quote(value)
+        return value
+
+    @profiled
     def get(self, config_file, setting):
         """Read the current value for setting from config_file.
 
         This will respect override files in conf/import/ and otherwise fall back to the file name
         given.
 
-        NOTE that at this point this will not work with complex values.
-
         Args:
             config_file (str): The file name of the configuration file to read from.
-            setting (str): The setting to read from the configuration file.
+            setting (str): The setting to read from the configuration file. This can be a bare
+                setting name, which will be found wherever it is nested, or a dotted path into
+                nested groups such as "sql_connection.db_hostname".
 
         Returns:
-            str: The value for the setting as it will be used by the server.
+            str: The value for the setting as it is written in the configuration file, e.g.
+                including quotes for strings. None if the setting is not present in any of the
+                matching files.
         """
         for file_name in self._find_config_files(config_file):
-            with open(file_name, 'r') as conffile:
-                configuration = conffile.read()
-            matches = re.search(r'\s*%s\s*:\s*(.*)' % setting, configuration)
-            if len(matches.groups()) > 1:
-                self.logger.warning(f'Found multiple matches for {setting}: {matches.groups()}')
-                self.logger.warning(f'Will use first matching group {matches.groups()[0]}.')
-            if matches.groups():
-                return matches.groups()[0]
+            document = self._read_document(file_name)
+            if document is not None:
+                value = document.get_raw(setting)
+                if value is not None:
+                    return value
+        return None
 
+    @profiled
     def set(self, file_name, setting, value):
         """Set the given value in the given configuration file.
 
+        The highest priority file matching the file name (usually the conf/import override) is
+        modified. The file is written straight away unless a transaction() is open. If the
+        setting is not in that file yet, it is added to the same group it is in within the
+        default configuration file.
+
         Args:
             config_file (str): The basic file name of the configuration file to modify.
-            setting (str): The name of the option to set.
+            setting (str): The name or dotted path of the option to set.
             value (str): The new value for the option.
         """
-        full_path = self._find_config_files(file_name)[0]
-        self.logger.debug(f'{full_path}: Setting {setting}: {value}.')
-        lines = []
-        with open(full_path) as config_file:
-            config = config_file.read()
-
-        config_lines = config.splitlines()
-
-        matches = re.search(r'\s*%s\s*:.*' % setting, config)
-        if not matches:
-            # setting isn't currently in the file. Simply append it.
-            out_lines = config_lines
-            out_lines.append(f'{setting}: {value}')
-        else:
-            out_lines = []
-            for line in config_lines:
-                matches = re.search(r'\s*%s\s*:\s*(.*)' % setting, line)
-                if matches:
-                    if matches.groups()[0].startswith('"'):
-                        value = f'"{value}"'
-                    new_line = re.sub(matches.groups()[0], value, line)
-                    self.logger.debug(f'Replacing {line} with {new_line}.')
-                    out_lines.append(new_line)
-                else:
-                    out_lines.append(line)
-
-        with open(full_path, 'w') as outfile:
-            outfile.write(os.linesep.join(out_lines))
+        matching_files = self._find_config_files(file_name)
+        full_path = matching_files[0]
+        document = self._read_document(full_path)
+        if document is None:
+            raise IOError(f'Failed to read {full_path}!')
+
+        path = setting
+        current = document.find(setting)
+        if current is None:
+            for default_file in matching_files[1:]:
+                default_document = self._read_document(default_file)
+                if default_document is not None and default_document.find(setting) is not None:
+                    current = default_document.find(setting)
+                    path = default_document.path_of(setting)
+                    break
+
+        raw_value = self._format_value(value, current)
+        self.logger.debug(f'{full_path}: Setting {path}: {raw_value}.')
+        with self.transaction(), self._lock:
+            document.set(path, raw_value)
+            self._pending[full_path] = document
 
     def show_rate_messages(self, enabled):
         """Toggle XP/drop etc rate messages on login."""
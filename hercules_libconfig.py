@@ -0,0 +1,447 @@
+import re
+
+# A single master pattern for every token in the libconfig dialect used by Hercules. Whitespace
+# and comments are matched so they can be skipped, but they are never discarded from the source
+# text, which is what lets documents serialise back byte-identically. Besides standard libconfig,
+# Hercules' database files use <" ... "> blocks for multi-line script values.
+TOKEN_RE = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<comment>//[^\n]*|\#[^\n]*|/\*.*?\*/)
+  | (?P<include>@include[ \t]+"(?:[^"\\\n]|\\.)*")
+  | (?P<script><".*?">)
+  | (?P<string>"(?:[^"\\]|\\.)*")
+  | (?P<hex>[-+]?0[xX][0-9A-Fa-f]+L{0,2})
+  | (?P<float>[-+]?(?:\d+\.\d*|\.\d+)(?:[eE][-+]?\d+)?|[-+]?\d+[eE][-+]?\d+)
+  | (?P<int>[-+]?\d+L{0,2})
+  | (?P<name>[A-Za-z*][-A-Za-z0-9_*]*)
+  | (?P<punct>[:=;,{}\[\]()])
+''', re.VERBOSE | re.DOTALL)
+
+STRING_ESCAPES = {'\\': '\\', '"': '"', 'n': '\n', 'r': '\r', 't': '\t', 'f': '\f'}
+STRING_ESCAPE_RE = re.compile(r'\\(x[0-9A-Fa-f]{2}|.)', re.DOTALL)
+
+
+class ParseError(ValueError):
+    """The configuration text is not valid libconfig syntax."""
+
+    def __init__(self, message, text, position, file_name=None):
+        line = text.count('\n', 0, position) + 1
+        column = position - text.rfind('\n', 0, position)
+        location = f'{file_name or "<string>"}:{line}:{column}'
+        super().__init__(f'{location}: {message}')
+        self.line = line
+        self.column = column
+
+
+class Node(object):
+    """A part of a configuration document, spanning text[start:end] in the source."""
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+
+class Scalar(Node):
+    """A single integer, float, boolean, (possibly concatenated) string or <" script "> value."""
+
+    def __init__(self, start, end, kind, raw):
+        super().__init__(start, end)
+        self.kind = kind
+        self.raw = raw
+
+    def to_python(self):
+        if self.kind == 'string':
+            return ''.join(_unescape(part) for part in STRING_PARTS_RE.findall(self.raw))
+        elif self.kind == 'script':
+            return self.raw[2:-2]
+        elif self.kind == 'bool':
+            return self.raw.lower() == 'true'
+        elif self.kind == 'hex':
+            return int(self.raw.rstrip('L'), 16)
+        elif self.kind == 'int':
+            return int(self.raw.rstrip('L'))
+        return float(self.raw)
+
+
+class Sequence(Node):
+    """A libconfig list - ( ... ) - or array - [ ... ] - of values."""
+
+    def __init__(self, start, end, kind, items):
+        super().__init__(start, end)
+        self.kind = kind
+        self.items = items
+
+    def to_python(self):
+        return [item.to_python() for item in self.items]
+
+
+class Group(Node):
+    """A group of settings - { ... } - or the top level of a document."""
+
+    def __init__(self, start, end, items):
+        super().__init__(start, end)
+        self.items = items
+        self.settings = {}
+        for item in items:
+            if isinstance(item, Setting):
+                self.settings.setdefault(item.name, item)
+
+    def to_python(self):
+        return {name: setting.value.to_python() for name, setting in self.settings.items()}
+
+
+class Setting(Node):
+    """A name: value pair. The span covers the name and value but not the terminator."""
+
+    def __init__(self, start, end, name, value):
+        super().__init__(start, end)
+        self.name = name
+        self.value = value
+
+
+class Include(Node):
+    """An @include "file" directive. Included files are not followed."""
+
+    def __init__(self, start, end, path):
+        super().__init__(start, end)
+        self.path = path
+
+
+STRING_PARTS_RE = re.compile(r'"((?:[^"\\]|\\.)*)"', re.DOTALL)
+
+
+def _unescape(string):
+    def replace(match):
+        escape = match.group(1)
+        if escape.startswith('x') and len(escape) == 3:
+            return chr(int(escape[1:], 16))
+        return STRING_ESCAPES.get(escape, escape)
+    return STRING_ESCAPE_RE.sub(replace, string)
+
+
+def quote(value):
+    """Format a Python string as a libconfig string literal."""
+    escaped = value.replace('\\', '\\\\').replace('"', '\\"')
+    escaped = escaped.replace('\n', '\\n').replace('\r', '\\r').replace('\t', '\\t')
+    return f'"{escaped}"'
+
+
+class _Parser(object):
+    """Single-pass recursive descent parser over the token stream of a configuration text."""
+
+    def __init__(self, text, file_name=None):
+        self.text = text
+        self.file_name = file_name
+        self.tokens = self._tokenize()
+        self.token = None
+        self._advance()
+
+    def _error(self, message, position=None):
+        if position is None:
+            position = self.token[1] if self.token else len(self.text)
+        return ParseError(message, self.text, position, self.file_name)
+
+    def _tokenize(self):
+        text = self.text
+        position = 0
+        length = len(text)
+        match = TOKEN_RE.match
+        while position < length:
+            token = match(text, position)
+            if token is None:
+                raise self._error(f'Unexpected character {text[position]!r}', position)
+            kind = token.lastgroup
+            if kind not in ('space', 'comment'):
+                yield (kind, position, token.end())
+            position = token.end()
+
+    def _advance(self):
+        self.token = next(self.tokens, None)
+
+    def _is_punct(self, chars):
+        return self.token is not None and self.token[0] == 'punct' and \
+            self.text[self.token[1]] in chars
+
+    def parse(self):
+        items = self._group_items()
+        if self.token is not None:
+            raise self._error(f'Unexpected {self.text[self.token[1]:self.token[2]]!r}')
+        return Group(0, len(self.text), items)
+
+    def _group_items(self):
+        items = []
+        while self.token is not None and not self._is_punct('}'):
+            kind, start, end = self.token
+            if kind == 'include':
+                raw = self.text[start:end]
+                path = STRING_PARTS_RE.search(raw).group(1)
+                items.append(Include(start, end, _unescape(path)))
+                self._advance()
+            elif kind == 'name':
+                items.append(self._setting())
+            else:
+                raise self._error(f'Expected a setting name, got {self.text[start:end]!r}')
+        return items
+
+    def _setting(self):
+        _, start, end = self.token
+        name = self.text[start:end]
+        self._advance()
+        if not self._is_punct(':='):
+            raise self._error(f'Expected ":" or "=" after {name!r}')
+        self._advance()
+        value = self._value()
+        if self._is_punct(';,'):
+            self._advance()
+        return Setting(start, value.end, name, value)
+
+    def _value(self):
+        if self.token is None:
+            raise self._error('Unexpected end of file, expected a value')
+        kind, start, end = self.token
+        if kind == 'string':
+            # Adjacent string literals are concatenated into a single value.
+            self._advance()
+            while self.token is not None and self.token[0] == 'string':
+                end = self.token[2]
+                self._advance()
+            return Scalar(start, end, 'string', self.text[start:end])
+        elif kind in ('script', 'hex', 'float', 'int'):
+            self._advance()
+            return Scalar(start, end, kind, self.text[start:end])
+        elif kind == 'name' and self.text[start:end].lower() in ('true', 'false'):
+            self._advance()
+            return Scalar(start, end, 'bool', self.text[start:end])
+        elif self._is_punct('{'):
+            self._advance()
+            items = self._group_items()
+            if not self._is_punct('}'):
+                raise self._error('Unterminated group, expected "}"')
+            end = self.token[2]
+            self._advance()
+            return Group(start, end, items)
+        elif self._is_punct('(['):
+            closing = ')' if self.text[start] == '(' else ']'
+            self._advance()
+            items = []
+            while not self._is_punct(closing):
+                items.append(self._value())
+                if self._is_punct(','):
+                    self._advance()
+                elif not self._is_punct(closing):
+                    raise self._error(f'Expected "," or "{closing}" in list')
+            end = self.token[2]
+            self._advance()
+            return Sequence(start, end, 'list' if closing == ')' else 'array', items)
+        raise self._error(f'Expected a value, got {self.text[start:end]!r}')
+
+
+def parse(text, file_name=None):
+    """Parse libconfig text into a tree of nodes.
+
+    Args:
+        text (str): The configuration text to parse.
+        file_name (str, optional): The file the text was read from, used in error messages.
+
+    Raises:
+        ParseError: The text is not valid libconfig syntax.
+
+    Returns:
+        Group: The top level group of the document.
+    """
+    return _Parser(text, file_name).parse()
+
+
+class Document(object):
+    """A parsed configuration file that can be queried, edited and written back.
+
+    The document keeps its source text and every node records its span within it, so edits
+    only ever replace the text of the values being changed; comments, whitespace and everything
+    else in the file survive untouched.
+
+    Args:
+        text (str): The configuration text.
+        file_name (str, optional): The file the text was read from, used in error messages.
+    """
+
+    def __init__(self, text, file_name=None):
+        self.file_name = file_name
+        self._set_text(text)
+
+    @classmethod
+    def load(cls, file_name):
+        """Read and parse a configuration file.
+
+        Args:
+            file_name (str): The path of the file to read.
+
+        Returns:
+            Document: The parsed document.
+        """
+        with open(file_name, 'r', newline='') as conffile:
+            return cls(conffile.read(), file_name)
+
+    def _set_text(self, text):
+        self.root = parse(text, self.file_name)
+        self.text = text
+        # setting name -> first setting of that name, built on the first lookup by bare name
+        self._names = None
+
+    def dumps(self):
+        """Serialise the document back to libconfig text."""
+        return self.text
+
+    def walk(self, group=None, prefix=()):
+        """Iterate over every setting in the document, depth first.
+
+        Yields:
+            tuple: The setting's path as a tuple of names and the Setting node itself.
+        """
+        group = self.root if group is None else group
+        for item in group.items:
+            if isinstance(item, Setting):
+                path = prefix + (item.name,)
+                yield path, item
+                if isinstance(item.value, Group):
+                    yield from self.walk(item.value, path)
+
+    def find(self, path):
+        """Find a setting by its dotted path.
+
+        The path is first resolved from the top of the document. If that fails, the first setting
+        (depth first) whose path ends with the given names is returned, so a bare setting name
+        finds that setting wherever it is nested.
+
+        Args:
+            path (str): The dotted path of the setting, e.g. "sql_connection.db_hostname".
+
+        Returns:
+            Setting: The setting node, or None if there is no such setting.
+        """
+        names = tuple(path.split('.'))
+        group = self.root
+        for depth, name in enumerate(names):
+            setting = group.settings.get(name)
+            if setting is None:
+                break
+            if depth == len(names) - 1:
+                return setting
+            if not isinstance(setting.value, Group):
+                break
+            group = setting.value
+
+        if len(names) == 1:
+            if self._names is None:
+                self._names = {}
+                for setting_path, setting in self.walk():
+                    self._names.setdefault(setting_path[-1], setting)
+            return self._names.get(names[0])
+
+        for setting_path, setting in self.walk():
+            if setting_path[-len(names):] == names:
+                return setting
+        return None
+
+    def path_of(self, path):
+        """Get the full dotted path of the setting a (possibly partial) path refers to.
+
+        Returns:
+            str: The full dotted path from the top of the document, or None if not found.
+        """
+        target = self.find(path)
+        for setting_path, setting in self.walk():
+            if setting is target:
+                return '.'.join(setting_path)
+        return None
+
+    def get(self, path, default=None):
+        """Get the Python value of a setting.
+
+        Args:
+            path (str): The dotted path of the setting.
+            default (optional): The value to return if the setting does not exist.
+        """
+        setting = self.find(path)
+        return default if setting is None else setting.value.to_python()
+
+    def get_raw(self, path):
+        """Get the source text of a setting's value, or None if it does not exist."""
+        setting = self.find(path)
+        return None if setting is None else self.text[setting.value.start:setting.value.end]
+
+    def set(self, path, raw_value):
+        """Set a setting to the given libconfig value text. See update()."""
+        self.update({path: raw_value})
+
+    def update(self, changes):
+        """Apply several settings changes, re-parsing the document only once.
+
+        Existing settings have only their value text replaced. Missing settings are inserted at
+        the end of the deepest existing group on their path, creating any missing groups.
+
+        Args:
+            changes (dict): Dotted setting paths mapped to their new value as libconfig text,
+                e.g. '"127.0.0.1"' for a string or '3306' for an integer.
+        """
+        replacements = []
+        insertions = {}
+        for path, raw_value in changes.items():
+            setting = self.find(path)
+            if setting is not None:
+                replacements.append((setting.value.start, setting.value.end, raw_value))
+                continue
+
+            names = path.split('.')
+            group, depth = self.root, 0
+            while depth < len(names) - 1:
+                parent = group.settings.get(names[depth])
+                if parent is None or not isinstance(parent.value, Group):
+                    break
+                group, depth = parent.value, depth + 1
+            insertions.setdefault(id(group), (group, []))[1].append((names[depth:], raw_value))
+
+        for group, new_settings in insertions.values():
+            position, indent, suffix = self._insertion_point(group)
+            text = ''.join(self._format_setting(names, raw_value, indent)
+                           for names, raw_value in new_settings)
+            if position == 0:
+                text = text.lstrip('\r\n')
+            replacements.append((position, position, text + suffix))
+
+        text = self.text
+        for start, end, raw_value in sorted(replacements, key=lambda r: r[0], reverse=True):
+            text = text[:start] + raw_value + text[end:]
+        self._set_text(text)
+
+    def _insertion_point(self, group):
+        """Find where to insert new settings into a group, and how to indent them.
+
+        Returns:
+            tuple: The insertion offset, the line break and indentation to put before each new
+                setting and any text to put after the inserted settings.
+        """
+        newline = '\r\n' if '\r\n' in self.text else '\n'
+        settings = [item for item in group.items if isinstance(item, Setting)]
+        if settings:
+            last = settings[-1]
+            line_start = self.text.rfind('\n', 0, last.start) + 1
+            indent = self.text[line_start:last.start]
+            if indent.strip():
+                indent = ''
+            end = last.end
+            if self.text[end:end + 1] in (';', ','):
+                end += 1
+            return end, newline + indent, ''
+        if group is self.root:
+            return len(self.text.rstrip()), newline, '' if self.text.strip() else newline
+        # Empty group: insert just inside the opening brace, one level deeper than its line.
+        line_start = self.text.rfind('\n', 0, group.start) + 1
+        line = self.text[line_start:group.start]
+        brace_indent = line[:len(line) - len(line.lstrip(' \t'))]
+        return group.start + 1, newline + brace_indent + '\t', newline + brace_indent
+
+    def _format_setting(self, names, raw_value, indent):
+        if len(names) == 1:
+            return f'{indent}{names[0]}: {raw_value}'
+        inner = self._format_setting(names[1:], raw_value, indent + '\t')
+        return f'{indent}{names[0]}: {{{inner}{indent}}}'